@@ -0,0 +1,155 @@
+import asyncio
+import os
+import time
+
+from contextlib import asynccontextmanager
+
+import metrics
+from log import Log
+from sqlitestore import SQLiteStore
+
+# Admission control in front of DeepStack, shared by every gunicorn worker through
+# a small SQLite database (like the trigger store).  At most `concurrency`
+# detections run at once over all workers; further ones wait in a bounded queue,
+# served by camera priority (higher first) and then in arrival order.  A waiting
+# event is dropped once its deadline passes, since a late detection is worth
+# nothing.  When the queue is full a new event is refused straight away, unless
+# it has a higher priority than the lowest priority waiter, which is then dropped
+# in its place.  Slots held by a worker that died are reclaimed.  The SQLite calls
+# run on a few threads of the admission's own, so a busy database never blocks the
+# worker's event loop.
+
+class Overloaded(Exception):
+    """Raised instead of running a detection; status is the HTTP status to answer with."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class Admission(SQLiteStore):
+    schema = ("CREATE TABLE IF NOT EXISTS admission (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+              "camera_id TEXT NOT NULL, priority INTEGER NOT NULL, pid INTEGER NOT NULL, "
+              "deadline REAL NOT NULL, granted REAL)",)
+    threads = 4
+
+    def __init__(self, filename, concurrency, max_queue=32, lease=300.0, busy_timeout=5.0):
+        super().__init__(filename, busy_timeout)
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        # Slots older than this are considered leaked and reclaimed
+        self.lease = lease
+        self.stats = {"admitted": 0, "queued": 0, "refused": 0, "shed": 0, "expired": 0}
+        self._cleaned = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.concurrency > 0
+
+    def _cleanup(self, db, now):
+        # At most once a second: leaked slots, waiters past their deadline, and rows of workers that are gone
+        if now - self._cleaned < 1.0:
+            return
+        self._cleaned = now
+        db.execute("DELETE FROM admission WHERE granted IS NOT NULL AND granted < ?", (now - self.lease,))
+        db.execute("DELETE FROM admission WHERE granted IS NULL AND deadline < ?", (now - 1.0,))
+        for (pid,) in db.execute("SELECT DISTINCT pid FROM admission").fetchall():
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                db.execute("DELETE FROM admission WHERE pid = ?", (pid,))
+            except PermissionError:
+                pass
+
+    def _enqueue(self, camera_id, priority, deadline, now) -> int:
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            self._cleanup(db, now)
+            waiting = db.execute("SELECT COUNT(*) FROM admission WHERE granted IS NULL").fetchone()[0]
+            if waiting >= self.max_queue:
+                victim = db.execute("SELECT id FROM admission WHERE granted IS NULL AND priority < ? "
+                                    "ORDER BY priority, id DESC LIMIT 1", (priority,)).fetchone()
+                if victim is None:
+                    raise Overloaded(429, "Detection queue full ({} waiting)".format(waiting))
+                db.execute("DELETE FROM admission WHERE id = ?", victim)
+            ticket = db.execute("INSERT INTO admission (camera_id, priority, pid, deadline) VALUES (?, ?, ?, ?)",
+                                (str(camera_id), priority, os.getpid(), deadline)).lastrowid
+            db.execute("COMMIT")
+            return ticket
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _try_grant(self, ticket, now):
+        """True when the ticket got a slot, False to keep waiting, None when it was shed from the queue."""
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            self._cleanup(db, now)
+            if db.execute("SELECT 1 FROM admission WHERE id = ?", (ticket,)).fetchone() is None:
+                return None
+            held = db.execute("SELECT COUNT(*) FROM admission WHERE granted IS NOT NULL").fetchone()[0]
+            free = self.concurrency - held
+            if free <= 0:
+                return False
+            ahead = db.execute("SELECT id FROM admission WHERE granted IS NULL AND deadline >= ? "
+                               "ORDER BY priority DESC, id LIMIT ?", (now, free)).fetchall()
+            if (ticket,) not in ahead:
+                return False
+            db.execute("UPDATE admission SET granted = ? WHERE id = ?", (now, ticket))
+            return True
+        finally:
+            db.execute("COMMIT")
+
+    def _release(self, ticket):
+        self._connection().execute("DELETE FROM admission WHERE id = ?", (ticket,))
+
+    def _release_enqueued(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self._get_executor().submit(self._release, future.result())
+
+    @asynccontextmanager
+    async def slot(self, camera_id, priority, deadline):
+        """Hold one of the detection slots, waiting for it until deadline (a time.time())."""
+        if not self.enabled:
+            yield
+            return
+        now = time.time()
+        if now >= deadline:
+            self.stats["expired"] += 1
+            raise Overloaded(503, "Event for camera {} expired before detection".format(camera_id))
+        enqueued = asyncio.ensure_future(self.run(self._enqueue, camera_id, priority, deadline, now))
+        try:
+            ticket = await asyncio.shield(enqueued)
+        except Overloaded:
+            self.stats["refused"] += 1
+            raise
+        except asyncio.CancelledError:
+            # Give the ticket back once the enqueue still running in its thread is done
+            enqueued.add_done_callback(self._release_enqueued)
+            raise
+        try:
+            delay = 0.005
+            granted = await self.run(self._try_grant, ticket, now)
+            if not granted:
+                self.stats["queued"] += 1
+            while not granted:
+                if granted is None:
+                    self.stats["shed"] += 1
+                    raise Overloaded(429, "Event for camera {} dropped for a higher priority one".format(camera_id))
+                if time.time() >= deadline:
+                    self.stats["expired"] += 1
+                    raise Overloaded(503, "Event for camera {} waited {:.1f}s for detection, dropped".format(
+                        camera_id, time.time() - now))
+                await asyncio.sleep(delay)
+                delay = min(0.05, delay * 2)
+                granted = await self.run(self._try_grant, ticket, time.time())
+            self.stats["admitted"] += 1
+            waited = time.time() - now
+            metrics.stage_seconds.labels("admission", str(camera_id)).observe(waited)
+            if waited > 1:
+                Log("INFO", "Camera {} waited {:.1f}s for a detection slot", camera_id, waited)
+            yield
+        finally:
+            # Not awaited, so a cancelled event still gives its slot back
+            self._get_executor().submit(self._release, ticket)
@@ -0,0 +1,90 @@
+import asyncio
+import collections
+
+import metrics
+from camerarules import camera_options, setting_options
+from log import Log
+
+# Burst mode.  Instead of deciding an event on its single snapshot, take up to
+# `frames` snapshots `spacing` seconds apart and trigger on the first one that
+# passes the camera's rules, so someone leaving the frame or blurred in the first
+# snapshot is still caught without lowering thresholds.  The frames are pipelined:
+# the next snapshot is fetched while earlier ones are still in detection, and as
+# soon as one passes, the fetches and detections still in progress are cancelled.
+# When several finished frames pass at once, the one with the most confident
+# detection is used for the capture and the email.  An event whose first frame
+# passes within `spacing` seconds costs no more than without a burst.
+#
+# Enabled with the "burst" setting, or per camera with a "burst" entry in cameras.json
+# (true/false, or an object overriding the options below).
+
+DEFAULTS = {
+    # Snapshots per event, the event's own included
+    "frames": 3,
+    # Seconds between two snapshots
+    "spacing": 0.5,
+}
+
+global_options = None
+
+# A snapshot of the event and the outcome of its detection.  error is the message of
+# a detection that failed, qualifying the zones.Detection list that passed the rules.
+Frame = collections.namedtuple("Frame", "index snapshot predictions qualifying skipped error")
+
+def configure(settings):
+    global global_options
+    global_options = setting_options(settings.get("burst"), DEFAULTS)
+
+def options(camera):
+    return camera_options(camera, "burst", global_options, DEFAULTS)
+
+def score(frame) -> int:
+    return max(d.confidence for d in frame.qualifying)
+
+async def run(camera, first, fetch, evaluate, opts) -> Frame:
+    """The frame to decide an event of the camera on.
+
+    first is the event's snapshot, fetch() gets another one and evaluate(index,
+    snapshot) returns its Frame.  When no frame passes, the earliest one without an
+    error is returned.  Exceptions of the first frame are raised, those of the
+    others are logged and the frame is left out.
+    """
+    async def frame(index):
+        if index == 0:
+            return await evaluate(0, first)
+        await asyncio.sleep(index * opts["spacing"])
+        return await evaluate(index, await fetch())
+
+    tasks = [asyncio.ensure_future(frame(i)) for i in range(max(1, int(opts["frames"])))]
+    pending = set(tasks)
+    frames = []
+    passed = []
+    try:
+        while pending and not passed:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index = tasks.index(task)
+                if task.exception() is not None:
+                    if index == 0:
+                        raise task.exception()
+                    metrics.burst_frames.labels(camera.id, "failed").inc()
+                    Log("ERROR", "Burst frame {} of {} failed: {}", index + 1, camera.name, task.exception())
+                    continue
+                metrics.burst_frames.labels(camera.id, "detected").inc()
+                frames.append(task.result())
+                if task.result().qualifying:
+                    passed.append(task.result())
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            metrics.burst_frames.labels(camera.id, "cancelled").inc(len(pending))
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    if passed:
+        best = max(passed, key=score)
+        if best.index > 0:
+            Log("INFO", "{} passed on burst frame {} of {}", camera.name, best.index + 1, len(tasks))
+        return best
+    frames.sort(key=lambda f: (f.error is not None, f.index))
+    return frames[0]
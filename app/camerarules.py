@@ -0,0 +1,131 @@
+import json
+import os
+import threading
+
+from log import Log
+
+# cameras.json compiled into a per camera index so the detection path never has to
+# walk or re-parse the raw configuration.  The index is rebuilt whenever the file's
+# mtime changes and swapped in with a single assignment, so requests always see
+# either the old or the new configuration, never a mix of both.
+
+class Rule:
+    """A detect_objects entry: thresholds plus pre-parsed ignore zones."""
+    __slots__ = ("label", "min_sizex", "min_sizey", "min_confidence",
+                 "ignore_areas", "ignore_polygons", "polygon_bboxes", "zones")
+
+    def __init__(self, detect_object):
+        self.label = detect_object["type"]
+        self.min_sizex = detect_object["min_sizex"]
+        self.min_sizey = detect_object["min_sizey"]
+        self.min_confidence = detect_object["min_confidence"]
+        # (x_min, y_min, x_max, y_max)
+        self.ignore_areas = tuple(
+            (int(a["x_min"]), int(a["y_min"]), int(a["x_max"]), int(a["y_max"]))
+            for a in detect_object.get("ignore_areas", []))
+        polygons = []
+        for polygon in detect_object.get("ignore_polygons", []):
+            points = []
+            for point in polygon:
+                if len(point) != 2:
+                    Log("ERROR", "Ignoring invalid point {} in ignore polygon for '{}'", point, self.label)
+                    continue
+                points.append((point[0], point[1]))
+            polygons.append(tuple(points))
+        self.ignore_polygons = tuple(polygons)
+        # (x_min, y_min, x_max, y_max) of every ignore polygon
+        self.polygon_bboxes = tuple(
+            (min(x for x, _ in pts), min(y for _, y in pts), max(x for x, _ in pts), max(y for _, y in pts))
+            if pts else (0, 0, -1, -1)
+            for pts in self.ignore_polygons)
+        # Compiled on first use by zones.get_zones
+        self.zones = None
+
+class Camera:
+    """A cameras.json entry, with its rules indexed by label."""
+    __slots__ = ("id", "name", "trigger_url", "homekit_acc_id", "detect_objects", "rules",
+                 "ignore_areas", "ignore_polygons", "options")
+
+    def __init__(self, camera_id, data):
+        self.id = camera_id
+        self.name = data["name"]
+        self.trigger_url = data["triggerUrl"]
+        self.homekit_acc_id = data.get("homekitAccId")
+        self.detect_objects = tuple(Rule(d) for d in data.get("detect_objects", []))
+        rules = {}
+        for rule in self.detect_objects:
+            rules[rule.label] = rules.get(rule.label, ()) + (rule,)
+        self.rules = rules
+        # Every ignore zone of the camera, used when annotating captures
+        self.ignore_areas = tuple(a for r in self.detect_objects for a in r.ignore_areas)
+        self.ignore_polygons = tuple(p for r in self.detect_objects for p in r.ignore_polygons)
+        # Raw entry, for optional per camera settings
+        self.options = data
+
+def setting_options(value, defaults):
+    """Options of an optional feature from its setting: None when it is off (missing or false),
+    the defaults when it is true, and the defaults overridden by its entries when it is an object."""
+    if not value:
+        return None
+    return dict(defaults, **(value if isinstance(value, dict) else {}))
+
+def camera_options(camera, key, global_options, defaults):
+    """Options of an optional feature for a camera, None when it is off for it.  A "key" entry in
+    cameras.json turns the feature on or off for the camera, or overrides some of its options;
+    without one the camera follows the global setting (global_options, from setting_options)."""
+    value = camera.options.get(key)
+    if value is None:
+        return global_options
+    return setting_options(value, global_options or defaults)
+
+def compile_cameras(cameradata) -> dict:
+    return {str(camera_id): Camera(str(camera_id), data) for camera_id, data in cameradata.items()}
+
+class CameraIndex:
+    """Compiled cameras.json, reloaded when the file changes on disk."""
+
+    def __init__(self, filename, check_interval=1.0):
+        self.filename = filename
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked = 0.0
+        self.cameras = {}
+        self.reload()
+
+    def reload(self) -> bool:
+        with self._lock:
+            mtime = None
+            try:
+                mtime = os.stat(self.filename).st_mtime
+                if mtime == self._mtime:
+                    return False
+                with open(self.filename) as f:
+                    cameras = compile_cameras(json.load(f))
+            except Exception as e:
+                if self._mtime is None:
+                    raise
+                Log("ERROR", "Error reloading {}, keeping previous camera configuration: {}", self.filename, e)
+                if mtime is not None:
+                    self._mtime = mtime
+                return False
+            self.cameras = cameras
+            self._mtime = mtime
+            Log("INFO", "Loaded {} camera(s) from {}", len(cameras), self.filename)
+            return True
+
+    def refresh(self, now):
+        if now - self._checked >= self.check_interval:
+            self._checked = now
+            self.reload()
+
+    def get(self, camera_id, now=None):
+        if now is not None:
+            self.refresh(now)
+        return self.cameras.get(str(camera_id))
+
+    def group(self, name, now=None) -> list:
+        """Ids of the cameras listing name in their "groups" entry."""
+        if now is not None:
+            self.refresh(now)
+        return [camera_id for camera_id, camera in self.cameras.items() if name in camera.options.get("groups", ())]
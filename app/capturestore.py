@@ -0,0 +1,197 @@
+import json
+import os
+import re
+import sys
+import time
+
+from log import Log
+from sqlitestore import SQLiteStore
+
+# Annotated captures, sharded by camera and day under captureDir
+# ({camera}/{YYYY}/{MM}/{DD}/{camera}-{epoch}.jpg) and recorded in a SQLite index
+# with their labels, detections and size.  The index answers /events without
+# listing directories, and lets the pruner enforce the size and age budgets: the
+# oldest captures go first, per camera and overall.  Pruning is claimed through the
+# index, so only one worker prunes per interval.
+
+class CaptureStore(SQLiteStore):
+    schema = ("CREATE TABLE IF NOT EXISTS captures (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+              "camera_id TEXT NOT NULL, camera_name TEXT NOT NULL, t REAL NOT NULL, labels TEXT NOT NULL, "
+              "detections TEXT NOT NULL, path TEXT NOT NULL, size INTEGER NOT NULL)",
+              "CREATE INDEX IF NOT EXISTS captures_camera_t ON captures (camera_id, t)",
+              "CREATE INDEX IF NOT EXISTS captures_t ON captures (t)",
+              "CREATE TABLE IF NOT EXISTS capture_meta (key TEXT PRIMARY KEY, value REAL NOT NULL)")
+
+    def __init__(self, root, index=None, max_bytes=None, camera_max_bytes=None, max_age_days=None,
+                 prune_interval=300.0, busy_timeout=5.0):
+        self.root = root
+        self.index = index or os.path.join(root, "captures.db")
+        self.max_bytes = max_bytes
+        self.camera_max_bytes = camera_max_bytes
+        self.max_age_days = max_age_days
+        self.prune_interval = prune_interval
+        self._pruner = None
+        os.makedirs(root, exist_ok=True)
+        super().__init__(self.index, busy_timeout)
+
+    @classmethod
+    def from_settings(cls, settings, root):
+        return cls(root,
+                   index=settings.get("captureIndex"),
+                   max_bytes=settings.get("captureMaxBytes"),
+                   camera_max_bytes=settings.get("captureCameraMaxBytes"),
+                   max_age_days=settings.get("captureMaxAgeDays"),
+                   prune_interval=float(settings.get("capturePruneInterval", 300)))
+
+    def path(self, camera_name, t) -> str:
+        """Where the capture of camera_name taken at t goes; the directory is created."""
+        shard = _safe(camera_name)
+        directory = os.path.join(self.root, shard, time.strftime("%Y/%m/%d", time.localtime(t)))
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, "{}-{}.jpg".format(shard, t))
+
+    def record(self, camera_id, camera_name, t, labels, detections, path) -> int:
+        """Index a capture written to path, with its thumbnail if there is one; labels is a list."""
+        size = 0
+        for fn in (path, _thumbnail(path)):
+            try:
+                size += os.path.getsize(fn)
+            except OSError:
+                pass
+        return self._connection().execute(
+            "INSERT INTO captures (camera_id, camera_name, t, labels, detections, path, size) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (str(camera_id), camera_name, t, json.dumps(labels), json.dumps(detections), os.path.relpath(path, self.root),
+             size)).lastrowid
+
+    def events(self, camera_id=None, label=None, since=None, until=None, before=None, limit=50) -> dict:
+        """Newest first.  Pass the returned "next" as before to get the following page."""
+        where, args = [], []
+        for clause, value in (("camera_id = ?", camera_id), ("t >= ?", since), ("t < ?", until), ("id < ?", before)):
+            if value is not None:
+                where.append(clause)
+                args.append(str(value) if clause.startswith("camera_id") else value)
+        if label is not None:
+            # labels is a JSON list, so match the label as one of its quoted strings
+            where.append("labels LIKE ? ESCAPE '\\'")
+            args.append("%{}%".format(re.sub(r"([\\%_])", r"\\\1", json.dumps(str(label)))))
+        sql = "SELECT id, camera_id, camera_name, t, labels, detections, path, size FROM captures"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY id DESC LIMIT ?"
+        rows = self._connection().execute(sql, args + [limit]).fetchall()
+        events = [{"id": r[0], "camera_id": r[1], "camera_name": r[2], "time": r[3], "labels": json.loads(r[4]),
+                   "detections": json.loads(r[5]), "path": r[6], "size": r[7]} for r in rows]
+        return {"events": events, "next": events[-1]["id"] if len(events) == limit else None}
+
+    def file(self, event_id):
+        row = self._connection().execute("SELECT path FROM captures WHERE id = ?", (event_id,)).fetchone()
+        return os.path.join(self.root, row[0]) if row else None
+
+    def _claim_prune(self, now) -> bool:
+        cursor = self._connection().execute(
+            "INSERT INTO capture_meta (key, value) VALUES ('pruned', ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value WHERE excluded.value - capture_meta.value >= ?",
+            (now, self.prune_interval))
+        return cursor.rowcount == 1
+
+    def _over_budget(self, db, budget, camera_id=None):
+        """Oldest (id, path) rows that bring the total (of camera_id) under budget."""
+        where, args = ("WHERE camera_id = ?", (camera_id,)) if camera_id is not None else ("", ())
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM captures " + where, args).fetchone()[0]
+        doomed = []
+        if total <= budget:
+            return doomed
+        for row_id, path, size in db.execute("SELECT id, path, size FROM captures {} ORDER BY t".format(where), args):
+            doomed.append((row_id, path))
+            total -= size
+            if total <= budget:
+                break
+        return doomed
+
+    def prune(self, now=None, force=False) -> int:
+        """Delete captures beyond the age and size budgets; returns how many were deleted."""
+        now = time.time() if now is None else now
+        if not force and not self._claim_prune(now):
+            return 0
+        db = self._connection()
+        directories = set()
+        # Age first, so the size budgets only count what is left
+        deleted = 0
+        if self.max_age_days is not None:
+            deleted += self._delete(db, db.execute("SELECT id, path FROM captures WHERE t < ?",
+                                                   (now - float(self.max_age_days) * 86400,)).fetchall(), directories)
+        if self.camera_max_bytes is not None:
+            for (camera_id,) in db.execute("SELECT DISTINCT camera_id FROM captures").fetchall():
+                deleted += self._delete(db, self._over_budget(db, self.camera_max_bytes, camera_id), directories)
+        if self.max_bytes is not None:
+            deleted += self._delete(db, self._over_budget(db, self.max_bytes), directories)
+        for directory in directories:
+            # Drop the day, month and year directories once empty
+            while os.path.abspath(directory) != os.path.abspath(self.root):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+        if deleted:
+            Log("INFO", "Pruned {} capture(s) from {}", deleted, self.root)
+        return deleted
+
+    def _delete(self, db, rows, directories) -> int:
+        for row_id, path in rows:
+            fn = os.path.join(self.root, path)
+            for f in (fn, _thumbnail(fn)):
+                try:
+                    os.remove(f)
+                except FileNotFoundError:
+                    pass
+            directories.add(os.path.dirname(fn))
+            db.execute("DELETE FROM captures WHERE id = ?", (row_id,))
+        return len(rows)
+
+    def start(self, loop):
+        """Prune every prune_interval in the loop's default executor."""
+        if self._pruner is not None or (self.max_bytes is None and self.camera_max_bytes is None and self.max_age_days is None):
+            return
+
+        def done(future):
+            if future.exception() is not None:
+                Log("ERROR", "Pruning captures failed: {}", future.exception())
+
+        def tick():
+            self._pruner = loop.call_later(self.prune_interval, tick)
+            loop.run_in_executor(None, self.prune).add_done_callback(done)
+        self._pruner = loop.call_later(min(self.prune_interval, 10), tick)
+
+    def stop(self):
+        if self._pruner is not None:
+            self._pruner.cancel()
+            self._pruner = None
+
+    def migrate(self) -> int:
+        """Move the captures of an unsharded captureDir ({name}-{epoch}.jpg) into shards and index them."""
+        moved = 0
+        pattern = re.compile(r"^(.*)-(\d+(?:\.\d+)?)\.jpg$")
+        for name in sorted(os.listdir(self.root)):
+            m = pattern.match(name)
+            source = os.path.join(self.root, name)
+            if m is None or not os.path.isfile(source):
+                continue
+            camera_name, t = m.group(1), float(m.group(2))
+            target = self.path(camera_name, t)
+            os.replace(source, target)
+            self.record(camera_name, camera_name, t, [], [], target)
+            moved += 1
+        return moved
+
+def _safe(name) -> str:
+    return re.sub(r"[\\/\x00]", "_", str(name)).strip(". ") or "_"
+
+def _thumbnail(fn) -> str:
+    # See render.render
+    return "{}-thumb.jpg".format(os.path.splitext(fn)[0])
+
+if __name__ == "__main__":
+    # python capturestore.py /captureDir  -- shard and index captures saved before the store existed
+    store = CaptureStore(sys.argv[1])
+    print("Moved {} capture(s) into {}".format(store.migrate(), store.root))
@@ -0,0 +1,251 @@
+import asyncio
+import collections
+import math
+import random
+import time
+
+import httpclient
+import metrics
+from log import Log
+
+# Dispatcher for one or more DeepStack servers.  Each detection goes to the healthy
+# backend with the fewest outstanding requests, below its concurrency cap.  Backends
+# failing repeatedly are ejected by a circuit breaker and brought back by an active
+# health check.  When a request takes longer than the backend's usual latency (a
+# percentile of its recent requests) the same image is also sent to a second
+# backend and the first answer wins.
+
+class DeepStackError(Exception):
+    pass
+
+class Backend:
+
+    def __init__(self, url, max_concurrency):
+        self.url = url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self.outstanding = 0
+        self.failures = 0
+        self.open_until = 0.0
+        self.latencies = collections.deque(maxlen=200)
+        self.requests = 0
+        self.errors = 0
+        self.ejected = False
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.open_until
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and self.outstanding < self.max_concurrency
+
+    def latency_percentile(self, percentile):
+        if len(self.latencies) < 20:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(math.ceil(percentile / 100.0 * len(ordered))) - 1)]
+
+class Dispatcher:
+
+    def __init__(self, urls, max_concurrency=4, failure_threshold=3, cooldown=30.0,
+                 health_interval=10.0, hedge_percentile=95, hedge_min_delay=1.0, attempts=2):
+        if isinstance(urls, str):
+            urls = [urls]
+        self.backends = [Backend(url, max_concurrency) for url in urls]
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.health_interval = health_interval
+        # Hedging needs a second backend; a percentile of None or 0 disables it
+        self.hedge_percentile = hedge_percentile if len(self.backends) > 1 else None
+        self.hedge_min_delay = hedge_min_delay
+        self.attempts = attempts
+        self._available = None
+        self._health_task = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings["deepstackUrl"],
+                   max_concurrency=int(settings.get("deepstackMaxConcurrency", 4)),
+                   failure_threshold=int(settings.get("deepstackFailureThreshold", 3)),
+                   cooldown=float(settings.get("deepstackCooldown", 30)),
+                   health_interval=float(settings.get("deepstackHealthInterval", 10)),
+                   hedge_percentile=settings.get("deepstackHedgePercentile", 95),
+                   hedge_min_delay=float(settings.get("deepstackHedgeMinDelay", 1.0)),
+                   attempts=int(settings.get("deepstackAttempts", 2)))
+
+    def _condition(self) -> asyncio.Condition:
+        # Created lazily so it belongs to the worker's event loop
+        if self._available is None:
+            self._available = asyncio.Condition()
+            if self.health_interval > 0:
+                self._health_task = asyncio.ensure_future(self._health_checks())
+        return self._available
+
+    def _pick(self, exclude=()):
+        candidates = [b for b in self.backends if b.available and b not in exclude]
+        if not candidates:
+            return None
+        fewest = min(b.outstanding for b in candidates)
+        return random.choice([b for b in candidates if b.outstanding == fewest])
+
+    async def _acquire(self, exclude=(), wait=True):
+        """Reserve a slot on the least loaded backend, waiting for one to free up if needed."""
+        condition = self._condition()
+        async with condition:
+            while True:
+                backend = self._pick(exclude)
+                if backend is not None:
+                    backend.outstanding += 1
+                    return backend
+                if not wait:
+                    return None
+                if not any(b.healthy for b in self.backends if b not in exclude):
+                    raise DeepStackError("No healthy DeepStack backend")
+                await condition.wait()
+
+    async def _release(self, backend):
+        condition = self._condition()
+        async with condition:
+            backend.outstanding -= 1
+            condition.notify_all()
+
+    def _record(self, backend, ok, latency=None):
+        backend.requests += 1
+        if ok:
+            backend.failures = 0
+            backend.latencies.append(latency)
+            if backend.ejected:
+                # Back after its cooldown without a health check
+                self._restore(backend)
+            return
+        backend.errors += 1
+        backend.failures += 1
+        if backend.failures >= self.failure_threshold and backend.healthy:
+            backend.open_until = time.monotonic() + self.cooldown
+            backend.ejected = True
+            metrics.deepstack_ejected.labels(backend.url).set(1)
+            Log("ERROR", "DeepStack backend {} ejected after {} failures", backend.url, backend.failures)
+
+    def _restore(self, backend):
+        backend.open_until = 0.0
+        backend.failures = 0
+        backend.ejected = False
+        metrics.deepstack_ejected.labels(backend.url).set(0)
+
+    async def _call(self, backend, image) -> dict:
+        s = time.perf_counter()
+        try:
+            r = await httpclient.post("deepstack", "{}/v1/vision/detection".format(backend.url), files={"image": image})
+            r.raise_for_status()
+            response = r.json()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._record(backend, False)
+            raise DeepStackError("{}: {}".format(backend.url, e))
+        finally:
+            await self._release(backend)
+        self._record(backend, True, time.perf_counter() - s)
+        return response
+
+    def _hedge_delay(self, backend):
+        if not self.hedge_percentile:
+            return None
+        p = backend.latency_percentile(self.hedge_percentile)
+        if p is None:
+            return None
+        return max(p, self.hedge_min_delay)
+
+    async def detect(self, image) -> dict:
+        """POST image to /v1/vision/detection on the best backend and return the JSON response."""
+        tried = []
+        error = None
+        for attempt in range(self.attempts):
+            if attempt > 0:
+                metrics.retries.labels("deepstack").inc()
+            try:
+                backend = await self._acquire(exclude=tried)
+            except DeepStackError as e:
+                error = error or e
+                break
+            tried.append(backend)
+            try:
+                return await self._hedged(backend, image, tried)
+            except DeepStackError as e:
+                error = e
+                Log("ERROR", "DeepStack request failed: {}", e)
+        metrics.errors.labels("deepstack").inc()
+        raise error
+
+    async def _hedged(self, backend, image, tried) -> dict:
+        primary = asyncio.ensure_future(self._call(backend, image))
+        tasks = [primary]
+        try:
+            delay = self._hedge_delay(backend)
+            if delay is None:
+                return await primary
+            done, _ = await asyncio.wait([primary], timeout=delay)
+            if done:
+                return primary.result()
+            second = await self._acquire(exclude=tried, wait=False)
+            if second is None:
+                return await primary
+            tried.append(second)
+            metrics.deepstack_hedges.inc()
+            Log("INFO", "DeepStack {} slower than {:.2f}s, hedging to {}", backend.url, delay, second.url)
+            hedge = asyncio.ensure_future(self._call(second, image))
+            tasks.append(hedge)
+            pending = {primary, hedge}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            metrics.deepstack_hedge_wins.inc()
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # asyncio.wait leaves the requests running when detect() is cancelled, so cancel the
+            # loser (or both) here and wait until their backend slots are given back
+            running = [task for task in tasks if not task.done()]
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.wait(running)
+
+    async def _ping(self, backend) -> bool:
+        try:
+            r = await httpclient.get("deepstack", "{}/".format(backend.url), timeout=5)
+            return r.status_code < 500
+        except Exception:
+            return False
+
+    async def warm(self) -> dict:
+        """Open a keep-alive connection to every backend and start the health checks; url -> reachable."""
+        self._condition()
+        reachable = await asyncio.gather(*(self._ping(b) for b in self.backends))
+        return {b.url: ok for b, ok in zip(self.backends, reachable)}
+
+    async def _health_checks(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            for backend in self.backends:
+                ok = await self._ping(backend)
+                if not ok:
+                    if backend.healthy:
+                        self._record(backend, False)
+                    else:
+                        backend.open_until = time.monotonic() + self.cooldown
+                elif not backend.healthy or backend.failures:
+                    self._restore(backend)
+                    Log("INFO", "DeepStack backend {} is healthy again", backend.url)
+                    condition = self._condition()
+                    async with condition:
+                        condition.notify_all()
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
@@ -0,0 +1,144 @@
+import collections
+import io
+import json
+import threading
+
+from PIL import Image
+
+import metrics
+from camerarules import camera_options, setting_options
+from log import Log
+from sqlitestore import SQLiteStore
+
+# Cache of DeepStack predictions keyed by camera and a perceptual hash (dHash) of
+# the snapshot.  A snapshot whose hash is within `distance` bits of a cached one of
+# the same camera, taken less than `ttl` seconds ago, reuses its predictions instead
+# of running inference again.  Only the predictions are cached: zones, thresholds
+# and the rest of the event still run on them, so cameras.json changes apply at
+# once.  Entries live in an LRU of at most maxEntries (and perCamera per camera) in
+# each worker, or in a SQLite file shared by all workers when "store" is set.
+#
+# Enabled with the "detectionCache" setting, or per camera with a "detectionCache"
+# entry in cameras.json (true/false, or an object overriding the options below).
+
+DEFAULTS = {
+    # Seconds a cached result may be reused
+    "ttl": 30,
+    # Most differing bits (of 64) for two snapshots to count as the same scene
+    "distance": 4,
+    "maxEntries": 256,
+    "perCamera": 8,
+    # SQLite file to share the cache between workers, None for one cache per worker
+    "store": None,
+}
+
+global_options = None
+stats = {"hits": 0, "misses": 0}
+
+def configure(settings):
+    global global_options, _cache
+    global_options = setting_options(settings.get("detectionCache"), DEFAULTS)
+    if global_options and global_options["store"]:
+        _cache = SharedCache(global_options["store"])
+
+def options(camera):
+    return camera_options(camera, "detectionCache", global_options, DEFAULTS)
+
+def dhash(snapshot) -> int:
+    """64 bit difference hash: is each pixel of a 9x8 grayscale thumbnail brighter than its right neighbour."""
+    im = Image.open(io.BytesIO(snapshot))
+    if im.format == "JPEG":
+        im.draft("L", (64, 64))
+    pixels = list(im.convert("L").resize((9, 8), Image.BILINEAR).getdata())
+    h = 0
+    for row in range(8):
+        for col in range(8):
+            h = (h << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return h
+
+def distance(a, b) -> int:
+    return bin(a ^ b).count("1")
+
+class LocalCache:
+    """Per worker LRU of (camera_id, hash) -> (time, predictions)."""
+
+    def __init__(self):
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, camera_id, h, now, opts):
+        with self._lock:
+            best = None
+            for key in [k for k in self._entries if k[0] == camera_id]:
+                t, predictions = self._entries[key]
+                if now - t > opts["ttl"]:
+                    del self._entries[key]
+                    continue
+                d = distance(h, key[1])
+                if d <= opts["distance"] and (best is None or d < best[0]):
+                    best = (d, key, predictions)
+            if best is None:
+                return None
+            self._entries.move_to_end(best[1])
+            return best[2]
+
+    def put(self, camera_id, h, now, predictions, opts):
+        with self._lock:
+            self._entries.pop((camera_id, h), None)
+            self._entries[(camera_id, h)] = (now, predictions)
+            own = [k for k in self._entries if k[0] == camera_id]
+            for key in own[:max(0, len(own) - opts["perCamera"])]:
+                del self._entries[key]
+            while len(self._entries) > opts["maxEntries"]:
+                self._entries.popitem(last=False)
+
+class SharedCache(SQLiteStore):
+    """The same cache in a SQLite file shared by the workers."""
+    schema = ("CREATE TABLE IF NOT EXISTS detection_cache (camera_id TEXT NOT NULL, hash INTEGER NOT NULL, "
+              "t REAL NOT NULL, predictions TEXT NOT NULL, PRIMARY KEY (camera_id, hash))",)
+
+    @staticmethod
+    def _signed(h):
+        # SQLite integers are signed 64 bit
+        return h - (1 << 64) if h >= (1 << 63) else h
+
+    def get(self, camera_id, h, now, opts):
+        rows = self._connection().execute(
+            "SELECT hash, predictions FROM detection_cache WHERE camera_id = ? AND t >= ?",
+            (camera_id, now - opts["ttl"])).fetchall()
+        best = None
+        for stored, predictions in rows:
+            d = distance(h, stored & ((1 << 64) - 1))
+            if d <= opts["distance"] and (best is None or d < best[0]):
+                best = (d, predictions)
+        return json.loads(best[1]) if best is not None else None
+
+    def put(self, camera_id, h, now, predictions, opts):
+        db = self._connection()
+        db.execute("INSERT OR REPLACE INTO detection_cache (camera_id, hash, t, predictions) VALUES (?, ?, ?, ?)",
+                   (camera_id, self._signed(h), now, json.dumps(predictions)))
+        db.execute("DELETE FROM detection_cache WHERE t < ? OR (camera_id = ? AND rowid NOT IN "
+                   "(SELECT rowid FROM detection_cache WHERE camera_id = ? ORDER BY t DESC LIMIT ?))",
+                   (now - opts["ttl"], camera_id, camera_id, opts["perCamera"]))
+
+_cache = LocalCache()
+
+async def _call(fn, *args):
+    # The shared cache is SQLite, so it is read and written off the event loop
+    if isinstance(_cache, SharedCache):
+        return await _cache.run(fn, *args)
+    return fn(*args)
+
+async def lookup(camera, h, now, opts):
+    """Cached predictions for a snapshot of the camera with hash h, or None."""
+    predictions = await _call(_cache.get, camera.id, h, now, opts)
+    result = "hit" if predictions is not None else "miss"
+    stats["hits" if predictions is not None else "misses"] += 1
+    metrics.detection_cache.labels(camera.id, result).inc()
+    if predictions is not None:
+        Log("INFO", "Reusing cached detection for {} (cache hit rate {}/{})", camera.name, stats["hits"],
+            stats["hits"] + stats["misses"])
+    return predictions
+
+async def store(camera, h, now, predictions, opts):
+    await _call(_cache.put, camera.id, h, now, predictions, opts)
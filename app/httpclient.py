@@ -0,0 +1,71 @@
+import httpx
+
+from log import Log
+
+# Shared, pooled async HTTP clients for every outbound call made while handling
+# a camera event.  One client is kept per upstream host so each of Surveillance
+# Station, DeepStack, the trigger url and Homebridge gets its own keep-alive pool
+# and connection limit, and a slow host cannot starve the others.
+
+# Default timeouts (seconds) for each stage of a camera event
+DEFAULT_STAGE_TIMEOUTS = {
+    "snapshot": 10,
+    "deepstack": 10,
+    "trigger": 10,
+    "homebridge": 10,
+}
+
+stage_timeouts = dict(DEFAULT_STAGE_TIMEOUTS)
+max_connections_per_host = 10
+max_keepalive_per_host = 5
+connect_timeout = 5
+
+_clients = {}
+
+def configure(settings):
+    global max_connections_per_host, max_keepalive_per_host, connect_timeout
+    # Backwards compatible: "timeout" has always been the DeepStack timeout
+    if "timeout" in settings:
+        stage_timeouts["deepstack"] = int(settings["timeout"])
+    if "stageTimeouts" in settings:
+        for stage, value in settings["stageTimeouts"].items():
+            stage_timeouts[stage] = float(value)
+    if "httpMaxConnectionsPerHost" in settings:
+        max_connections_per_host = int(settings["httpMaxConnectionsPerHost"])
+    if "httpMaxKeepAlivePerHost" in settings:
+        max_keepalive_per_host = int(settings["httpMaxKeepAlivePerHost"])
+    if "httpConnectTimeout" in settings:
+        connect_timeout = float(settings["httpConnectTimeout"])
+
+def get_client(url) -> httpx.AsyncClient:
+    u = httpx.URL(url)
+    key = (u.scheme, u.host, u.port)
+    client = _clients.get(key)
+    if client is None or client.is_closed:
+        limits = httpx.Limits(max_connections=max_connections_per_host,
+                              max_keepalive_connections=max_keepalive_per_host)
+        client = httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(stage_timeouts["deepstack"], connect=connect_timeout))
+        _clients[key] = client
+    return client
+
+def stage_timeout(stage) -> httpx.Timeout:
+    return httpx.Timeout(stage_timeouts.get(stage, DEFAULT_STAGE_TIMEOUTS["snapshot"]), connect=connect_timeout)
+
+async def request(stage, method, url, **kwargs) -> httpx.Response:
+    kwargs.setdefault("timeout", stage_timeout(stage))
+    return await get_client(url).request(method, url, **kwargs)
+
+async def get(stage, url, **kwargs) -> httpx.Response:
+    return await request(stage, "GET", url, **kwargs)
+
+async def post(stage, url, **kwargs) -> httpx.Response:
+    return await request(stage, "POST", url, **kwargs)
+
+async def close():
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        try:
+            await client.aclose()
+        except Exception as e:
+            Log("ERROR", "Error closing http client: {}", e)
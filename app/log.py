@@ -0,0 +1,181 @@
+import atexit
+import contextvars
+import functools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+import metrics
+
+# Logging for the whole app.  Log(level, fmt, *args) checks the level before doing
+# anything and keeps fmt and args as they are: the "{}" formatting (and any lazy()
+# argument) is only done by the sink thread, after the record has been queued.  All
+# stdlib logging records, ours and those of the libraries, go through the same
+# bounded queue, so a slow stdout never blocks a request; records are dropped when
+# the queue is full, and counted in sssai_log_dropped_total.  Every record carries
+# the camera_id and request_id bound to the request that emitted it, and is written
+# as text or as one JSON object per line (JSON_LOGS=1).
+
+LEVELS = {
+    "DEBUG": logging.DEBUG,
+    "INFO": logging.INFO,
+    "WARNING": logging.WARNING,
+    "ERROR": logging.ERROR,
+}
+
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - [%(camera_id)s %(request_id)s] %(message)s"
+DATE_FORMAT = "%m/%d/%Y %I:%M:%S %p"
+
+camera_id = contextvars.ContextVar("camera_id", default="-")
+request_id = contextvars.ContextVar("request_id", default="-")
+
+# Libraries only logged from WARNING up, whatever the level
+QUIET_LOGGERS = ("httpx", "httpcore")
+
+# Fraction of the per-prediction DEBUG events that are logged
+debug_sample = 1.0
+queue_size = 10000
+
+_logger = logging.getLogger("sssai")
+_handler = None
+_listener = None
+_formatter = None
+
+class _Message:
+    """A "{}" format string and its arguments, formatted when the record is written."""
+    __slots__ = ("fmt", "args")
+
+    def __init__(self, fmt, args):
+        self.fmt = fmt
+        self.args = args
+
+    def __str__(self):
+        return self.fmt.format(*self.args) if self.args else str(self.fmt)
+
+class _Lazy:
+    __slots__ = ("fn", "args", "kwargs")
+
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+    def __format__(self, spec):
+        return format(self.fn(*self.args, **self.kwargs), spec)
+
+    def __str__(self):
+        return str(self.fn(*self.args, **self.kwargs))
+
+def lazy(fn, *args, **kwargs):
+    """An argument for Log that is only computed if the record is written, e.g. lazy(json.dumps, response)."""
+    return _Lazy(fn, args, kwargs)
+
+def Log(level, fmt, *args):
+    levelno = LEVELS.get(level, logging.INFO)
+    if _logger.isEnabledFor(levelno):
+        _logger.log(levelno, _Message(fmt, args))
+
+def sampled() -> bool:
+    """True when a per-prediction DEBUG event should be logged."""
+    return _logger.isEnabledFor(logging.DEBUG) and (debug_sample >= 1 or random.random() < debug_sample)
+
+def bind(camera=None, request=None):
+    """Set the camera_id and request_id of the records logged by the current task."""
+    if camera is not None:
+        camera_id.set(camera)
+    if request is not None:
+        request_id.set(request)
+
+def new_request_id() -> str:
+    return os.urandom(6).hex()
+
+def wrap(fn):
+    """fn bound to the current context, for run_in_executor (threads do not inherit it on Python 3.7)."""
+    return functools.partial(contextvars.copy_context().run, fn)
+
+class _ContextFilter(logging.Filter):
+    def filter(self, record):
+        record.camera_id = camera_id.get()
+        record.request_id = request_id.get()
+        return True
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Leave the message to the sink thread, only the traceback has to be taken now
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.log_dropped.inc()
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "camera_id": getattr(record, "camera_id", "-"),
+            "request_id": getattr(record, "request_id", "-"),
+            "pid": record.process,
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+def _start():
+    global _listener
+    sink = logging.StreamHandler(sys.stdout)
+    sink.setFormatter(_formatter)
+    _handler.queue = queue.Queue(queue_size)
+    _listener = logging.handlers.QueueListener(_handler.queue, sink)
+    _listener.start()
+
+def _after_fork():
+    # The sink thread does not survive fork, give the worker its own
+    if _handler is not None:
+        _start()
+
+def stop():
+    """Write out the queued records and stop the sink thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def setup(level=None, json_logs=None):
+    """Send all logging through the queue; level and json_logs default to LOG_LEVEL and JSON_LOGS."""
+    global _handler, _formatter
+    if level is None:
+        level = os.environ.get("LOG_LEVEL", "INFO")
+    if json_logs is None:
+        json_logs = os.environ.get("JSON_LOGS", "0") == "1"
+    _formatter = JsonFormatter() if json_logs else logging.Formatter(TEXT_FORMAT, DATE_FORMAT)
+
+    root = logging.getLogger()
+    root.setLevel(LEVELS.get(str(level).upper(), logging.INFO))
+    if _handler is None:
+        _handler = _QueueHandler(None)
+        _handler.addFilter(_ContextFilter())
+        os.register_at_fork(after_in_child=_after_fork)
+        atexit.register(stop)
+    stop()
+    root.handlers = [_handler]
+    # httpx logs every request with its full url at INFO, and the SSS login url carries the password
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+    _start()
+
+def configure(settings):
+    global debug_sample
+    if "logDebugSample" in settings:
+        debug_sample = float(settings["logDebugSample"])
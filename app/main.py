@@ -1,28 +1,60 @@
 from typing import Optional
-from fastapi import FastAPI
-from PIL import Image, ImageDraw
+from fastapi import FastAPI, Response
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from PIL import Image
 
-import requests
+import asyncio
 import logging
 import base64
+import io
 import time
 import json
-import pickle
 import sys
 import os
-from polygon import *
+import log
+from log import Log, lazy
 from sendmail import *
-
-logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+from sendmail import configure as sendmail_configure
+import httpclient
+from camerarules import CameraIndex
+from zones import find_triggers
+from triggerstore import TriggerStore
+from ssssession import SSSSession
+from notifier import NotificationQueue
+import render
+from singleflight import SingleFlight
+from deepstack import Dispatcher
+import preprocess
+import motiongate
+import tracker
+import metrics
+import scheduler
+import detectcache
+import burst
+from capturestore import CaptureStore
+from scheduler import Scheduler
+from admission import Admission, Overloaded
+from collections import Counter
+
+log.setup()
 Log("INFO",'App Started')
 app = FastAPI()
 
-with open('/config/cameras.json') as f:
-    cameradata = json.load(f)
+# settings.json and cameras.json live in /config unless SSSAI_CONFIG_DIR says otherwise
+config_dir = os.environ.get("SSSAI_CONFIG_DIR", "/config")
+camera_index = CameraIndex(os.path.join(config_dir, "cameras.json"))
 
-with open('/config/settings.json') as f:
+with open(os.path.join(config_dir, "settings.json")) as f:
     settings = json.load(f)
 
+# run.py loads the app once in the gunicorn master, so a broken config stops startup here instead of every worker
+REQUIRED_SETTINGS = ("SSSUrl", "SSSUsername", "SSSPassword", "SSSGetSessionURL", "SSSGetSnapshotURL", "deepstackUrl",
+                     "homebridgeWebhookUrl", "EmailSenderAddress", "EmailReceiverAddress", "EmailSmtpHost",
+                     "EmailSmtpPort", "EmailPassword")
+missing = [key for key in REQUIRED_SETTINGS if key not in settings]
+if missing:
+    raise SystemExit("{} is missing {}".format(os.path.join(config_dir, "settings.json"), ", ".join(missing)))
+
 SSSUrl = settings["SSSUrl"]
 deepstackUrl = settings["deepstackUrl"]
 homebridgeWebhookUrl = settings["homebridgeWebhookUrl"]
@@ -34,13 +66,25 @@ EmailSmtpHost = settings["EmailSmtpHost"]
 EmailSmtpPort = settings["EmailSmtpPort"]
 EmailPassword = settings["EmailPassword"]
 
-timeout = 10
-if "timeout" in settings:
-    timeout = int(settings["timeout"])
+# Alerts arriving within this many seconds of each other are sent as one email (0 = one email per alert)
+EmailCoalesceWindow = 0
+if "EmailCoalesceWindow" in settings:
+    EmailCoalesceWindow = float(settings["EmailCoalesceWindow"])
+log.configure(settings)
+sendmail_configure(settings)
+render.configure(settings)
+preprocess.configure(settings)
+motiongate.configure(settings)
+tracker.configure(settings)
+scheduler.configure(settings)
+detectcache.configure(settings)
+burst.configure(settings)
+
+httpclient.configure(settings)
+
+# deepstackUrl may be a single url or a list of DeepStack servers to spread detections over
+deepstack = Dispatcher.from_settings(settings)
 
-if "SSSGetSessionURL" in settings:
-    SSSGetSessionURL = settings["SSSGetSessionURL"]
-    
 # If no trigger interval set then make it 60s (i.e. don't send another event from the triggered camera for at least 60s to stop flooding event notifications
 trigger_interval = 60
 if "triggerInterval" in settings:
@@ -52,291 +96,470 @@ polygon_deepstack_bottom_offset = 0.5
 if "polygon_deepstack_bottom_offset" in settings:
     polygon_deepstack_bottom_offset = settings["polygon_deepstack_bottom_offset"]    
 
-capture_dir = "/captureDir"
-if "captureDir" in settings:
-    capture_dir = settings["captureDir"]
+# Test ignore polygons against a bitmap mask at snapshot resolution instead of ray casting
+zone_mask = False
+if "zoneMask" in settings:
+    zone_mask = settings["zoneMask"]
 
-def save_cookies(requests_cookiejar, filename):
-    with open(filename, 'wb') as f:
-        pickle.dump(requests_cookiejar, f)
+# Directory to dump every downloaded snapshot to, for debugging (off by default)
+snapshot_dump_dir = None
+if "snapshotDumpDir" in settings:
+    snapshot_dump_dir = settings["snapshotDumpDir"]
 
-def load_cookies(filename):
-    with open(filename, 'rb') as f:
-        return pickle.load(f)
+# Directory to record every snapshot with its DeepStack predictions to ({camera_id}/{epoch}.jpg and .json),
+# to replay them against a changed cameras.json with replay.py (off by default)
+replay_record_dir = settings.get("replayRecordDir")
 
-# Create a session with synology
-url = SSSGetSessionURL.format(SSSUrl,SSSUsername,SSSPassword)
-
-#  Save cookies
-Log("INFO",'Session login: ' + url)
-r = requests.get(url)
-save_cookies(r.cookies, 'cookie')
-
-# Dictionary to save last trigger times for camera to stop flooding the capability
-last_trigger_fn = "/tmp/last.dict"
+capture_dir = "/captureDir"
+if "captureDir" in settings:
+    capture_dir = settings["captureDir"]
+# Captures are sharded by camera and day, indexed for /events and pruned to the configured budgets
+capture_store = CaptureStore.from_settings(settings, capture_dir)
+
+# Session with synology, logged in on first use and again whenever it expires
+sss_session = SSSSession(SSSUrl, settings["SSSGetSessionURL"].format(SSSUrl,SSSUsername,SSSPassword), settings["SSSGetSnapshotURL"])
+
+# Last trigger times for each camera, shared by all workers, to stop flooding the capability
+last_trigger_fn = "/tmp/last_trigger.db"
+if "triggerStore" in settings:
+    last_trigger_fn = settings["triggerStore"]
+last_trigger = TriggerStore(last_trigger_fn)
+
+# Detections in progress over all workers, and how many more may wait for a slot and for how long.
+# The default lets every DeepStack server run deepstackMaxConcurrency detections (0 turns this off).
+admission = Admission(
+    settings.get("admissionStore", "/tmp/sssai_admission.db"),
+    concurrency=int(settings.get("admissionConcurrency", sum(b.max_concurrency for b in deepstack.backends))),
+    max_queue=int(settings.get("admissionQueueSize", 32)))
+admission_max_wait = float(settings.get("admissionMaxWait", 30))
+
+# Annotated captures, emails and Homebridge calls run in the background after the trigger
+notifications = NotificationQueue(
+    workers=int(settings.get("notifyWorkers", 2)),
+    maxsize=int(settings.get("notifyQueueSize", 100)),
+    retries=int(settings.get("notifyRetries", 3)),
+    backoff=float(settings.get("notifyBackoff", 1.0)))
+
+# Recordings for replay on a small queue of their own, dropped while it is full rather
+# than holding up captures and emails under load (and never retried)
+recordings = NotificationQueue(workers=1, maxsize=int(settings.get("replayRecordQueueSize", 16)), retries=0,
+                               name="recording", gauge=None)
+
+# Concurrent requests for the same camera share one snapshot and detection.  Requests
+# arriving up to detectionDebounce seconds after it completed reuse its result as well.
+detectionDebounce = 0
+if "detectionDebounce" in settings:
+    detectionDebounce = float(settings["detectionDebounce"])
+detections = SingleFlight(detectionDebounce)
+
+email_alerts = AlertCoalescer(EmailCoalesceWindow, lambda alerts: notifications.submit("email", send_email, alerts))
+
+async def detect_frame(camera, index, snapshot, start, cache, record) -> burst.Frame:
+    """Run detection on a snapshot of the camera (or reuse cached predictions) and check them against its rules."""
+    camera_id = camera.id
+    predictions = None
+    if cache is not None:
+        snapshot_hash = await asyncio.get_event_loop().run_in_executor(None, detectcache.dhash, snapshot)
+        predictions = await detectcache.lookup(camera, snapshot_hash, time.time(), cache)
+
+    if predictions is None:
+        # Optionally crop and downscale the snapshot before inference
+        image, transform = snapshot, None
+        if preprocess.needed(camera):
+            with metrics.timed("preprocess", camera_id):
+                image, transform = await asyncio.get_event_loop().run_in_executor(None, log.wrap(preprocess.prepare), camera, snapshot)
+
+        Log("INFO","Requesting detection from DeepStack...")
+        s = time.perf_counter()
+        try:
+            # Wait for one of the detection slots shared by all workers, higher "priority" cameras first
+            async with admission.slot(camera_id, int(camera.options.get("priority", 0)), start + admission_max_wait):
+                with metrics.timed("deepstack", camera_id):
+                    response = await deepstack.detect(image)
+        except Overloaded:
+            raise
+        except Exception as e:
+            Log("ERROR","Error calling Deepstack: {}", e)
+            return burst.Frame(index, snapshot, None, [], Counter(), "Error calling Deepstack: {}".format(e))
+
+        e = time.perf_counter()
+        Log("DEBUG","Got result: {}. Time: {}s", lazy(json.dumps, response, indent=2), e-s)
+        if not response["success"]:
+            metrics.errors.labels("deepstack").inc()
+            return burst.Frame(index, snapshot, None, [], Counter(), "Error calling Deepstack: " + response["error"])
+
+        predictions = preprocess.restore(response["predictions"], transform)
+        if cache is not None:
+            await detectcache.store(camera, snapshot_hash, time.time(), predictions, cache)
+    if replay_record_dir is not None and record:
+        recordings.submit("record", record_snapshot, camera_id, snapshot, predictions, time.time(), camera=camera_id)
+    frame_size = None
+    if zone_mask:
+        frame_size = Image.open(io.BytesIO(snapshot)).size
+    skipped = Counter()
+    qualifying = find_triggers(camera, predictions, polygon_deepstack_bottom_offset, frame_size, skipped)
+    return burst.Frame(index, snapshot, predictions, qualifying, skipped, None)
+
+def record_snapshot(camera_id, snapshot, predictions, t):
+    directory = os.path.join(replay_record_dir, str(camera_id))
+    os.makedirs(directory, exist_ok=True)
+    fn = os.path.join(directory, "{}".format(t))
+    with open(fn + ".jpg", "wb") as f:
+        f.write(snapshot)
+    with open(fn + ".json", "w") as f:
+        json.dump({"camera_id": camera_id, "time": t, "predictions": predictions}, f)
+
+async def poll_camera(camera):
+    with metrics.timed("poll", camera.id):
+        try:
+            await detections.run(camera.id, lambda: process_event(camera, None, time.time()))
+        except Overloaded as e:
+            Log("INFO", "Poll of {} not run: {}", camera.name, e)
+
+async def triggered_since(camera_id, since):
+    t = await last_trigger.run(last_trigger.last, camera_id)
+    return t is not None and t >= since
+
+# Optional built-in polling of the cameras, next to the webhook
+poller = Scheduler(camera_index, poll_camera, triggered_since)
+
+# Log in to Surveillance Station and connect to DeepStack as soon as a worker starts,
+# in the background, instead of on the first event (on by default)
+warm_up_enabled = settings.get("warmUp", True)
+# Set once the worker has started, for /readyz; upstream -> warm-up state
+ready = False
+upstreams = {}
+
+async def warm_up():
+    async def sss():
+        upstreams["sss"] = "pending"
+        try:
+            await sss_session.login(sss_session.generation)
+            upstreams["sss"] = "ok"
+        except Exception as e:
+            upstreams["sss"] = "error: {}".format(e)
+            Log("ERROR", "Surveillance Station warm-up failed: {}", e)
 
-def save_last_trigger(last_trigger):
-    with open(last_trigger_fn, 'wb') as f:
-        pickle.dump(last_trigger, f)
+    async def deepstack_backends():
+        for url in (b.url for b in deepstack.backends):
+            upstreams[url] = "pending"
+        for url, ok in (await deepstack.warm()).items():
+            upstreams[url] = "ok" if ok else "unreachable"
 
-def load_last_trigger():
-    if os.path.exists(last_trigger_fn):
-        with open(last_trigger_fn, 'rb') as f:
-            return pickle.load(f)
-    else:
-        return {}
-        
-def Log(level, entry):
-    if level == "DEBUG":
-        logging.debug(entry)
-    elif level == "ERROR":
-        logging.error(entry)
-    else:
-        logging.info(entry)
-        
-def contains(rOutside, rInside):
-    return rOutside["x_min"] < rInside["x_min"] < rInside["x_max"] < rOutside["x_max"] and \
-        rOutside["y_min"] < rInside["y_min"] < rInside["y_max"] < rOutside["y_max"]
-
-def IsInsidePolygons(points:list, p:tuple, label, confidence) -> bool:
-    i = 0
-    count = len(points)
-    if count == 0: 
-        return True
-    else:
-        Log("DEBUG","We have at least {} ignore polygon(s) to check, if {} is not in any of these zones then trigger will be initiated.".format(len(points),label))
-        hit = []
-        for polygon in points:
-            i=i+1
-            Log("DEBUG","{}. Checking polygon {}...".format(i,polygon))
-            if not IsInsidePolygon(polygon, p, label):
-                hit = polygon
-            else:
-                Log("DEBUG","'{}' ({}%) with center @ {} is within ignore polygon {}".format(label,confidence,p,polygon))
-                return True
-        Log("DEBUG","'{}' ({}%) with center @ {} is not within ignore polygon {}".format(label,confidence,p,polygon))
-        return False
+    s = time.perf_counter()
+    await asyncio.gather(sss(), deepstack_backends())
+    Log("INFO", "Warm-up done in {:.2f}s: {}", time.perf_counter() - s, upstreams)
+
+@app.on_event("startup")
+async def startup():
+    global ready
+    poller.start()
+    capture_store.start(asyncio.get_event_loop())
+    if warm_up_enabled:
+        asyncio.ensure_future(warm_up())
+    ready = True
+
+@app.on_event("shutdown")
+async def shutdown():
+    await poller.stop()
+    capture_store.stop()
+    email_alerts.close()
+    await notifications.stop()
+    await recordings.stop()
+    close_connections()
+    render.shutdown()
+    await deepstack.close()
+    await httpclient.close()
         
-# If you would like to ignore objects outside the ignore area instead of inside, set this to contains(rect, ignore_area):
-def IsInsideAreas(rect, ignore_areas, label, confidence):
-    i = 0
-    count = len(ignore_areas)
-    if count == 0: 
-        return True
-    else:
-        hit = []
-        Log("DEBUG","We have at least {} ignore areas(s) to check, if {} is not in any of these zones then trigger will be initiated.".format(count,label))
-        for ignore_area in ignore_areas:
-            i+=1
-            Log("DEBUG","{}. Checking area {}...".format(i,ignore_area))
-            if not contains(ignore_area, rect):
-                hit = ignore_area
-            else:
-                Log("DEBUG","'{}' ({}%) matching {} is within ignore area {}".format(label,confidence,rect,ignore_area))
-                return True
-        Log("DEBUG","'{}' ({}%) matching {} is NOT within ignore area {}".format(label,confidence,rect,ignore_area))
-        return False
-
-def CheckZones(prediction, ignore_areas, label, confidence, points, p)-> bool:
-    if not IsInsideAreas(prediction, ignore_areas, label, confidence):
-        return True
-    elif not IsInsidePolygons(points = points, p = p, label = label, confidence = confidence):
-        return True
-    return False
-    
+# Registered before /{camera_id} so they are not taken for a camera
+@app.get("/healthz")
+async def read_health():
+    return {"status": "ok", "pid": os.getpid()}
+
+@app.get("/readyz")
+async def read_ready():
+    """200 once the worker serves events; the upstreams only report their warm-up, they may still be connecting."""
+    body = {"ready": ready, "cameras": len(camera_index.cameras), "upstreams": upstreams}
+    return JSONResponse(body, status_code=200 if ready else 503)
+
+@app.get("/batch")
+async def read_batch(cameras: Optional[str] = None, group: Optional[str] = None, debug: Optional[str] = None,
+                     sse: bool = False):
+    """Handle an event on several cameras at once, streaming one JSON result per camera as each completes.
+
+    cameras is a comma separated list of camera ids, group the name of a group in
+    cameras.json (cameras list the groups they belong to in "groups"); both may be
+    given.  Every camera goes through the same path as /{camera_id}.
+    """
+    start = time.time()
+    log.bind(camera="batch", request=log.new_request_id())
+    camera_ids = [c for c in (cameras or "").split(",") if c]
+    if group is not None:
+        members = camera_index.group(group, start)
+        if not members:
+            return JSONResponse({"error": "Unknown camera group {}".format(group)}, status_code=404)
+        camera_ids += members
+    camera_ids = list(dict.fromkeys(camera_ids))
+    if not camera_ids:
+        return JSONResponse({"error": "Pass cameras=<id>,<id> or group=<name>"}, status_code=400)
+    Log("INFO", "Batch event for {} camera(s): {}", len(camera_ids), ",".join(camera_ids))
+
+    async def one(camera_id):
+        log.bind(camera=camera_id, request=log.new_request_id())
+        result = {"camera_id": camera_id}
+        camera = camera_index.get(camera_id)
+        if camera is None:
+            Log("ERROR", "Unknown camera_id={}", camera_id)
+            result["error"] = "Unknown camera {}".format(camera_id)
+            return result
+        result["name"] = camera.name
+        try:
+            result["result"] = await run_event(camera, debug, start)
+            result["triggered"] = await triggered_since(camera.id, start)
+        except Overloaded as e:
+            Log("INFO", "{}", e)
+            result["error"] = str(e)
+            result["status"] = e.status
+        except Exception as e:
+            Log("ERROR", "Batch event on camera {} failed: {}", camera_id, e)
+            result["error"] = str(e)
+        result["seconds"] = round(time.time() - start, 3)
+        return result
+
+    # Started here rather than in the stream, so the events run even if the client goes away.
+    # Snapshots are fetched concurrently; detections queue for the shared admission slots.
+    tasks = [asyncio.ensure_future(one(camera_id)) for camera_id in camera_ids]
+
+    async def stream():
+        for task in asyncio.as_completed(tasks):
+            line = json.dumps(await task)
+            yield "data: {}\n\n".format(line) if sse else line + "\n"
+    return StreamingResponse(stream(), media_type="text/event-stream" if sse else "application/x-ndjson")
+
+@app.get("/metrics")
+async def read_metrics():
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE_LATEST)
+
+@app.get("/events")
+async def read_events(camera: Optional[str] = None, label: Optional[str] = None, since: Optional[float] = None,
+                      until: Optional[float] = None, before: Optional[int] = None, limit: int = 50):
+    """Saved captures, newest first; pass the returned "next" as before for the next page."""
+    return await capture_store.run(capture_store.events, camera, label, since, until, before, max(1, min(limit, 500)))
+
+@app.get("/events/{event_id}")
+async def read_event_image(event_id: int):
+    fn = await capture_store.run(capture_store.file, event_id)
+    if fn is None or not os.path.exists(fn):
+        return JSONResponse({"error": "Unknown event {}".format(event_id)}, status_code=404)
+    return FileResponse(fn, media_type="image/jpeg")
+
 @app.get("/{camera_id}")
 async def read_item(camera_id, debug: Optional[str] = None):
     start = time.time()
-    cameraname = cameradata["{}".format(camera_id)]["name"]
-    Log("INFO","***Call started for {} (camera_id={} and debug={})".format(cameraname,camera_id,debug))
+    log.bind(camera=camera_id, request=log.new_request_id())
+    camera = camera_index.get(camera_id, start)
+    if camera is None:
+        Log("ERROR","Unknown camera_id={}", camera_id)
+        return ("Unknown camera {}".format(camera_id))
+    try:
+        return await run_event(camera, debug, start)
+    except Overloaded as e:
+        Log("INFO", "{}", e)
+        return JSONResponse({"error": str(e)}, status_code=e.status, headers={"Retry-After": "5"})
+
+async def run_event(camera, debug, start):
+    """Handle an event of the camera like /{camera_id}; raises Overloaded when the detection is refused."""
+    metrics.in_flight.inc()
+    try:
+        with metrics.timed("request", camera.id):
+            # Manual test triggers always run on their own
+            if str(debug) == "99":
+                return await process_event(camera, debug, start)
+            return await detections.run(camera.id, lambda: process_event(camera, debug, start))
+    finally:
+        metrics.in_flight.dec()
+
+async def process_event(camera, debug, start):
+    camera_id = camera.id
+    cameraname = camera.name
+    Log("INFO","***Call started for {} (camera_id={} and debug={})", cameraname, camera_id, debug)
     predictions = None
-    last_trigger = load_last_trigger()
 
     # Check we are outside the trigger interval for this camera
-    if camera_id in last_trigger:
-        t = last_trigger[camera_id]
-        Log("INFO","Found last camera time for {} was {}".format(camera_id,t))
+    t = await last_trigger.run(last_trigger.last, camera_id)
+    if t is not None:
+        Log("INFO","Found last camera time for {} was {}", camera_id, t)
         if (start - t) < trigger_interval:
             msg = "Skipping detection on camera {} since it was only triggered {}s ago".format(camera_id,(start-t))
             Log("INFO",msg)
+            metrics.events.labels(camera_id, "skipped_interval").inc()
             return (msg)
         else:
-            Log("INFO","Processing event on camera (last trigger was {}s ago)".format(start-t))
+            Log("INFO","Processing event on camera (last trigger was {}s ago)", start-t)
     else:
-        Log("INFO","No last camera time for {}".format(camera_id))
-
-    url = settings["SSSGetSnapshotURL"].format(SSSUrl, camera_id)
-    triggerurl = cameradata["{}".format(camera_id)]["triggerUrl"]
-    if "homekitAccId" in cameradata["{}".format(camera_id)]:
-        homekit_acc_id = cameradata["{}".format(camera_id)]["homekitAccId"]
-
-    response = requests.request("GET", url, cookies=load_cookies("cookie"))
-    Log("DEBUG",'Requested snapshot: ' + url)
-    if response.status_code == 200:
-        with open("/tmp/{}.jpg".format(camera_id), "wb") as f:
-            f.write(response.content)
-            Log("DEBUG","Snapshot downloaded")
-
-    snapshot_file = "/tmp/{}.jpg".format(camera_id)
-    image_data = open(snapshot_file, "rb").read()
-    Log("INFO","Requesting detection from DeepStack...")
-    s = time.perf_counter()
-    response = requests.post("{}/v1/vision/detection".format(deepstackUrl), files={"image": image_data}, timeout=timeout).json()
+        Log("INFO","No last camera time for {}", camera_id)
 
-    e = time.perf_counter()
-    Log("DEBUG","Got result: {}. Time: {}s".format(json.dumps(response, indent=2), e-s))
-    if not response["success"]:
-        return ("Error calling Deepstack: " + response["error"])
+    triggerurl = camera.trigger_url
+    homekit_acc_id = camera.homekit_acc_id
 
-    labels = ""
-    predictions = response["predictions"]
-    for object in predictions:
-        label = object["label"]
-        if label != 'person':
-            labels = labels + label + " "
+    try:
+        with metrics.timed("snapshot", camera_id):
+            snapshot = await sss_session.get_snapshot(camera_id)
+    except Exception as e:
+        Log("ERROR","Error getting snapshot: {}", e)
+        metrics.errors.labels("snapshot").inc()
+        metrics.events.labels(camera_id, "error").inc()
+        return ("Error getting snapshot from Surveillance Station: {}".format(e))
+    Log("DEBUG","Snapshot downloaded ({} bytes)", len(snapshot))
+    if snapshot_dump_dir is not None:
+        with open("{}/{}.jpg".format(snapshot_dump_dir, camera_id), "wb") as f:
+            f.write(snapshot)
+
+    # Skip inference when the scene has not changed since the last snapshot
+    gate = motiongate.options(camera)
+    gate_frame = None
+    if gate is not None and str(debug) != "99":
+        gate_time = time.time()
+        with metrics.timed("motion_gate", camera_id):
+            gate_frame = await asyncio.get_event_loop().run_in_executor(None, log.wrap(motiongate.check), camera, snapshot, gate_time, gate)
+        if gate_frame is None:
+            metrics.events.labels(camera_id, "skipped_motion").inc()
+            Log("INFO","***Call completed for {} (camera_id={} and debug={})", cameraname, camera_id, debug)
+            return ("{} not triggered - no change since the last snapshot".format(cameraname))
+
+    # Reuse the predictions of a near identical snapshot of this camera
+    cache = detectcache.options(camera)
+    if str(debug) == "99":
+        cache = None
+
+    async def evaluate(index, frame):
+        # Only the event's own snapshot may reuse a result: the later frames of a burst
+        # are taken to look again, and would otherwise hit the entry of the first one
+        result = await detect_frame(camera, index, frame, start, cache if index == 0 else None, str(debug) != "99")
+        # The gate compares later snapshots with this one only now that it has been looked at
+        if index == 0 and gate_frame is not None and result.predictions is not None:
+            motiongate.commit(camera, gate_frame, gate_time)
+        return result
+
+    async def fetch():
+        with metrics.timed("snapshot", camera_id):
+            return await sss_session.get_snapshot(camera_id)
+
+    # Optionally take a few more snapshots, until one passes the rules
+    bursting = burst.options(camera)
+    if str(debug) == "99":
+        bursting = None
+    try:
+        if bursting is not None:
+            frame = await burst.run(camera, snapshot, fetch, evaluate, bursting)
+        else:
+            frame = await evaluate(0, snapshot)
+    except Overloaded:
+        metrics.events.labels(camera_id, "overloaded").inc()
+        raise
+    if frame.error is not None:
+        metrics.events.labels(camera_id, "error").inc()
+        return (frame.error)
+    snapshot, predictions, qualifying = frame.snapshot, frame.predictions, frame.qualifying
+    for reason, count in frame.skipped.items():
+        metrics.skipped_predictions.labels(camera_id, reason).inc(count)
 
-    i = 0
     found = False
     founditems = []
-    ignore_areas = []
-	
-    for prediction in response["predictions"]:
-        if found: break
-        i += 1
-        confidence = round(100 * prediction["confidence"])
-        label = prediction["label"]
-        sizex = int(prediction["x_max"])-int(prediction["x_min"])
-        sizey = int(prediction["y_max"])-int(prediction["y_min"])
-        p = [(int(prediction["x_max"])+int(prediction["x_min"])) / 2, int((int(prediction["y_min"]) + (int(prediction["y_max"]) - int(prediction["y_min"])) * (1 - polygon_deepstack_bottom_offset))) ]
-        Log("DEBUG","Suspected '{}' id={} found ({}%) size {}x{} with center @ {} on {}. Checking if '{}' is in ignore zones...".format(label,i,confidence,sizex,sizey, p, cameradata[camera_id]["name"],label))
-
-        if not label in [item.get("type") for item in list(cameradata[camera_id]["detect_objects"])]:
-            Log("DEBUG","Ignoring '{}' as it is not part of camera configuration detect object list.".format(label))
-            continue;
-
-        for detect_object in cameradata[camera_id]["detect_objects"]:
-            if not found and \
-                detect_object["type"] == label:
-                    min_sizex = detect_object["min_sizex"]
-                    min_sizey = detect_object["min_sizey"]
-                    min_confidence = detect_object["min_confidence"]
-                    ignore_areas = []
-                    if "ignore_areas" in detect_object:
-                        for ignore_area in detect_object["ignore_areas"]:
-                            ignore_areas.append({
-                                "y_min": int(ignore_area["y_min"]),
-                                "x_min": int(ignore_area["x_min"]),
-                                "y_max": int(ignore_area["y_max"]),
-                                "x_max": int(ignore_area["x_max"])
-                            })
-                    if not found and \
-                       sizex > min_sizex and \
-                       sizey > min_sizey and \
-                       confidence > min_confidence:
-
-                        Log("DEBUG","Minimum size and confidence haved passed for {} id={}...".format(label,i))
-                        found = CheckZones(prediction, ignore_areas, label, confidence, detect_object["ignore_polygons"], p)
-
-                        if found:
-                            founditems.append(label)
-                            payload = {}
-                            response = requests.request("GET", triggerurl, data=payload)
-                            end = time.time()
-                            runtime = round(end - start, 1)
-                            Log("INFO","{}% sure we found a {} - triggering {} - took {} seconds".format(confidence,label,cameraname,runtime))
-                            last_trigger[camera_id] = time.time()
-                            save_last_trigger(last_trigger)
-                            Log("DEBUG","Saving last camera time for {} as {}".format(camera_id,last_trigger[camera_id]))
-                            if homebridgeWebhookUrl is not None and homekit_acc_id is not None:
-                                hb = requests.get("{}/?accessoryId={}&state=true".format(homebridgeWebhookUrl,homekitAccId))
-                                Log("DEBUG","Sent message to homebridge webhook: {}".format(hb.status_code))
-                            else:
-                                Log("DEBUG","Skipping HomeBridge Webhook since no webhookUrl or accessory Id")
-                        else:
-                            Log("DEBUG","Ignoring '{}' id={} as it was in an ignore zone.".format(label,i))
-                            
-                    else:
-                        Log("DEBUG","Ignoring '{}' id={} as it did not meet minimum size or confidence setting.".format(label,i))
+    p = None
+
+    # Don't trigger again for objects that have been standing still for a while
+    stationary = tracker.options(camera)
+    if qualifying and stationary is not None:
+        qualifying = await tracker.update(camera, qualifying, time.time(), stationary)
+        if not qualifying:
+            metrics.events.labels(camera_id, "suppressed_stationary").inc()
+    detection = qualifying[0] if qualifying else None
+
+    # Another worker may have triggered this camera while we were detecting
+    if detection is not None and not await last_trigger.run(last_trigger.claim, camera_id, time.time(), trigger_interval):
+        Log("INFO","Skipping trigger on camera {} since another request triggered it during detection", camera_id)
+        metrics.events.labels(camera_id, "skipped_interval").inc()
+        detection = None
+
+    if detection is not None:
+        found = True
+        label = detection.label
+        confidence = detection.confidence
+        p = detection.point
+        founditems.append(label)
+        try:
+            with metrics.timed("trigger", camera_id):
+                response = await httpclient.get("trigger", triggerurl)
+        except Exception:
+            metrics.errors.labels("trigger").inc()
+            raise
+        end = time.time()
+        runtime = round(end - start, 1)
+        Log("INFO","{}% sure we found a {} - triggering {} - took {} seconds", confidence, label, cameraname, runtime)
+        if homebridgeWebhookUrl is not None and homekit_acc_id is not None:
+            notifications.submit("homebridge", notify_homebridge, homekit_acc_id, blocking=False, camera=camera_id)
+        else:
+            Log("DEBUG","Skipping HomeBridge Webhook since no webhookUrl or accessory Id")
 
     end = time.time()
     runtime = round(end - start, 1)
     start = time.time()
-    fn = "{}/{}-{}.jpg".format(capture_dir,cameraname,start)
+    capture_name = cameraname
     
     #test assistance, force found
     if str(debug) == "99":
         founditems = ['Test Request']
         found=True
-        fn = "{}/{}-{}.jpg".format(capture_dir,"TestOnly",start)
-        Log("INFO","Debug Mode On = {} - This trigger was manually invoked".format(debug))
+        capture_name = "TestOnly"
+        Log("INFO","Debug Mode On = {} - This trigger was manually invoked", debug)
 
-    founditems = ' '.join(map(str, founditems))
-    ignore_polygons_list = [item.get("ignore_polygons") for item in list(cameradata[camera_id]["detect_objects"])]
+    labels = [str(label) for label in founditems]
+    founditems = ' '.join(labels)
 
     if found:
-        try:
-           send_email(cameraname, founditems, snapshot_file, fn)
-           save_image(predictions, cameraname, snapshot_file, ignore_areas, ignore_polygons_list, fn, p)
-           Log("INFO","***Call completed for {} (camera_id={} image_name={} and debug={})".format(cameraname,camera_id,fn,debug))
-           return ("Triggering camera because {} was found - took {} seconds".format(founditems,runtime))
-        except Exception as e:
-           Log("ERROR","Error: {}".format(e))
-           Log("INFO","***Call completed for {} (camera_id={} and debug={})".format(cameraname,camera_id,debug))
-           return (e)
+        fn = capture_store.path(capture_name, start)
+        email_alerts.add((cameraname, founditems, snapshot, fn))
+        notifications.submit("capture", save_capture, camera, snapshot, predictions, fn, p, start, labels,
+                             [d.prediction for d in qualifying], blocking=False, camera=camera_id)
+        metrics.events.labels(camera_id, "triggered").inc()
+        Log("INFO","***Call completed for {} (camera_id={} image_name={} and debug={})", cameraname, camera_id, fn, debug)
+        return ("Triggering camera because {} was found - took {} seconds".format(founditems,runtime))
     else:
     	#Uncomment below to debug issues when notifications are not being sent
-        #fn = "{}/{}-{}.jpg".format(capture_dir,"NOTHING_{}".format(cameraname),start)
-        #save_image(predictions, cameraname, snapshot_file, ignore_areas, ignore_polygons_list, fn, p)
-        Log("INFO","{} not triggered - nothing found - took {} seconds".format(cameraname,runtime))
-        Log("INFO","***Call completed for {} (camera_id={} and debug={})".format(cameraname,camera_id,debug))
+        #fn = capture_store.path("NOTHING_{}".format(cameraname), start)
+        #notifications.submit("capture", save_capture, camera, snapshot, predictions, fn, p, start, "", [], blocking=False)
+        metrics.events.labels(camera_id, "not_found").inc()
+        Log("INFO","{} not triggered - nothing found - took {} seconds", cameraname, runtime)
+        Log("INFO","***Call completed for {} (camera_id={} and debug={})", cameraname, camera_id, debug)
         return ("{} not triggered - nothing found".format(cameraname))
     
 
 
-def save_image(predictions, camera_name, snapshot_file, ignore_areas, ignore_polygons_list, fn, p):
-    try:	
-       start = time.time()
-       im = Image.open(snapshot_file)
-       draw = ImageDraw.Draw(im, "RGBA")
-       tint_color = (0, 0, 0)  # Black
-       transparency = .25  # Degree of transparency, 0-100%
-       opacity = int(255 * transparency)
-   
-       for ignore_area in ignore_areas:
-           draw.rectangle((ignore_area["x_min"], ignore_area["y_min"],
-                           ignore_area["x_max"], ignore_area["y_max"]), outline=(255, 66, 66), fill=(255, 66, 66, 127))
-           draw.text((ignore_area["x_min"]+10, ignore_area["y_min"]+10), "ignore area", fill=(255, 66, 66, 255))
-
-       for ignore_polygons in ignore_polygons_list:
-           for ignore_polygon in ignore_polygons:
-               poly_tuple = list(map(tuple,ignore_polygon))
-               draw.polygon(poly_tuple, fill=(255, 66, 66, 127), outline=(255, 66, 66))
-               draw.text([(ignore_polygon[0][0]+10, ignore_polygon[0][1]+10)], "ignore polygon", fill=(255, 255, 255, 255))
-
-       for object in predictions:
-           confidence = round(100 * object["confidence"])
-           label = "{} ({}%)".format(object['label'], confidence)
-           draw.rectangle((object["x_min"], object["y_min"], object["x_max"], object["y_max"]), outline=(255, 230, 66), width=2)
-           draw.text((object["x_min"]+10, object["y_min"]+10), label, fill=(255, 230, 66, 255))
-       
-       #Draw a circle where detection was found.    
-       X, Y = p
-       r = 9
-       draw.ellipse([(X-r, Y-r), (X+r, Y+r)], fill=(0, 255, 0, 127), outline=(0, 255, 0))
-         
-       im.save(fn, quality=100)
-       im.close()
-       end = time.time()
-       runtime = round(end - start, 1)
-       Log("DEBUG","Saved captured and annotated image: {} in {} seconds.".format(fn,runtime))
-    except Exception as e:
-       Log("ERROR","Error: {}".format(e))
-       
-    
-def send_email(camera_name, founditems, filename, captured_image):
-	# Add body to email
-	subject = "Alert: A {} was found on {}".format(founditems, camera_name)
+async def save_capture(camera, snapshot, predictions, fn, p, t, labels, detections):
+    await render.render_async(camera.id, snapshot, predictions, camera.ignore_areas, camera.ignore_polygons, fn, p)
+    await capture_store.run(capture_store.record, camera.id, camera.name, t, labels, detections, fn)
 
+async def notify_homebridge(homekit_acc_id):
+    hb = await httpclient.get("homebridge", "{}/?accessoryId={}&state=true".format(homebridgeWebhookUrl,homekit_acc_id))
+    Log("DEBUG","Sent message to homebridge webhook: {}", hb.status_code)
+    hb.raise_for_status()
+
+# Runs on the notification queue, errors are logged and retried there.
+# alerts is a list of (camera_name, founditems, snapshot, captured_image), sent as one email
+def send_email(alerts):
+	# Add body to email
+	if len(alerts) == 1:
+		camera_name, founditems, snapshot, captured_image = alerts[0]
+		subject = "Alert: A {} was found on {}".format(founditems, camera_name)
+	else:
+		subject = "Alert: {} found on {} ({} alerts)".format(
+			", ".join(sorted(set(a[1] for a in alerts))), ", ".join(sorted(set(a[0] for a in alerts))), len(alerts))
+
+	if len(alerts) == 1:
+		captured_images = captured_image
+	else:
+		captured_images = "".join("<br/>{}: {}".format(a[0], a[3]) for a in alerts)
 	html = """\
 	<html>
 	  <body>
@@ -347,9 +570,7 @@ def send_email(camera_name, founditems, filename, captured_image):
 	    </p>
 	  </body>
 	</html>
-	""".format(captured_image)
+	""".format(captured_images)
 
-	try:		 
-		sendmail(EmailSenderAddress, EmailReceiverAddress, EmailSmtpHost, EmailSmtpPort, EmailPassword, subject, html, filename)
-	except Exception as e:
-		Log("ERROR","Error: {}".format(e))
+	attachments = [(os.path.basename(captured_image), snapshot) for _, _, snapshot, captured_image in alerts]
+	sendmail(EmailSenderAddress, EmailReceiverAddress, EmailSmtpHost, EmailSmtpPort, EmailPassword, subject, html, None, attachments=attachments)
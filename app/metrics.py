@@ -0,0 +1,53 @@
+from contextlib import contextmanager
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client import multiprocess
+
+import os
+import time
+
+# Prometheus metrics.  When PROMETHEUS_MULTIPROC_DIR is set (run.py does this) every
+# gunicorn worker writes its samples there and /metrics aggregates all workers.
+
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 180)
+
+stage_seconds = Histogram("sssai_stage_seconds", "Time spent in each stage of a camera event",
+                          ["stage", "camera"], buckets=BUCKETS)
+events = Counter("sssai_events_total", "Camera events by outcome", ["camera", "outcome"])
+skipped_predictions = Counter("sssai_skipped_predictions_total",
+                              "DeepStack predictions that did not trigger, by reason", ["camera", "reason"])
+errors = Counter("sssai_errors_total", "Errors by stage", ["stage"])
+retries = Counter("sssai_retries_total", "Retries by stage", ["stage"])
+detection_cache = Counter("sssai_detection_cache_total", "Detection cache lookups by result", ["camera", "result"])
+burst_frames = Counter("sssai_burst_frames_total", "Snapshots of burst events by outcome", ["camera", "outcome"])
+in_flight = Gauge("sssai_requests_in_flight", "Camera requests being processed", multiprocess_mode="livesum")
+log_dropped = Counter("sssai_log_dropped_total", "Log records dropped because the log queue was full")
+deepstack_hedges = Counter("sssai_deepstack_hedges_total", "Slow DeepStack requests also sent to a second backend")
+deepstack_hedge_wins = Counter("sssai_deepstack_hedge_wins_total", "Hedged DeepStack requests answered by the second backend")
+deepstack_ejected = Gauge("sssai_deepstack_backend_ejected", "1 while the circuit breaker keeps a DeepStack backend out",
+                          ["backend"], multiprocess_mode="livemax")
+queue_depth = Gauge("sssai_notification_queue_depth", "Jobs waiting on the notification queue",
+                    multiprocess_mode="livesum")
+
+def multiprocess_dir():
+    return os.environ.get("PROMETHEUS_MULTIPROC_DIR") or os.environ.get("prometheus_multiproc_dir")
+
+@contextmanager
+def timed(stage, camera=""):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.labels(stage, camera).observe(time.perf_counter() - start)
+
+def render() -> bytes:
+    if multiprocess_dir():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
+
+def mark_process_dead(pid):
+    """Called by gunicorn when a worker exits, drops its live gauges."""
+    if multiprocess_dir():
+        multiprocess.mark_process_dead(pid)
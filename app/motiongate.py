@@ -0,0 +1,108 @@
+from PIL import Image
+
+import io
+import threading
+
+import numpy as np
+
+import preprocess
+from camerarules import camera_options, setting_options
+from log import Log
+
+# Cheap frame difference gate in front of DeepStack.  Each snapshot is decoded at
+# low resolution to grayscale and compared with the last one of the same camera
+# that went through detection; when the fraction of changed pixels is below the
+# threshold the scene is considered unchanged and inference is skipped.  A snapshot
+# only becomes the reference once its detection succeeded (commit()), so a scene
+# whose detection failed is looked at again on the next event.  Pixels where no
+# rule of the camera could ever trigger (inside the ignore zones) can be left out.
+#
+# Enabled with the "motionGate" setting, or per camera with a "motionGate" entry in
+# cameras.json (true/false, or an object overriding the options below).
+
+DEFAULTS = {
+    # Longest side of the frames compared, in pixels
+    "size": 160,
+    # Difference in gray level (0-255) for a pixel to count as changed
+    "pixelThreshold": 25,
+    # Fraction of changed pixels needed to run inference
+    "threshold": 0.005,
+    # Only compare pixels outside the camera's ignore zones
+    "maskIgnored": True,
+    # Always run inference when the reference frame is older than this (seconds)
+    "maxAge": 300,
+}
+
+global_options = None
+
+class _CameraState:
+    __slots__ = ("frame", "mask", "camera", "taken", "checked", "skipped")
+
+    def __init__(self):
+        self.frame = None
+        self.mask = None
+        self.camera = None
+        self.taken = 0.0
+        self.checked = 0
+        self.skipped = 0
+
+_states = {}
+_lock = threading.Lock()
+
+def configure(settings):
+    global global_options
+    global_options = setting_options(settings.get("motionGate"), DEFAULTS)
+
+def options(camera):
+    return camera_options(camera, "motionGate", global_options, DEFAULTS)
+
+def _state(camera_id) -> _CameraState:
+    with _lock:
+        state = _states.get(camera_id)
+        if state is None:
+            state = _states[camera_id] = _CameraState()
+        return state
+
+def _small_gray(snapshot, size):
+    im = Image.open(io.BytesIO(snapshot))
+    full_size = im.size
+    scale = float(size) / max(full_size)
+    if im.format == "JPEG":
+        im.draft("L", (int(full_size[0] * scale), int(full_size[1] * scale)))
+    im = im.convert("L").resize((max(1, int(full_size[0] * scale)), max(1, int(full_size[1] * scale))), Image.BILINEAR)
+    return np.asarray(im, dtype=np.int16), full_size
+
+def check(camera, snapshot, now, opts):
+    """The snapshot at gate resolution when it differs enough from the camera's reference to run
+    inference, None to skip it.  Pass it to commit() once its detection succeeded."""
+    frame, full_size = _small_gray(snapshot, opts["size"])
+    state = _state(camera.id)
+    previous, taken = state.frame, state.taken
+    state.checked += 1
+
+    if previous is None or previous.shape != frame.shape or now - taken > opts["maxAge"]:
+        return frame
+
+    changed = np.abs(frame - previous) > opts["pixelThreshold"]
+    if opts["maskIgnored"]:
+        if state.camera is not camera or state.mask is None or state.mask.shape != frame.shape:
+            mask = Image.fromarray(preprocess.possible_mask(camera, full_size).astype(np.uint8) * 255)
+            state.mask = np.asarray(mask.resize((frame.shape[1], frame.shape[0]), Image.NEAREST)) > 0
+            state.camera = camera
+        considered = int(state.mask.sum())
+        fraction = float((changed & state.mask).sum()) / considered if considered else 0.0
+    else:
+        fraction = float(changed.mean())
+
+    if fraction >= opts["threshold"]:
+        Log("DEBUG", "Motion gate: {:.2%} of {} changed, running inference", fraction, camera.name)
+        return frame
+    state.skipped += 1
+    Log("INFO", "Motion gate: only {:.2%} of {} changed, skipping inference (gate hit rate {}/{} = {:.0%})",
+        fraction, camera.name, state.skipped, state.checked, float(state.skipped) / state.checked)
+    return None
+
+def commit(camera, frame, now):
+    """Compare the camera's next snapshots with frame (from check()), taken at now and detected."""
+    state = _state(camera.id)
+    state.frame, state.taken = frame, now
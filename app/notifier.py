@@ -0,0 +1,95 @@
+import asyncio
+import time
+
+import log
+import metrics
+from log import Log
+
+# Bounded in-process job queue for the side effects of a detection (annotated
+# capture, email, Homebridge), so the webhook can answer as soon as the camera is
+# triggered.  Jobs are served by a small pool of asyncio workers; blocking jobs
+# (PIL, SMTP) run in the loop's thread pool.  Failed jobs are retried with
+# exponential backoff and the queue is drained on shutdown.  A queue of its own keeps
+# low value jobs (recordings for replay) from crowding out the notifications.
+
+class NotificationQueue:
+
+    def __init__(self, workers=2, maxsize=100, retries=3, backoff=1.0, name="notification", gauge=metrics.queue_depth):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.retries = retries
+        self.backoff = backoff
+        # For the log, and the depth gauge to keep up to date (None for none)
+        self.name = name
+        self.gauge = gauge
+        self._queue = None
+        self._tasks = []
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(self.maxsize)
+        self._tasks = [asyncio.ensure_future(self._worker(i)) for i in range(self.workers)]
+
+    def submit(self, name, fn, *args, blocking=True, camera="") -> bool:
+        """Queue fn(*args); blocking functions run in a thread, otherwise fn must be a coroutine function."""
+        self.start()
+        try:
+            self._queue.put_nowait((name, fn, args, blocking, time.time(), camera, log.request_id.get()))
+        except asyncio.QueueFull:
+            metrics.errors.labels(name).inc()
+            Log("ERROR", "{} queue full ({} jobs), dropping {}", self.name.capitalize(), self.maxsize, name)
+            return False
+        if self.gauge is not None:
+            self.gauge.inc()
+        Log("DEBUG", "Queued {} {} (queue depth {})", self.name, name, self.depth)
+        return True
+
+    async def _worker(self, n):
+        loop = asyncio.get_event_loop()
+        while True:
+            name, fn, args, blocking, queued, camera, request = await self._queue.get()
+            # Log the job under the request that queued it
+            log.bind(camera=camera or "-", request=request)
+            if self.gauge is not None:
+                self.gauge.dec()
+            try:
+                for attempt in range(self.retries + 1):
+                    try:
+                        with metrics.timed(name, camera):
+                            if blocking:
+                                await loop.run_in_executor(None, log.wrap(fn), *args)
+                            else:
+                                await fn(*args)
+                        Log("DEBUG", "{} {} done {:.2f}s after it was queued", self.name.capitalize(), name, time.time() - queued)
+                        break
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        if attempt == self.retries:
+                            metrics.errors.labels(name).inc()
+                            Log("ERROR", "{} {} failed after {} attempts: {}", self.name.capitalize(), name, attempt + 1, e)
+                            break
+                        metrics.retries.labels(name).inc()
+                        delay = self.backoff * 2 ** attempt
+                        Log("INFO", "{} {} failed ({}), retrying in {}s", self.name.capitalize(), name, e, delay)
+                        await asyncio.sleep(delay)
+            finally:
+                self._queue.task_done()
+
+    async def stop(self, timeout=30):
+        """Wait up to timeout seconds for queued jobs to finish, then stop the workers."""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            Log("ERROR", "{} queue not drained after {}s, {} job(s) lost", self.name.capitalize(), timeout, self.depth)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -3,7 +3,7 @@
 # Refer https://www.geeksforgeeks.org/how-to-check-if-a-given-point-lies-inside-a-polygon/?ref=lbp
 # This code is contributed by Vikas Chitturi
 
-import logging
+from log import Log
 
 # Define Infinite (Using INT_MAX 
 # caused overflow problems)
@@ -84,7 +84,7 @@ def IsInsidePolygon(points:list, p:tuple, label) -> bool:
     # There must be at least 3 vertices
     # in polygon
     if n < 3:
-        Log("DEBUG","{} is not a Polygon, it must have at least 3 vertices.  Ignoring...".format(points))
+        Log("DEBUG","{} is not a Polygon, it must have at least 3 vertices.  Ignoring...", points)
         return False
          
     # Create a point for line segment
@@ -126,10 +126,3 @@ def IsInsidePolygon(points:list, p:tuple, label) -> bool:
     # Return true if count is odd, false otherwise
     return (count % 2 == 1)
 
-def Log(level, entry):
-    if level == "DEBUG":
-        logging.debug(entry)
-    elif level == "ERROR":
-        logging.error(entry)
-    else:
-        logging.info(entry)
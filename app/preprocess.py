@@ -0,0 +1,135 @@
+from collections import namedtuple
+from PIL import Image, ImageDraw
+
+import io
+
+import numpy as np
+
+from log import Log
+from zones import get_zones
+
+# Optional pre-processing of a snapshot before it is sent to DeepStack: crop it to a
+# region of interest and/or downscale it.  Prediction boxes are mapped back into the
+# coordinates of the original snapshot, so zones, thresholds and captures are not
+# affected.
+#
+# Per camera options in cameras.json:
+#   "roi": {"x_min":..,"y_min":..,"x_max":..,"y_max":..} to crop to a fixed rectangle,
+#          or "auto" to crop to the part of the frame where some rule can still trigger
+#   "roiMargin": pixels added around the region of interest (default 64)
+#   "inferenceMaxSize": longest side of the image sent to DeepStack (overrides the setting)
+
+# Offset of the crop and scale of the resize: original x = x / scale_x + x offset
+Transform = namedtuple("Transform", "x y scale_x scale_y")
+
+max_size = None
+min_object_pixels = 24
+quality = 90
+
+_masks = {}
+_rois = {}
+
+def configure(settings):
+    global max_size, min_object_pixels, quality
+    if "inferenceMaxSize" in settings:
+        max_size = settings["inferenceMaxSize"]
+    if "inferenceMinObjectPixels" in settings:
+        min_object_pixels = int(settings["inferenceMinObjectPixels"])
+    if "inferenceQuality" in settings:
+        quality = int(settings["inferenceQuality"])
+
+def needed(camera) -> bool:
+    return "roi" in camera.options or camera.options.get("inferenceMaxSize", max_size) is not None
+
+def possible_mask(camera, size) -> np.ndarray:
+    """(height, width) mask of the pixels where at least one rule of the camera could still trigger."""
+    cached = _masks.get(camera.id)
+    if cached is not None and cached[0] is camera and cached[1] == size:
+        return cached[2]
+    width, height = size
+    possible = np.zeros((height, width), dtype=bool)
+    for rule in camera.detect_objects:
+        zones = get_zones(rule)
+        # As in CheckZones: outside every ignore area, or anchored outside every ignore polygon
+        if zones.has_areas:
+            im = Image.new("1", size, 0)
+            draw = ImageDraw.Draw(im)
+            for area in rule.ignore_areas:
+                draw.rectangle(area, fill=1)
+            possible |= ~np.asarray(im, dtype=bool)
+        if zones.has_polygons:
+            if zones.polygons:
+                possible |= ~zones.mask(size)
+            else:
+                possible[:] = True
+    _masks[camera.id] = (camera, size, possible)
+    return possible
+
+def auto_roi(camera, size):
+    """Bounding box of possible_mask, None when no rule can ever trigger."""
+    cached = _rois.get(camera.id)
+    if cached is not None and cached[0] is camera and cached[1] == size:
+        return cached[2]
+    possible = possible_mask(camera, size)
+    rows = np.nonzero(possible.any(axis=1))[0]
+    cols = np.nonzero(possible.any(axis=0))[0]
+    roi = None
+    if len(cols):
+        roi = (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+    _rois[camera.id] = (camera, size, roi)
+    return roi
+
+def prepare(camera, snapshot):
+    """The image to send to DeepStack and the Transform back to snapshot coordinates (None if unchanged)."""
+    im = Image.open(io.BytesIO(snapshot))
+    width, height = im.size
+
+    box = (0, 0, width, height)
+    roi = camera.options.get("roi")
+    if roi == "auto":
+        box = auto_roi(camera, im.size) or box
+    elif roi is not None:
+        box = (int(roi["x_min"]), int(roi["y_min"]), int(roi["x_max"]), int(roi["y_max"]))
+    if roi is not None:
+        margin = int(camera.options.get("roiMargin", 64))
+        box = (max(0, box[0] - margin), max(0, box[1] - margin), min(width, box[2] + margin), min(height, box[3] + margin))
+
+    scale = 1.0
+    limit = camera.options.get("inferenceMaxSize", max_size)
+    if limit is not None:
+        scale = min(1.0, float(limit) / max(box[2] - box[0], box[3] - box[1]))
+        # Never shrink the smallest object the camera cares about below min_object_pixels
+        min_sizes = [min(r.min_sizex, r.min_sizey) for r in camera.detect_objects if min(r.min_sizex, r.min_sizey) > 0]
+        if min_sizes:
+            scale = min(1.0, max(scale, float(min_object_pixels) / min(min_sizes)))
+
+    if box == (0, 0, width, height) and scale == 1.0:
+        return snapshot, None
+
+    target = (max(1, int((box[2] - box[0]) * scale)), max(1, int((box[3] - box[1]) * scale)))
+    if scale < 1.0 and im.format == "JPEG":
+        # Let the JPEG decoder skip detail we are about to throw away
+        im.draft("RGB", (int(width * scale), int(height * scale)))
+    draft_scale = im.size[0] / float(width)
+    crop = tuple(int(round(v * draft_scale)) for v in box)
+    im = im.convert("RGB").crop(crop)
+    if im.size != target:
+        im = im.resize(target, Image.BILINEAR)
+    out = io.BytesIO()
+    im.save(out, "JPEG", quality=quality)
+    Log("DEBUG", "Sending {}x{} crop {} of {}x{} snapshot to DeepStack", target[0], target[1], box, width, height)
+    return out.getvalue(), Transform(box[0], box[1], target[0] / float(box[2] - box[0]), target[1] / float(box[3] - box[1]))
+
+def restore(predictions, transform):
+    """Map prediction boxes from the prepared image back into snapshot coordinates."""
+    if transform is None:
+        return predictions
+    restored = []
+    for prediction in predictions:
+        prediction = dict(prediction)
+        for key in ("x_min", "x_max"):
+            prediction[key] = int(round(prediction[key] / transform.scale_x + transform.x))
+        for key in ("y_min", "y_max"):
+            prediction[key] = int(round(prediction[key] / transform.scale_y + transform.y))
+        restored.append(prediction)
+    return restored
@@ -0,0 +1,107 @@
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw
+
+import asyncio
+import io
+import os
+import time
+
+from log import Log
+
+# Annotated capture renderer.  The ignore areas and polygons of a camera are static,
+# so they are drawn once into a transparent RGBA overlay which is cached per camera
+# and frame size; each event only composites the overlay and draws its detections.
+# The cache key includes the zones themselves, so editing cameras.json invalidates
+# it.  Rendering can run in a process pool to keep PIL work off the worker's GIL.
+
+quality = 90
+progressive = True
+# Longest side of the saved capture in pixels, None to keep the snapshot size
+max_size = None
+# Longest side of an extra "-thumb.jpg" capture, None for no thumbnail
+thumbnail_size = None
+processes = 0
+
+_overlays = {}
+_pool = None
+
+def configure(settings):
+    global quality, progressive, max_size, thumbnail_size, processes
+    if "captureQuality" in settings:
+        quality = int(settings["captureQuality"])
+    if "captureProgressive" in settings:
+        progressive = bool(settings["captureProgressive"])
+    if "captureMaxSize" in settings:
+        max_size = settings["captureMaxSize"]
+    if "captureThumbnailSize" in settings:
+        thumbnail_size = settings["captureThumbnailSize"]
+    if "renderProcesses" in settings:
+        processes = int(settings["renderProcesses"])
+
+def overlay(camera_id, ignore_areas, ignore_polygons, size) -> Image.Image:
+    key = (camera_id, size)
+    zones = (ignore_areas, ignore_polygons)
+    cached = _overlays.get(key)
+    if cached is not None and cached[0] == zones:
+        return cached[1]
+
+    layer = Image.new("RGBA", size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(layer)
+    for x_min, y_min, x_max, y_max in ignore_areas:
+        draw.rectangle((x_min, y_min, x_max, y_max), outline=(255, 66, 66), fill=(255, 66, 66, 127))
+        draw.text((x_min+10, y_min+10), "ignore area", fill=(255, 66, 66, 255))
+
+    for ignore_polygon in ignore_polygons:
+        if len(ignore_polygon) < 2:
+            continue
+        draw.polygon(list(ignore_polygon), fill=(255, 66, 66, 127), outline=(255, 66, 66))
+        draw.text((ignore_polygon[0][0]+10, ignore_polygon[0][1]+10), "ignore polygon", fill=(255, 255, 255, 255))
+
+    _overlays[key] = (zones, layer)
+    Log("DEBUG", "Rendered ignore zone overlay for camera {} at {}x{}", camera_id, *size)
+    return layer
+
+def render(camera_id, snapshot, predictions, ignore_areas, ignore_polygons, fn, p):
+    """Annotate snapshot with the camera's ignore zones and the predictions and save it as fn."""
+    start = time.time()
+    im = Image.open(io.BytesIO(snapshot)).convert("RGBA")
+    im.alpha_composite(overlay(camera_id, ignore_areas, ignore_polygons, im.size))
+    draw = ImageDraw.Draw(im)
+
+    for object in predictions:
+        confidence = round(100 * object["confidence"])
+        label = "{} ({}%)".format(object['label'], confidence)
+        draw.rectangle((object["x_min"], object["y_min"], object["x_max"], object["y_max"]), outline=(255, 230, 66), width=2)
+        draw.text((object["x_min"]+10, object["y_min"]+10), label, fill=(255, 230, 66, 255))
+
+    #Draw a circle where detection was found.
+    if p is not None:
+        X, Y = p
+        r = 9
+        draw.ellipse([(X-r, Y-r), (X+r, Y+r)], fill=(0, 255, 0, 127), outline=(0, 255, 0))
+
+    im = im.convert("RGB")
+    if max_size is not None:
+        im.thumbnail((max_size, max_size))
+    im.save(fn, "JPEG", quality=quality, progressive=progressive, optimize=progressive)
+    if thumbnail_size is not None:
+        im.thumbnail((thumbnail_size, thumbnail_size))
+        im.save("{}-thumb.jpg".format(os.path.splitext(fn)[0]), "JPEG", quality=quality)
+    im.close()
+    Log("DEBUG", "Saved captured and annotated image: {} in {} seconds.", fn, round(time.time() - start, 2))
+
+async def render_async(*args):
+    """render() in the render process pool, or in the loop's thread pool when renderProcesses is 0."""
+    global _pool
+    executor = None
+    if processes > 0:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(processes)
+        executor = _pool
+    await asyncio.get_event_loop().run_in_executor(executor, render, *args)
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+        _pool = None
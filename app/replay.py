@@ -0,0 +1,216 @@
+"""Replay recorded snapshots against the camera rules, to tune cameras.json offline.
+
+Every .jpg under SNAPSHOTS is checked with the same decision logic as a live event
+(zones.find_triggers: labels, min_sizex/min_sizey, min_confidence, ignore areas and
+ignore polygons).  Stationary object suppression depends on the order of events and
+is not replayed.  The DeepStack predictions come from the .json recorded next to
+the snapshot (see the replayRecordDir setting), or from --deepstack when there is
+none.  The camera is the "camera_id" of that .json, else the snapshot's directory
+name, else --camera.  The bottom offset and zone mask follow the settings.json next
+to --cameras (or --settings), as the live app does, unless given on the command
+line.  Frames are spread over a process pool and streamed back.
+
+Usage:
+    python app/replay.py /recordings --cameras /config/cameras.json
+    python app/replay.py /recordings --cameras cameras.json --compare cameras.new.json --annotate /tmp/diff
+    python app/replay.py /recordings --cameras cameras.json --jsonl > results.jsonl
+"""
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from camerarules import compile_cameras
+from zones import find_triggers
+
+# Set in each pool process by _init
+_configs = None
+_options = None
+
+def _load(filename):
+    with open(filename) as f:
+        return compile_cameras(json.load(f))
+
+def _init(filenames, options):
+    global _configs, _options
+    _configs = [_load(fn) for fn in filenames]
+    _options = options
+
+def discover(root):
+    """Every snapshot under root, in name order."""
+    frames = []
+    for directory, _, files in os.walk(root):
+        for name in files:
+            if name.lower().endswith((".jpg", ".jpeg")) and not name.endswith("-thumb.jpg"):
+                frames.append(os.path.join(directory, name))
+    return sorted(frames)
+
+def _predictions(fn, options):
+    """(camera_id, predictions) of a snapshot, predictions None when there is no way to get them."""
+    camera_id = options["camera"]
+    recorded = os.path.splitext(fn)[0] + ".json"
+    if os.path.exists(recorded):
+        with open(recorded) as f:
+            data = json.load(f)
+        if isinstance(data, list):
+            return camera_id or os.path.basename(os.path.dirname(fn)), data
+        return str(data.get("camera_id") or camera_id or os.path.basename(os.path.dirname(fn))), data.get("predictions", [])
+    camera_id = camera_id or os.path.basename(os.path.dirname(fn))
+    if options["deepstack"] is None:
+        return camera_id, None
+    import requests
+    with open(fn, "rb") as f:
+        response = requests.post("{}/v1/vision/detection".format(options["deepstack"].rstrip("/")),
+                                 files={"image": f}, timeout=60).json()
+    predictions = response.get("predictions", [])
+    if options["save_json"]:
+        with open(recorded, "w") as f:
+            json.dump({"camera_id": camera_id, "predictions": predictions}, f)
+    return camera_id, predictions
+
+def _triggered(decision) -> bool:
+    # A camera missing from a config never triggers
+    return bool(decision and decision["triggered"])
+
+def _decide(camera, predictions, frame_size, options):
+    if camera is None:
+        return None
+    skipped = collections.Counter()
+    detections = find_triggers(camera, predictions, options["offset"], frame_size, skipped)
+    return {"triggered": bool(detections),
+            "labels": [d.label for d in detections],
+            "point": list(detections[0].point) if detections else None,
+            "skipped": dict(skipped)}
+
+def replay_frame(fn):
+    """Result of one snapshot under every config (runs in a pool process)."""
+    camera_id, predictions = _predictions(fn, _options)
+    result = {"file": fn, "camera_id": camera_id}
+    if predictions is None:
+        result["error"] = "no recorded predictions"
+        return result
+    result["predictions"] = len(predictions)
+    frame_size = None
+    if _options["zone_mask"]:
+        with Image.open(fn) as im:
+            frame_size = im.size
+    result["decisions"] = [_decide(cameras.get(camera_id), predictions, frame_size, _options) for cameras in _configs]
+    changed = len(set(_triggered(d) for d in result["decisions"])) > 1
+    result["changed"] = changed
+    annotate = _options["annotate"]
+    if annotate and (changed if len(_configs) > 1 else _triggered(result["decisions"][0])):
+        _annotate(fn, camera_id, predictions, result, annotate)
+    return result
+
+def _annotate(fn, camera_id, predictions, result, directory):
+    import render
+    with open(fn, "rb") as f:
+        snapshot = f.read()
+    for i, (cameras, decision) in enumerate(zip(_configs, result["decisions"])):
+        camera = cameras.get(camera_id)
+        if camera is None:
+            continue
+        out = os.path.join(directory, camera_id, "{}-{}{}.jpg".format(
+            os.path.splitext(os.path.basename(fn))[0], "ab"[i] if len(_configs) > 1 else "",
+            "-triggered" if decision["triggered"] else ""))
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+        render.render(camera_id, snapshot, predictions, camera.ignore_areas, camera.ignore_polygons, out,
+                      decision["point"])
+
+class Summary:
+
+    def __init__(self, configs):
+        self.configs = configs
+        self.cameras = collections.defaultdict(lambda: {
+            "frames": 0, "triggered": [0] * configs, "suppressed": [0] * configs,
+            "skipped": [collections.Counter() for _ in range(configs)], "a_only": 0, "b_only": 0})
+        self.errors = collections.Counter()
+        self.frames = 0
+
+    def add(self, result):
+        self.frames += 1
+        if "error" in result:
+            self.errors[result["error"]] += 1
+            return
+        camera = self.cameras[result["camera_id"]]
+        camera["frames"] += 1
+        for i, decision in enumerate(result["decisions"]):
+            if decision is None:
+                continue
+            camera["triggered" if decision["triggered"] else "suppressed"][i] += 1
+            camera["skipped"][i].update(decision["skipped"])
+        if self.configs > 1 and result["changed"]:
+            a, b = (_triggered(d) for d in result["decisions"][:2])
+            camera["a_only" if a else "b_only"] += 1
+
+    def report(self, out, elapsed):
+        print("\n{} frame(s) in {:.1f}s ({:.0f}/s)".format(self.frames, elapsed, self.frames / max(elapsed, 1e-9)), file=out)
+        for error, count in self.errors.items():
+            print("  {} frame(s) skipped: {}".format(count, error), file=out)
+        header = "{:<12}{:>8}{:>11}{:>11}".format("camera", "frames", "triggered", "suppressed")
+        if self.configs > 1:
+            header += "{:>11}{:>11}{:>10}{:>10}".format("triggered'", "suppressed'", "only A", "only B")
+        print(header + "   why predictions did not trigger", file=out)
+        for camera_id, c in sorted(self.cameras.items()):
+            line = "{:<12}{:>8}{:>11}{:>11}".format(camera_id, c["frames"], c["triggered"][0], c["suppressed"][0])
+            if self.configs > 1:
+                line += "{:>11}{:>11}{:>10}{:>10}".format(c["triggered"][1], c["suppressed"][1], c["a_only"], c["b_only"])
+            reasons = ", ".join("{} {}".format(k, v) for k, v in c["skipped"][0].most_common())
+            print(line + "   " + reasons, file=out)
+
+def _settings(filename, required):
+    """settings.json as a dict; a missing one is only an error when it was asked for."""
+    if not required and not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__.split("\n\n", 1)[1])
+    parser.add_argument("snapshots", help="directory of recorded snapshots")
+    parser.add_argument("--cameras", default="/config/cameras.json", help="cameras.json to replay with (A)")
+    parser.add_argument("--compare", help="second cameras.json (B), to report the frames where the decision changes")
+    parser.add_argument("--settings", help="settings.json to take the defaults below from (default: next to --cameras)")
+    parser.add_argument("--offset", type=float, help="polygon_deepstack_bottom_offset (default: from settings, else 0.5)")
+    parser.add_argument("--zone-mask", action="store_const", const=True,
+                        help="test polygons with the bitmap mask, as zoneMask does (default: from settings)")
+    parser.add_argument("--no-zone-mask", dest="zone_mask", action="store_const", const=False)
+    parser.add_argument("--camera", help="camera id of snapshots that do not say")
+    parser.add_argument("--deepstack", help="DeepStack url for snapshots without recorded predictions")
+    parser.add_argument("--save-json", action="store_true", help="record the predictions fetched from --deepstack")
+    parser.add_argument("--annotate", help="write annotated images of triggering (or, with --compare, changed) frames here")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="pool size (default: one per CPU)")
+    parser.add_argument("--jsonl", action="store_true", help="stream one JSON result per frame to stdout")
+    args = parser.parse_args()
+
+    settings = _settings(args.settings or os.path.join(os.path.dirname(args.cameras), "settings.json"), args.settings)
+    if args.offset is None:
+        args.offset = float(settings.get("polygon_deepstack_bottom_offset", 0.5))
+    if args.zone_mask is None:
+        args.zone_mask = bool(settings.get("zoneMask", False))
+    frames = discover(args.snapshots)
+    configs = [args.cameras] + ([args.compare] if args.compare else [])
+    options = {"offset": args.offset, "zone_mask": args.zone_mask, "camera": args.camera, "deepstack": args.deepstack,
+               "save_json": args.save_json, "annotate": args.annotate}
+    summary = Summary(len(configs))
+    out = sys.stderr if args.jsonl else sys.stdout
+    start = time.time()
+    with ProcessPoolExecutor(max(1, args.processes), initializer=_init, initargs=(configs, options)) as pool:
+        for result in pool.map(replay_frame, frames, chunksize=max(1, min(256, len(frames) // (4 * max(1, args.processes)) or 1))):
+            summary.add(result)
+            if args.jsonl:
+                print(json.dumps(result), flush=True)
+            elif args.compare and result.get("changed"):
+                a, b = (_triggered(d) for d in result["decisions"][:2])
+                print("{}: {} -> {}".format(result["file"], "trigger" if a else "no trigger", "trigger" if b else "no trigger"))
+    summary.report(out, time.time() - start)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import asyncio
+import fcntl
+import os
+import random
+import time
+
+import log
+from camerarules import camera_options, setting_options
+from log import Log
+
+# Built-in polling of the cameras, for when the Surveillance Station action rules
+# miss or delay a motion event.  Every polled camera gets a snapshot and detection
+# on its own interval through the same path as the webhook (single-flight, trigger
+# interval, notifications), with at most `concurrency` polls in progress at once so
+# the DeepStack load stays predictable.  The interval adapts: it drops to
+# minInterval after a poll that triggered the camera, and grows by backoff after
+# every quiet one, up to maxInterval.
+#
+# Only one gunicorn worker polls: the workers compete for a lock file and the
+# others take over if that worker goes away.
+#
+# Enabled with the "poll" setting, or per camera with a "poll" entry in cameras.json
+# (true/false, or an object overriding the options below).
+
+DEFAULTS = {
+    # Seconds between polls of a camera to start with
+    "interval": 10,
+    # Interval after a poll that triggered the camera
+    "minInterval": 2,
+    # Longest interval for a camera where nothing happens
+    "maxInterval": 60,
+    # Growth of the interval after every poll that did not trigger
+    "backoff": 1.5,
+    # Random spread of every interval (fraction), so cameras do not poll in lockstep
+    "jitter": 0.1,
+}
+
+global_options = None
+# Polls in progress at once, over all cameras
+concurrency = 2
+lock_file = "/tmp/sssai_scheduler.lock"
+# Seconds between attempts of a standby worker to become the poller
+standby_interval = 5
+
+def configure(settings):
+    global global_options, concurrency, lock_file
+    global_options = setting_options(settings.get("poll"), DEFAULTS)
+    if "pollConcurrency" in settings:
+        concurrency = int(settings["pollConcurrency"])
+    if "pollLockFile" in settings:
+        lock_file = settings["pollLockFile"]
+
+def options(camera):
+    return camera_options(camera, "poll", global_options, DEFAULTS)
+
+class Scheduler:
+    """Polls the cameras of a CameraIndex with poll(camera); await triggered(camera_id, since) tells if a poll fired."""
+
+    def __init__(self, cameras, poll, triggered):
+        self.cameras = cameras
+        self.poll = poll
+        self.triggered = triggered
+        self.intervals = {}
+        self._tasks = {}
+        self._budget = None
+        self._lock_fd = None
+        self._supervisor = None
+
+    @property
+    def leader(self) -> bool:
+        return self._lock_fd is not None
+
+    def start(self):
+        if self._supervisor is None:
+            self._budget = asyncio.Semaphore(concurrency)
+            self._supervisor = asyncio.ensure_future(self._supervise())
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        if self._supervisor is not None:
+            tasks.append(self._supervisor)
+            self._supervisor = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+        self._release()
+
+    def _acquire(self) -> bool:
+        fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        Log("INFO", "Polling scheduler active in worker {}", os.getpid())
+        return True
+
+    def _release(self):
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    async def _supervise(self):
+        while True:
+            self.cameras.refresh(time.time())
+            wanted = {camera_id: camera for camera_id, camera in self.cameras.cameras.items() if options(camera)}
+            if wanted and (self.leader or self._acquire()):
+                for camera_id in wanted:
+                    if camera_id not in self._tasks:
+                        self._tasks[camera_id] = asyncio.ensure_future(self._poll_camera(camera_id))
+            for camera_id in [c for c in self._tasks if c not in wanted]:
+                self._tasks.pop(camera_id).cancel()
+                self.intervals.pop(camera_id, None)
+            await asyncio.sleep(1 if self.leader or not wanted else standby_interval)
+
+    async def _poll_camera(self, camera_id):
+        opts = options(self.cameras.get(camera_id))
+        interval = opts["interval"]
+        # Spread the first polls over one interval
+        await asyncio.sleep(random.uniform(0, interval))
+        while True:
+            camera = self.cameras.get(camera_id)
+            opts = camera and options(camera)
+            if opts is None:
+                return
+            started = time.time()
+            async with self._budget:
+                log.bind(camera=camera_id, request=log.new_request_id())
+                try:
+                    await self.poll(camera)
+                except Exception as e:
+                    Log("ERROR", "Polling camera {} failed: {}", camera.name, e)
+
+            if await self.triggered(camera_id, started):
+                interval = opts["minInterval"]
+            else:
+                interval = interval * opts["backoff"]
+            interval = min(opts["maxInterval"], max(opts["minInterval"], interval))
+            self.intervals[camera_id] = interval
+            delay = interval * (1 + random.uniform(-opts["jitter"], opts["jitter"]))
+            await asyncio.sleep(max(0.0, delay - (time.time() - started)))
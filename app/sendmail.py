@@ -1,16 +1,138 @@
 import email, smtplib, ssl
+import asyncio
+import io
+import threading
+import time
 
 from email import encoders
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
+from log import Log
+
 #Setup a burner gmail account to send emails and follow links below
 #to ensure the smtp connection will work
 #https://www.google.com/settings/security/lesssecureapps
 #https://accounts.google.com/DisplayUnlockCaptcha
 
-def sendmail(sender_email, receiver_email, smtp_host, smtp_port, password, subject, html, filename) -> bool:
+# Attached images larger than this (in pixels, either side) are downscaled, None to attach as is
+attachment_max_size = 1920
+attachment_quality = 85
+
+# Seconds a connection may sit idle before it is checked with NOOP before use
+noop_after = 30
+# Upgrade the connection with STARTTLS, off only for local relays (and the benchmark SMTP sink)
+starttls = True
+
+def configure(settings):
+   global attachment_max_size, attachment_quality, noop_after, starttls
+   if "EmailImageMaxSize" in settings:
+      attachment_max_size = settings["EmailImageMaxSize"]
+   if "EmailImageQuality" in settings:
+      attachment_quality = int(settings["EmailImageQuality"])
+   if "EmailNoopAfter" in settings:
+      noop_after = float(settings["EmailNoopAfter"])
+   if "EmailStartTLS" in settings:
+      starttls = bool(settings["EmailStartTLS"])
+
+class SMTPConnection:
+   """A long-lived, logged in SMTP connection, reconnected when it fails."""
+
+   def __init__(self, smtp_host, smtp_port, sender_email, password):
+      self.smtp_host = smtp_host
+      self.smtp_port = smtp_port
+      self.sender_email = sender_email
+      self.password = password
+      self.server = None
+      self.last_used = 0
+      self._lock = threading.Lock()
+
+   def _connect(self):
+      server = smtplib.SMTP(self.smtp_host, self.smtp_port, timeout=30)
+      server.ehlo()
+      if starttls:
+         server.starttls(context=ssl.create_default_context())
+         server.ehlo()
+      server.login(self.sender_email, self.password)
+      self.server = server
+      Log("DEBUG", "Connected to SMTP server {}:{}", self.smtp_host, self.smtp_port)
+
+   def _healthy(self) -> bool:
+      if self.server is None:
+         return False
+      if time.time() - self.last_used < noop_after:
+         return True
+      try:
+         return self.server.noop()[0] == 250
+      except smtplib.SMTPException:
+         return False
+      except OSError:
+         return False
+
+   def close(self):
+      with self._lock:
+         self._close()
+
+   def _close(self):
+      if self.server is not None:
+         try:
+            self.server.quit()
+         except Exception:
+            pass
+         self.server = None
+
+   def send(self, receiver_email, message_bytes):
+      with self._lock:
+         for attempt in range(2):
+            if not self._healthy():
+               self._close()
+               self._connect()
+            try:
+               self.server.sendmail(self.sender_email, receiver_email, message_bytes)
+               self.last_used = time.time()
+               return
+            except (smtplib.SMTPServerDisconnected, OSError):
+               # Stale connection, reconnect once
+               self._close()
+               if attempt == 1:
+                  raise
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+def get_connection(smtp_host, smtp_port, sender_email, password) -> SMTPConnection:
+   key = (smtp_host, smtp_port, sender_email)
+   with _connections_lock:
+      connection = _connections.get(key)
+      if connection is None:
+         connection = SMTPConnection(smtp_host, smtp_port, sender_email, password)
+         _connections[key] = connection
+      return connection
+
+def close_connections():
+   with _connections_lock:
+      connections = list(_connections.values())
+      _connections.clear()
+   for connection in connections:
+      connection.close()
+
+def downscale(image_bytes) -> bytes:
+   """The image re-encoded to fit attachment_max_size, or unchanged when it already fits."""
+   if attachment_max_size is None:
+      return image_bytes
+   from PIL import Image
+   im = Image.open(io.BytesIO(image_bytes))
+   if max(im.size) <= attachment_max_size:
+      return image_bytes
+   im.thumbnail((attachment_max_size, attachment_max_size))
+   out = io.BytesIO()
+   im.convert("RGB").save(out, "JPEG", quality=attachment_quality, optimize=True)
+   return out.getvalue()
+
+# attachment is the image as bytes; when it is None the file named filename is attached instead.
+# attachments is an optional list of further (filename, bytes) to attach.
+def sendmail(sender_email, receiver_email, smtp_host, smtp_port, password, subject, html, filename, attachment=None, attachments=None) -> bool:
    # Create a multipart message and set headers
    message = MIMEMultipart()
    message["From"] = sender_email
@@ -21,36 +143,64 @@ def sendmail(sender_email, receiver_email, smtp_host, smtp_port, password, subje
    # Turn these into plain/html MIMEText objects
    message.attach(MIMEText(html, "html"))
 
+   files = []
    if filename:
-      # Open PDF file in binary mode
-      with open(filename, "rb") as attachment:
-          # Add file as application/octet-stream
-          # Email client can usually download this automatically as attachment
-          part = MIMEBase("application", "octet-stream")
-          part.set_payload(attachment.read())
-
-      # Encode file in ASCII characters to send by email    
+      if attachment is None:
+         with open(filename, "rb") as f:
+            attachment = f.read()
+      files.append((filename, attachment))
+   files.extend(attachments or [])
+
+   for name, data in files:
+      # Add file as application/octet-stream
+      # Email client can usually download this automatically as attachment
+      part = MIMEBase("application", "octet-stream")
+      part.set_payload(downscale(data))
+
+      # Encode file in ASCII characters to send by email
       encoders.encode_base64(part)
 
       # Add header as key/value pair to attachment part
       part.add_header(
           "Content-Disposition",
-          f"attachment; filename= {filename}",
+          f"attachment; filename= {name}",
       )
 
-      # Add attachment to message and convert message to string
+      # Add attachment to message
       message.attach(part)
-   
-   text = message.as_string()
-
-   # Log in to server using secure context and send email
-   context = ssl.create_default_context()
-   with smtplib.SMTP(smtp_host, smtp_port) as server:
-       server.ehlo()
-       server.starttls()
-       server.ehlo()
-       server.login(sender_email, password)
-       server.sendmail(sender_email, receiver_email, text)
-       server.quit()
-       print('Mail Sent')
+
+   # Send over the shared, already logged in connection
+   get_connection(smtp_host, smtp_port, sender_email, password).send(receiver_email, message.as_bytes())
+   Log("DEBUG", "Mail sent to {}", receiver_email)
    return True
+
+class AlertCoalescer:
+   """Collects alerts for window seconds after the first one and hands them to flush as one list.
+
+   flush is called on the event loop with the list of alerts; with a window of 0
+   every alert is flushed on its own straight away.
+   """
+
+   def __init__(self, window, flush):
+      self.window = window
+      self.flush = flush
+      self._pending = []
+      self._handle = None
+
+   def add(self, alert):
+      self._pending.append(alert)
+      if self.window <= 0:
+         self._flush()
+      elif self._handle is None:
+         self._handle = asyncio.get_event_loop().call_later(self.window, self._flush)
+
+   def _flush(self):
+      self._handle = None
+      alerts, self._pending = self._pending, []
+      if alerts:
+         self.flush(alerts)
+
+   def close(self):
+      if self._handle is not None:
+         self._handle.cancel()
+      self._flush()
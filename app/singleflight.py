@@ -0,0 +1,43 @@
+import asyncio
+import time
+
+from log import Log
+
+# Per key single-flight for coroutines.  While a call for a key is running, further
+# calls for the same key wait for and share its result instead of starting their
+# own.  With a debounce window the result is also reused by calls arriving up to
+# that many seconds after it completed.  The shared task is shielded, so a caller
+# going away does not cancel it for the others.
+
+class SingleFlight:
+
+    def __init__(self, debounce=0):
+        self.debounce = debounce
+        self._flights = {}
+
+    async def run(self, key, fn):
+        """Return await fn(), or the result of the call already in flight (or debounced) for key."""
+        flight = self._flights.get(key)
+        if flight is not None:
+            task, done_at = flight
+            if not task.done():
+                Log("INFO", "Joining detection already in flight for {}", key)
+                return await asyncio.shield(task)
+            if done_at is not None and time.monotonic() - done_at < self.debounce:
+                Log("INFO", "Reusing detection for {} from {:.2f}s ago", key, time.monotonic() - done_at)
+                return task.result()
+
+        task = asyncio.ensure_future(fn())
+        flight = [task, None]
+        self._flights[key] = flight
+
+        def done(t):
+            if self._flights.get(key) is not flight:
+                return
+            if self.debounce > 0 and not t.cancelled() and t.exception() is None:
+                flight[1] = time.monotonic()
+            else:
+                del self._flights[key]
+
+        task.add_done_callback(done)
+        return await asyncio.shield(task)
@@ -0,0 +1,63 @@
+import asyncio
+import os
+import sqlite3
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import log
+
+# Base of the small SQLite databases shared by every gunicorn worker (trigger times,
+# admission, tracks, detection cache, capture index).  Each thread gets a connection
+# of its own, in WAL mode so readers never wait for the writer, and waits up to
+# busy_timeout for another worker's write transaction.  Since that wait blocks, async
+# code goes through run(), which calls into the store on a few threads of its own.
+
+class SQLiteStore:
+    # CREATE statements run when the store is opened
+    schema = ()
+    # Threads of the executor behind run()
+    threads = 2
+
+    def __init__(self, filename, busy_timeout=5.0):
+        self.filename = filename
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._pid = None
+        self._executor = None
+        self._executor_pid = None
+        # The schema is created on a connection of its own and closed again: stores are
+        # built in the gunicorn master, which must not hand open connections to its workers
+        db = self._connect()
+        try:
+            for statement in self.schema:
+                db.execute(statement)
+        finally:
+            db.close()
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread, reopened after a fork
+        if self._pid != os.getpid():
+            self._local = threading.local()
+            self._pid = os.getpid()
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = self._connect()
+        return db
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.filename, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # Created lazily, and again after a fork: threads do not survive it
+        if self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix=type(self).__name__.lower())
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    async def run(self, fn, *args):
+        """fn(*args) on the store's threads, for calls from the event loop."""
+        return await asyncio.get_event_loop().run_in_executor(self._get_executor(), log.wrap(fn), *args)
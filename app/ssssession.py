@@ -0,0 +1,78 @@
+import asyncio
+
+import httpclient
+
+from log import Log
+
+# Surveillance Station session kept in memory by each worker.  Cookies live on the
+# session object and requests go through the pooled keep-alive client.  When SSS
+# answers a snapshot request with a session error instead of a JPEG, the session
+# logs in again once (concurrent requests wait for that single login) and retries.
+
+# SYNO.API error codes meaning the session is gone and a new login is needed
+SESSION_ERRORS = {105, 106, 107, 119}
+
+class SSSError(Exception):
+    pass
+
+class SSSSession:
+
+    def __init__(self, base_url, login_url, snapshot_url):
+        self.base_url = base_url
+        self.login_url = login_url
+        # SSSGetSnapshotURL template, formatted with (base_url, camera_id)
+        self.snapshot_url = snapshot_url
+        self.cookies = None
+        # Incremented on every successful login, lets waiters see a re-login already happened
+        self.generation = 0
+        self._lock = None
+
+    @property
+    def logged_in(self) -> bool:
+        return self.cookies is not None
+
+    def _get_lock(self) -> asyncio.Lock:
+        # Created lazily so the lock belongs to the worker's event loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def login(self, stale_generation=None):
+        async with self._get_lock():
+            if stale_generation is not None and self.generation != stale_generation:
+                return
+            Log("INFO", "Session login: {}", self.login_url.split("?")[0])
+            r = await httpclient.get("snapshot", self.login_url)
+            error = _api_error(r)
+            if r.status_code != 200 or error is not None:
+                raise SSSError("Surveillance Station login failed (status={} error={})".format(r.status_code, error))
+            self.cookies = dict(r.cookies)
+            self.generation += 1
+
+    async def get_snapshot(self, camera_id) -> bytes:
+        if not self.logged_in:
+            await self.login(self.generation)
+        url = self.snapshot_url.format(self.base_url, camera_id)
+        for attempt in range(2):
+            generation = self.generation
+            r = await httpclient.get("snapshot", url, cookies=self.cookies)
+            if r.status_code == 200 and (r.headers.get("content-type", "").startswith("image/") or r.content[:2] == b"\xff\xd8"):
+                return r.content
+            error = _api_error(r)
+            if attempt == 0 and error in SESSION_ERRORS:
+                Log("INFO", "Surveillance Station session expired (error={}), logging in again", error)
+                await self.login(generation)
+                continue
+            raise SSSError("Snapshot failed for camera {} (status={} error={})".format(camera_id, r.status_code, error))
+
+def _api_error(r):
+    """The SYNO.API error code of a response, None on success or a non JSON body."""
+    if not r.headers.get("content-type", "").startswith(("application/json", "text/")):
+        return None
+    try:
+        body = r.json()
+    except ValueError:
+        return None
+    if body.get("success", True):
+        return None
+    return body.get("error", {}).get("code", "unknown")
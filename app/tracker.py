@@ -0,0 +1,137 @@
+import json
+
+from camerarules import camera_options, setting_options
+from log import Log
+from sqlitestore import SQLiteStore
+
+# Stationary object suppression.  For every camera the boxes of recent qualifying
+# detections are remembered as tracks; a new detection matches a track with the
+# same label whose box overlaps it by at least the IoU threshold.  A trigger is
+# suppressed when every qualifying object matches a track that has already been
+# seen in place for the configured number of events, so a parked car stops
+# re-triggering while anything new or moving still fires.  State is bounded: tracks
+# expire after ttl seconds, each camera keeps at most max_tracks, and at most
+# max_cameras cameras are tracked (least recently used first out).
+#
+# The tracks live in a SQLite file shared by every gunicorn worker (like the trigger
+# store), since consecutive events of a camera rarely land on the same worker.  It is
+# read and written on the store's threads, off the event loop.
+#
+# Enabled with the "stationary" setting, or per camera with a "stationary" entry in
+# cameras.json (true/false, or an object overriding the options below).
+
+DEFAULTS = {
+    "iou": 0.7,
+    "events": 2,
+    "ttl": 3600,
+    "maxTracks": 50,
+}
+
+global_options = None
+max_cameras = 256
+store_file = "/tmp/sssai_tracker.db"
+
+class Track:
+    __slots__ = ("label", "box", "events", "last_seen")
+
+    def __init__(self, label, box, now, events=1):
+        self.label = label
+        self.box = box
+        self.events = events
+        self.last_seen = now
+
+def configure(settings):
+    global global_options, store_file
+    global_options = setting_options(settings.get("stationary"), DEFAULTS)
+    if "stationaryStore" in settings:
+        store_file = settings["stationaryStore"]
+
+def options(camera):
+    return camera_options(camera, "stationary", global_options, DEFAULTS)
+
+def iou(a, b) -> float:
+    x_min, y_min = max(a[0], b[0]), max(a[1], b[1])
+    x_max, y_max = min(a[2], b[2]), min(a[3], b[3])
+    intersection = max(0, x_max - x_min) * max(0, y_max - y_min)
+    if intersection == 0:
+        return 0.0
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return float(intersection) / union
+
+def _box(prediction):
+    return (int(prediction["x_min"]), int(prediction["y_min"]), int(prediction["x_max"]), int(prediction["y_max"]))
+
+class TrackStore(SQLiteStore):
+    """The tracks of every camera in a SQLite file; update() reads and writes them in one transaction."""
+    schema = ("CREATE TABLE IF NOT EXISTS tracks (camera_id TEXT PRIMARY KEY, t REAL NOT NULL, tracks TEXT NOT NULL)",)
+
+    def update(self, camera_id, now, fn):
+        """Replace the tracks of the camera by fn(tracks) and return what fn returned with them."""
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT tracks FROM tracks WHERE camera_id = ?", (camera_id,)).fetchone()
+            tracks = [Track(label, tuple(box), last_seen, events)
+                      for label, box, events, last_seen in json.loads(row[0])] if row else []
+            result = fn(tracks)
+            db.execute("INSERT OR REPLACE INTO tracks (camera_id, t, tracks) VALUES (?, ?, ?)",
+                       (camera_id, now, json.dumps([(t.label, t.box, t.events, t.last_seen) for t in tracks])))
+            db.execute("DELETE FROM tracks WHERE camera_id NOT IN "
+                       "(SELECT camera_id FROM tracks ORDER BY t DESC LIMIT ?)", (max_cameras,))
+            db.execute("COMMIT")
+            return result
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+_store = None
+
+def _get_store() -> TrackStore:
+    # Opened on first use, in the worker, after configure() has picked the file
+    global _store
+    if _store is None or _store.filename != store_file:
+        _store = TrackStore(store_file)
+    return _store
+
+def match(tracks, detections, now, opts):
+    """Update tracks in place with the detections and return those that are new or moving."""
+    tracks[:] = [t for t in tracks if now - t.last_seen <= opts["ttl"]]
+    moving = []
+    matched = set()
+    for detection in detections:
+        box = _box(detection.prediction)
+        best, best_iou = None, opts["iou"]
+        for track in tracks:
+            if track.label != detection.label or id(track) in matched:
+                continue
+            overlap = iou(track.box, box)
+            if overlap >= best_iou:
+                best, best_iou = track, overlap
+        if best is None:
+            tracks.append(Track(detection.label, box, now))
+            moving.append(detection)
+            continue
+        matched.add(id(best))
+        if best.events < opts["events"]:
+            moving.append(detection)
+        best.events += 1
+        best.box = box
+        best.last_seen = now
+
+    if len(tracks) > opts["maxTracks"]:
+        tracks.sort(key=lambda t: t.last_seen)
+        del tracks[:len(tracks) - opts["maxTracks"]]
+    return moving
+
+async def update(camera, detections, now, opts):
+    """Record detections for the camera and return those that are new or moving.
+
+    An empty result means every detection is a stationary object and the trigger
+    should be suppressed.
+    """
+    store = _get_store()
+    moving = await store.run(store.update, camera.id, now, lambda tracks: match(tracks, detections, now, opts))
+    if not moving:
+        Log("INFO", "Suppressing trigger on {}: {} stationary for {} events or more", camera.name,
+            ", ".join("{} @ {}".format(d.label, list(_box(d.prediction))) for d in detections), opts["events"])
+    return moving
@@ -0,0 +1,25 @@
+from sqlitestore import SQLiteStore
+
+# Last trigger time per camera, shared by every gunicorn worker through a small
+# SQLite database in WAL mode.  claim() is a single conditional UPSERT, so the
+# "outside trigger interval?" check and the timestamp update happen atomically and
+# two workers can never both fire for the same camera within the interval.
+
+class TriggerStore(SQLiteStore):
+    schema = ("CREATE TABLE IF NOT EXISTS last_trigger (camera_id TEXT PRIMARY KEY, t REAL NOT NULL)",)
+
+    def last(self, camera_id):
+        """Time of the last trigger for the camera, or None."""
+        row = self._connection().execute("SELECT t FROM last_trigger WHERE camera_id = ?", (str(camera_id),)).fetchone()
+        return row[0] if row else None
+
+    def claim(self, camera_id, now, interval) -> bool:
+        """Record a trigger at now unless the camera triggered less than interval seconds ago."""
+        cursor = self._connection().execute(
+            "INSERT INTO last_trigger (camera_id, t) VALUES (?, ?) "
+            "ON CONFLICT(camera_id) DO UPDATE SET t = excluded.t WHERE excluded.t - last_trigger.t >= ?",
+            (str(camera_id), now, interval))
+        return cursor.rowcount == 1
+
+    def clear(self, camera_id):
+        self._connection().execute("DELETE FROM last_trigger WHERE camera_id = ?", (str(camera_id),))
@@ -0,0 +1,202 @@
+from collections import namedtuple
+from PIL import Image, ImageDraw
+
+import numpy as np
+
+import log
+from log import Log
+
+# Batched zone engine.  All predictions of a frame are tested against all ignore
+# areas and ignore polygons of a detect_objects rule in one set of NumPy operations
+# (even-odd ray cast over every polygon edge, points on an edge count as inside).
+# A polygon bounding box prefilter skips the ray cast entirely when no anchor point
+# can be inside any polygon, and an optional bitmap mask at snapshot resolution
+# turns the polygon test into a single array lookup per point.
+
+Detection = namedtuple("Detection", "index label confidence point prediction")
+
+class RuleZones:
+    """NumPy form of a Rule's ignore areas and ignore polygons."""
+
+    def __init__(self, rule):
+        # Like CheckZones, an empty list means "no zone to be outside of"
+        self.has_areas = len(rule.ignore_areas) > 0
+        self.has_polygons = len(rule.ignore_polygons) > 0
+        self.areas = np.array(rule.ignore_areas, dtype=np.float64).reshape(-1, 4)
+
+        # Polygons with less than 3 vertices never contain a point
+        polygons = [(pts, bbox) for pts, bbox in zip(rule.ignore_polygons, rule.polygon_bboxes) if len(pts) >= 3]
+        self.polygons = [pts for pts, _ in polygons]
+        self.bboxes = np.array([bbox for _, bbox in polygons], dtype=np.float64).reshape(-1, 4)
+        starts = []
+        edges = []
+        for pts in self.polygons:
+            starts.append(len(edges))
+            for i in range(len(pts)):
+                (x1, y1), (x2, y2) = pts[i], pts[(i + 1) % len(pts)]
+                edges.append((x1, y1, x2, y2))
+        self.edge_starts = np.array(starts, dtype=np.intp)
+        edges = np.array(edges, dtype=np.float64).reshape(-1, 4)
+        self.x1, self.y1, self.x2, self.y2 = edges.T
+        self._masks = {}
+
+    def in_areas(self, boxes) -> np.ndarray:
+        """(N,) True when a box is strictly inside at least one ignore area."""
+        if not self.has_areas:
+            return np.ones(len(boxes), dtype=bool)
+        a = self.areas[None, :, :]
+        b = boxes[:, None, :]
+        inside = (a[..., 0] < b[..., 0]) & (b[..., 0] < b[..., 2]) & (b[..., 2] < a[..., 2]) & \
+                 (a[..., 1] < b[..., 1]) & (b[..., 1] < b[..., 3]) & (b[..., 3] < a[..., 3])
+        return inside.any(axis=1)
+
+    def in_polygons(self, points, frame_size=None) -> np.ndarray:
+        """(N,) True when a point is inside (or on the edge of) at least one ignore polygon."""
+        if not self.has_polygons:
+            return np.ones(len(points), dtype=bool)
+        if len(self.polygons) == 0:
+            return np.zeros(len(points), dtype=bool)
+        if frame_size is not None:
+            return self._in_mask(points, frame_size)
+        return self._ray_cast(points)
+
+    def _ray_cast(self, points) -> np.ndarray:
+        result = np.zeros(len(points), dtype=bool)
+        px, py = points[:, 0], points[:, 1]
+        b = self.bboxes
+        candidates = ((b[None, :, 0] <= px[:, None]) & (px[:, None] <= b[None, :, 2]) &
+                      (b[None, :, 1] <= py[:, None]) & (py[:, None] <= b[None, :, 3])).any(axis=1)
+        if not candidates.any():
+            return result
+        px, py = px[candidates, None], py[candidates, None]
+        x1, y1, x2, y2 = self.x1[None, :], self.y1[None, :], self.x2[None, :], self.y2[None, :]
+
+        # Points lying on an edge are inside, as in polygon.IsInsidePolygon
+        cross = (x2 - x1) * (py - y1) - (y2 - y1) * (px - x1)
+        on_edge = (cross == 0) & (np.minimum(x1, x2) <= px) & (px <= np.maximum(x1, x2)) & \
+                  (np.minimum(y1, y2) <= py) & (py <= np.maximum(y1, y2))
+
+        straddles = (y1 > py) != (y2 > py)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+        crossings = straddles & (px < x_cross)
+
+        counts = np.add.reduceat(crossings.astype(np.intp), self.edge_starts, axis=1)
+        edge_hits = np.add.reduceat(on_edge.astype(np.intp), self.edge_starts, axis=1)
+        result[candidates] = ((counts % 2 == 1) | (edge_hits > 0)).any(axis=1)
+        return result
+
+    def mask(self, frame_size) -> np.ndarray:
+        """(height, width) bitmap of the ignore polygons, built once per frame size."""
+        m = self._masks.get(frame_size)
+        if m is None:
+            im = Image.new("1", frame_size, 0)
+            draw = ImageDraw.Draw(im)
+            for pts in self.polygons:
+                draw.polygon(list(pts), fill=1, outline=1)
+            m = np.asarray(im, dtype=bool)
+            self._masks[frame_size] = m
+        return m
+
+    def _in_mask(self, points, frame_size) -> np.ndarray:
+        m = self.mask(frame_size)
+        x = points[:, 0].astype(np.intp)
+        y = points[:, 1].astype(np.intp)
+        in_frame = (0 <= x) & (x < m.shape[1]) & (0 <= y) & (y < m.shape[0])
+        result = np.zeros(len(points), dtype=bool)
+        result[in_frame] = m[y[in_frame], x[in_frame]]
+        # Anchors outside the snapshot fall back to the exact test
+        if not in_frame.all():
+            result[~in_frame] = self._ray_cast(points[~in_frame])
+        return result
+
+    def outside(self, boxes, points, frame_size=None) -> np.ndarray:
+        """(N,) True when a prediction is not ignored by this rule's zones (see CheckZones)."""
+        return ~self.in_areas(boxes) | ~self.in_polygons(points, frame_size)
+
+def get_zones(rule) -> RuleZones:
+    # Compiled lazily and kept on the rule, so a cameras.json reload drops it
+    if rule.zones is None:
+        rule.zones = RuleZones(rule)
+    return rule.zones
+
+def prediction_arrays(predictions, bottom_offset):
+    """Boxes (N,4), anchor points (N,2) and confidences (N,) of DeepStack predictions."""
+    boxes = np.array([(int(p["x_min"]), int(p["y_min"]), int(p["x_max"]), int(p["y_max"])) for p in predictions],
+                     dtype=np.float64).reshape(-1, 4)
+    # The anchor is the horizontal center, polygon_deepstack_bottom_offset from the bottom of the box
+    points = np.empty((len(boxes), 2), dtype=np.float64)
+    points[:, 0] = (boxes[:, 2] + boxes[:, 0]) / 2
+    points[:, 1] = np.trunc(boxes[:, 1] + (boxes[:, 3] - boxes[:, 1]) * (1 - bottom_offset))
+    confidences = np.round(100 * np.array([p["confidence"] for p in predictions], dtype=np.float64))
+    return boxes, points, confidences
+
+def find_trigger(camera, predictions, bottom_offset, frame_size=None):
+    """Return the first prediction that passes the camera's rules as a Detection, or None.
+
+    A prediction passes when its label has a detect_objects rule whose size and
+    confidence minimums it exceeds and whose ignore zones it is not inside.  Pass
+    frame_size=(width, height) to use the bitmap mask for the polygon test.
+    """
+    detections = find_triggers(camera, predictions, bottom_offset, frame_size)
+    return detections[0] if detections else None
+
+def find_triggers(camera, predictions, bottom_offset, frame_size=None, skipped=None):
+    """Every prediction that passes the camera's rules as a Detection, in DeepStack order.
+
+    When skipped (a collections.Counter) is given, every other prediction is counted
+    in it under the reason it failed: "label", "size", "confidence" or "zone".
+    """
+    if not predictions:
+        return []
+    boxes, points, confidences = prediction_arrays(predictions, bottom_offset)
+    sizes = boxes[:, 2:] - boxes[:, :2]
+    labels = np.array([p["label"] for p in predictions])
+    size_ok = np.zeros(len(predictions), dtype=bool)
+    passed = np.zeros(len(predictions), dtype=bool)
+    if skipped is not None:
+        known = np.zeros(len(predictions), dtype=bool)
+        big_enough = np.zeros(len(predictions), dtype=bool)
+
+    for label, rules in camera.rules.items():
+        of_label = labels == label
+        if not of_label.any():
+            continue
+        for rule in rules:
+            large = (sizes[:, 0] > rule.min_sizex) & (sizes[:, 1] > rule.min_sizey)
+            candidates = of_label & ~passed & large & (confidences > rule.min_confidence)
+            if skipped is not None:
+                known |= of_label
+                big_enough |= of_label & large
+            if not candidates.any():
+                continue
+            size_ok |= candidates
+            idx = np.nonzero(candidates)[0]
+            passed[idx[get_zones(rule).outside(boxes[idx], points[idx], frame_size)]] = True
+
+    if log.sampled():
+        _log_predictions(camera, predictions, labels, sizes, points, confidences, size_ok, passed)
+
+    if skipped is not None:
+        for reason, mask in (("label", ~known), ("size", known & ~big_enough), ("confidence", big_enough & ~size_ok),
+                             ("zone", size_ok & ~passed)):
+            count = int(mask.sum())
+            if count:
+                skipped[reason] += count
+
+    return [Detection(i, predictions[i]["label"], int(confidences[i]), (float(points[i, 0]), int(points[i, 1])), predictions[i])
+            for i in np.nonzero(passed)[0].tolist()]
+
+def _log_predictions(camera, predictions, labels, sizes, points, confidences, size_ok, passed):
+    for i in range(len(predictions)):
+        label = labels[i]
+        Log("DEBUG", "Suspected '{}' id={} found ({}%) size {}x{} with center @ {} on {}.", label, i + 1,
+            int(confidences[i]), int(sizes[i, 0]), int(sizes[i, 1]), points[i].tolist(), camera.name)
+        if label not in camera.rules:
+            Log("DEBUG", "Ignoring '{}' as it is not part of camera configuration detect object list.", label)
+        elif not size_ok[i]:
+            Log("DEBUG", "Ignoring '{}' id={} as it did not meet minimum size or confidence setting.", label, i + 1)
+        elif not passed[i]:
+            Log("DEBUG", "Ignoring '{}' id={} as it was in an ignore zone.", label, i + 1)
+        else:
+            Log("DEBUG", "'{}' id={} is not in any ignore zone.", label, i + 1)
@@ -0,0 +1,108 @@
+"""Micro-benchmarks of the per event hot spots: zone checks, capture rendering and email.
+
+Each case is timed over a number of iterations and reported as p50/p95/p99 per call.
+Save a baseline and compare later runs against it to catch regressions:
+
+    python benchmarks/bench_micro.py --save baseline.json
+    python benchmarks/bench_micro.py --compare baseline.json --tolerance 0.25   # exits 1 when slower
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchutil import percentiles, use_app
+
+use_app()
+
+from bench_zones import HEIGHT, WIDTH, random_polygon, random_prediction
+from camerarules import Camera
+from fakes import FakeSMTP, generate_fixtures
+from polygon import IsInsidePolygon
+from zones import find_triggers, prediction_arrays
+import render
+import sendmail
+
+def measure(fn, iterations, warmup=3):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return percentiles(times)
+
+def cases(args):
+    rnd = random.Random(args.seed)
+    polygons = [random_polygon(rnd) for _ in range(args.polygons)]
+    camera = Camera("1", {"name": "bench", "triggerUrl": "", "detect_objects": [
+        {"type": "person", "min_sizex": 0, "min_sizey": 0, "min_confidence": 0, "ignore_polygons": polygons},
+        {"type": "car", "min_sizex": 50, "min_sizey": 50, "min_confidence": 60,
+         "ignore_areas": [{"x_min": 0, "y_min": 600, "x_max": 900, "y_max": 1080}]}]})
+    predictions = [random_prediction(rnd) for _ in range(args.predictions)]
+    _, points, _ = prediction_arrays(predictions, 0.1)
+    tuples = [(x, int(y)) for x, y in points.tolist()]
+    snapshot = generate_fixtures(1, (WIDTH, HEIGHT))[0]
+    directory = tempfile.mkdtemp(prefix="sssai-micro-")
+    fn = os.path.join(directory, "capture.jpg")
+    smtp = FakeSMTP().start()
+    sendmail.starttls = False
+
+    yield "polygon.IsInsidePolygon", lambda: [any(IsInsidePolygon(pg, p, "person") for pg in polygons) for p in tuples]
+    yield "zones.find_triggers", lambda: find_triggers(camera, predictions, 0.1)
+    yield "zones.find_triggers (mask)", lambda: find_triggers(camera, predictions, 0.1, (WIDTH, HEIGHT))
+    yield "render.render", lambda: render.render("1", snapshot, predictions, [], polygons, fn, tuples[0])
+    yield "sendmail.downscale", lambda: sendmail.downscale(snapshot)
+    yield "sendmail.sendmail", lambda: sendmail.sendmail(
+        "bench@localhost", "bench@localhost", smtp.host, smtp.port, "bench", "bench", "<p>bench</p>", "capture.jpg",
+        attachment=snapshot)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--polygons", type=int, default=12)
+    parser.add_argument("--predictions", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--only", help="comma separated case names to run")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare the p50 of every case with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p50 slowdown against the baseline")
+    args = parser.parse_args()
+
+    only = set(args.only.split(",")) if args.only else None
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print("{:<28}{:>10}{:>10}{:>10}  (ms){}".format("case", "p50", "p95", "p99", "  vs baseline" if baseline else ""))
+    for name, fn in cases(args):
+        if only is not None and name not in only:
+            continue
+        p = measure(fn, args.iterations)
+        results[name] = {"p50": p[50], "p95": p[95], "p99": p[99]}
+        line = "{:<28}{:>10.3f}{:>10.3f}{:>10.3f}".format(name, p[50] * 1000, p[95] * 1000, p[99] * 1000)
+        if name in baseline:
+            change = p[50] / baseline[name]["p50"] - 1
+            line += "  {:+.0%}".format(change)
+            if change > args.tolerance:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line, flush=True)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print("{} case(s) slower than the baseline by more than {:.0%}: {}".format(
+            len(regressions), args.tolerance, ", ".join(regressions)))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
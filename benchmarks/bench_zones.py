@@ -0,0 +1,101 @@
+"""Benchmark the NumPy zone engine (app/zones.py) against the per point ray cast in app/polygon.py.
+
+Usage: python benchmarks/bench_zones.py [--polygons 48] [--predictions 10] [--frames 2000]
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from camerarules import Camera
+from polygon import IsInsidePolygon
+from zones import get_zones, prediction_arrays
+
+WIDTH, HEIGHT = 1920, 1080
+
+def random_polygon(rnd):
+    cx, cy = rnd.randint(100, WIDTH - 100), rnd.randint(100, HEIGHT - 100)
+    n = rnd.randint(4, 10)
+    angles = sorted(rnd.uniform(0, 2 * math.pi) for _ in range(n))
+    return [[int(cx + r * math.cos(a)), int(cy + r * math.sin(a))]
+            for a, r in ((a, rnd.uniform(30, 250)) for a in angles)]
+
+def random_prediction(rnd):
+    x_min, y_min = rnd.randint(0, WIDTH - 200), rnd.randint(0, HEIGHT - 300)
+    return {"label": "person", "confidence": rnd.uniform(0.4, 1.0),
+            "x_min": x_min, "y_min": y_min,
+            "x_max": x_min + rnd.randint(20, 200), "y_max": y_min + rnd.randint(40, 300)}
+
+def level_with_vertex(polygons, p):
+    # polygon.IsInsidePolygon reports any point level with a vertex to its right as
+    # inside, even when it is outside the polygon; zones.py does not reproduce that,
+    # so the disagreement on such points is reported on its own.
+    return any(y == p[1] and x >= p[0] for polygon in polygons for x, y in polygon)
+
+def legacy(polygons, points):
+    return [any(IsInsidePolygon(polygon, p, "person") for polygon in polygons) for p in points]
+
+def timed(fn, frames):
+    start = time.perf_counter()
+    for frame in frames:
+        result = fn(frame)
+    return (time.perf_counter() - start) / len(frames) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--polygons", type=int, default=48)
+    parser.add_argument("--predictions", type=int, default=10)
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--offset", type=float, default=0.1, help="polygon_deepstack_bottom_offset")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    camera = Camera("1", {"name": "bench", "triggerUrl": "", "detect_objects": [{
+        "type": "person", "min_sizex": 0, "min_sizey": 0, "min_confidence": 0,
+        "ignore_polygons": [random_polygon(rnd) for _ in range(args.polygons)]}]})
+    rule = camera.rules["person"][0]
+    zones = get_zones(rule)
+    zones.mask((WIDTH, HEIGHT))
+
+    frames = []
+    for _ in range(args.frames):
+        predictions = [random_prediction(rnd) for _ in range(args.predictions)]
+        _, points, _ = prediction_arrays(predictions, args.offset)
+        frames.append((points, [(x, int(y)) for x, y in points.tolist()]))
+
+    legacy_us = timed(lambda f: legacy(rule.ignore_polygons, f[1]), frames)
+    vector_us = timed(lambda f: zones.in_polygons(f[0]), frames)
+    mask_us = timed(lambda f: zones.in_polygons(f[0], (WIDTH, HEIGHT)), frames)
+
+    # [points, agreeing with polygon.py] for the points away from and level with a vertex
+    counts = {"vector": [[0, 0], [0, 0]], "mask": [[0, 0], [0, 0]]}
+    for points, tuples in frames:
+        expected = legacy(rule.ignore_polygons, tuples)
+        results = {"vector": zones.in_polygons(points).tolist(), "mask": zones.in_polygons(points, (WIDTH, HEIGHT)).tolist()}
+        for i, p in enumerate(tuples):
+            level = level_with_vertex(rule.ignore_polygons, p)
+            for name, result in results.items():
+                counts[name][level][0] += 1
+                counts[name][level][1] += expected[i] == result[i]
+
+    print("{} polygons, {} predictions per frame, {} frames".format(args.polygons, args.predictions, args.frames))
+    print("{:<22}{:>12}{:>10}{:>12}{:>14}{:>17}".format("engine", "us/frame", "speedup", "agreement", "off vertex",
+                                                       "level w/ vertex"))
+    print("{:<22}{:>12.1f}{:>9.1f}x".format("polygon.py", legacy_us, 1.0))
+    for name, key, us in (("zones (ray cast)", "vector", vector_us), ("zones (bitmap mask)", "mask", mask_us)):
+        (off, off_agree), (level, level_agree) = counts[key]
+        print("{:<22}{:>12.1f}{:>9.1f}x{:>11.2f}%{:>13.2f}%{:>16.2f}%".format(
+            name, us, legacy_us / us, 100.0 * (off_agree + level_agree) / (off + level), 100.0 * off_agree / max(off, 1),
+            100.0 * level_agree / max(level, 1)))
+    (off, off_agree), (level, level_agree) = counts["vector"]
+    print("{} of {} points ({:.1%}) are level with a polygon vertex to their right; the ray cast decides {} of them "
+          "differently from polygon.py, which counts them as inside (see README).".format(
+              level, off + level, float(level) / (off + level), level - level_agree))
+
+if __name__ == "__main__":
+    main()
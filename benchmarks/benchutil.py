@@ -0,0 +1,17 @@
+"""Helpers shared by the benchmarks."""
+import os
+import sys
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+
+def use_app():
+    """Make the app modules importable the way main.py imports them."""
+    if APP not in sys.path:
+        sys.path.insert(0, APP)
+
+def percentiles(values, qs=(50, 95, 99)):
+    """{q: value} nearest rank percentiles of values, None when there are none."""
+    ordered = sorted(values)
+    if not ordered:
+        return {q: None for q in qs}
+    return {q: ordered[min(len(ordered) - 1, max(0, int(round(q / 100.0 * len(ordered))) - 1))] for q in qs}
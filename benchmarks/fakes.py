@@ -0,0 +1,326 @@
+"""Local stand-ins for Surveillance Station, DeepStack and an SMTP server.
+
+Only the standard library (and Pillow for the generated fixtures) is used, so the
+fakes run anywhere the app does.  Each server runs in a background thread:
+
+    sss = FakeSSS(fixtures="path/to/jpegs", latency=0.02).start()
+    deepstack = FakeDeepStack(latency=0.15, jitter=0.05).start()
+    smtp = FakeSMTP().start()
+    ...
+    print(sss.url, deepstack.url, smtp.port, smtp.stats)
+
+Run this file on its own to keep the three servers up for manual testing.
+"""
+import argparse
+import base64
+import io
+import itertools
+import json
+import os
+import random
+import socketserver
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+LABELS = ("person", "car", "dog", "cat", "bicycle", "truck")
+
+def generate_fixtures(count=4, size=(1920, 1080), seed=0):
+    """count synthetic JPEG snapshots, slightly different from one another."""
+    from PIL import Image, ImageDraw
+    rnd = random.Random(seed)
+    frames = []
+    for i in range(count):
+        im = Image.new("RGB", size, (90, 110, 90))
+        draw = ImageDraw.Draw(im)
+        for _ in range(40):
+            x, y = rnd.randrange(size[0]), rnd.randrange(size[1])
+            draw.rectangle((x, y, x + rnd.randint(20, 300), y + rnd.randint(20, 300)),
+                           fill=tuple(rnd.randrange(256) for _ in range(3)))
+        out = io.BytesIO()
+        im.save(out, "JPEG", quality=85)
+        frames.append(out.getvalue())
+    return frames
+
+def load_fixtures(directory):
+    names = sorted(n for n in os.listdir(directory) if n.lower().endswith((".jpg", ".jpeg")))
+    frames = []
+    for name in names:
+        with open(os.path.join(directory, name), "rb") as f:
+            frames.append(f.read())
+    if not frames:
+        raise ValueError("No .jpg fixtures in {}".format(directory))
+    return frames
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256
+
+class _Fake:
+    handler = None
+    server_class = _Server
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.lock = threading.Lock()
+        self.stats = {}
+        self._server = None
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(self.host, self.port)
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def start(self):
+        fake = self
+
+        class Handler(self.handler):
+            pass
+        Handler.fake = fake
+        self._server = self.server_class((self.host, self.port), Handler)
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body, content_type="application/json", headers=()):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+class _SSSHandler(_Handler):
+    def do_GET(self):
+        fake = self.fake
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if fake.latency:
+            time.sleep(fake.latency)
+        if url.path.endswith("/auth.cgi"):
+            fake.count("logins")
+            sid = uuid.uuid4().hex
+            with fake.lock:
+                fake.sessions.add(sid)
+            self.reply(200, {"success": True, "data": {"sid": sid}}, headers=[("Set-Cookie", "id={}; path=/".format(sid))])
+        elif url.path.endswith("/entry.cgi"):
+            sid = (self.headers.get("Cookie") or "").partition("id=")[2].split(";")[0]
+            with fake.lock:
+                valid = sid in fake.sessions
+                fake.served += 1
+                expire = fake.expire_every and fake.served % fake.expire_every == 0
+                if expire:
+                    fake.sessions.discard(sid)
+            if not valid or expire:
+                fake.count("session_errors")
+                self.reply(200, {"success": False, "error": {"code": 119}})
+                return
+            fake.count("snapshots")
+            camera = query.get("cameraId", ["0"])[0]
+            self.reply(200, fake.frame(camera), content_type="image/jpeg")
+        elif url.path.startswith("/trigger"):
+            fake.count("triggers")
+            self.reply(200, {"success": True})
+        else:
+            self.reply(404, {"success": False})
+
+class FakeSSS(_Fake):
+    """Surveillance Station: auth.cgi logs in, entry.cgi serves snapshots, /trigger/<id> stands in for action rules.
+
+    Every camera cycles through the fixture frames.  expire_every=N invalidates the
+    session on every Nth snapshot to exercise the re-login path.
+    """
+    handler = _SSSHandler
+
+    def __init__(self, fixtures=None, latency=0.0, expire_every=0, **kwargs):
+        super().__init__(**kwargs)
+        self.frames = load_fixtures(fixtures) if fixtures else generate_fixtures()
+        self.latency = latency
+        self.expire_every = expire_every
+        self.sessions = set()
+        self.served = 0
+        self._cycles = {}
+
+    def frame(self, camera):
+        with self.lock:
+            cycle = self._cycles.get(camera)
+            if cycle is None:
+                cycle = self._cycles[camera] = itertools.cycle(self.frames)
+            return next(cycle)
+
+class _DeepStackHandler(_Handler):
+    def do_GET(self):
+        self.fake.count("health")
+        self.reply(200, {"success": True})
+
+    def do_POST(self):
+        fake = self.fake
+        self.read_body()
+        if not self.path.startswith("/v1/vision/detection"):
+            self.reply(404, {"success": False})
+            return
+        fake.count("detections")
+        time.sleep(fake.delay())
+        if fake.error_rate and random.random() < fake.error_rate:
+            fake.count("errors")
+            self.reply(500, {"success": False, "error": "injected failure"})
+            return
+        self.reply(200, {"success": True, "predictions": fake.predictions()})
+
+class FakeDeepStack(_Fake):
+    """DeepStack detection with a configurable latency.
+
+    Returns the canned predictions when given, otherwise 0 to max_predictions random
+    ones on a width x height frame.  error_rate answers that fraction with a 500.
+    """
+    handler = _DeepStackHandler
+
+    def __init__(self, latency=0.1, jitter=0.0, predictions=None, max_predictions=5,
+                 size=(1920, 1080), error_rate=0.0, seed=None, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.jitter = jitter
+        self.canned = predictions
+        self.max_predictions = max_predictions
+        self.size = size
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+    def delay(self):
+        with self.lock:
+            return max(0.0, self.random.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+
+    def predictions(self):
+        if self.canned is not None:
+            return self.canned
+        with self.lock:
+            rnd = self.random
+            predictions = []
+            for _ in range(rnd.randint(0, self.max_predictions)):
+                x_min, y_min = rnd.randrange(self.size[0] - 100), rnd.randrange(self.size[1] - 100)
+                predictions.append({
+                    "label": rnd.choice(LABELS),
+                    "confidence": round(rnd.uniform(0.4, 0.99), 4),
+                    "x_min": x_min, "y_min": y_min,
+                    "x_max": min(self.size[0], x_min + rnd.randint(40, 400)),
+                    "y_max": min(self.size[1], y_min + rnd.randint(40, 500)),
+                })
+            return predictions
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib: EHLO, AUTH PLAIN, MAIL, RCPT, DATA, NOOP, RSET, QUIT."""
+    fake = None
+
+    def send(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        fake = self.fake
+        fake.count("connections")
+        self.send("220 fake-smtp ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("latin-1").strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb in ("EHLO", "HELO"):
+                self.send("250-fake-smtp")
+                self.send("250-SIZE 52428800")
+                self.send("250 AUTH PLAIN")
+            elif verb == "AUTH":
+                fake.count("logins")
+                parts = command.split()
+                if len(parts) == 2:
+                    self.send("334 ")
+                    base64.b64decode(self.rfile.readline().strip() or b"")
+                self.send("235 2.7.0 Authentication successful")
+            elif verb in ("MAIL", "RCPT", "RSET"):
+                self.send("250 OK")
+            elif verb == "NOOP":
+                fake.count("noops")
+                self.send("250 OK")
+            elif verb == "DATA":
+                self.send("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data in (b".\r\n", b".\n"):
+                        break
+                    size += len(data)
+                if fake.latency:
+                    time.sleep(fake.latency)
+                with fake.lock:
+                    fake.stats["messages"] = fake.stats.get("messages", 0) + 1
+                    fake.stats["bytes"] = fake.stats.get("bytes", 0) + size
+                self.send("250 OK queued")
+            elif verb == "QUIT":
+                self.send("221 Bye")
+                return
+            else:
+                self.send("502 Command not implemented")
+
+class _SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class FakeSMTP(_Fake):
+    """An SMTP sink without TLS (run the app with "EmailStartTLS": false); messages are counted, not kept."""
+    handler = _SMTPHandler
+    server_class = _SMTPServer
+
+    def __init__(self, latency=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--fixtures", help="directory of .jpg snapshots (default: generated)")
+    parser.add_argument("--sss-port", type=int, default=5000)
+    parser.add_argument("--deepstack-port", type=int, default=8383)
+    parser.add_argument("--smtp-port", type=int, default=2525)
+    parser.add_argument("--latency", type=float, default=0.1, help="DeepStack latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    args = parser.parse_args()
+
+    sss = FakeSSS(fixtures=args.fixtures, port=args.sss_port).start()
+    deepstack = FakeDeepStack(latency=args.latency, jitter=args.jitter, port=args.deepstack_port).start()
+    smtp = FakeSMTP(port=args.smtp_port).start()
+    print("SSS {}  DeepStack {}  SMTP 127.0.0.1:{}".format(sss.url, deepstack.url, smtp.port))
+    try:
+        while True:
+            time.sleep(10)
+            print("SSS {}  DeepStack {}  SMTP {}".format(sss.stats, deepstack.stats, smtp.stats))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
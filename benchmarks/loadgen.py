@@ -0,0 +1,266 @@
+"""Load test the whole service against local fake SSS, DeepStack and SMTP servers.
+
+For every worker class and worker count given, the app is started with run.py on a
+generated config, driven at a fixed request rate spread over a number of cameras,
+and stopped again.  Reports client side throughput and latency, and p50/p95/p99 of
+every stage from the sssai_stage_seconds histograms of /metrics.
+
+Usage:
+    python benchmarks/loadgen.py --workers 1,2,5 --rate 20 --duration 30 --cameras 8
+    python benchmarks/loadgen.py --worker-class uvicorn.workers.UvicornWorker,uvicorn.workers.UvicornH11Worker
+    python benchmarks/loadgen.py --url http://localhost:4242 --cameras 3   # an instance that is already running
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchutil import percentiles
+from fakes import FakeDeepStack, FakeSMTP, FakeSSS
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+BUCKET = re.compile(r'^sssai_stage_seconds_bucket\{(.*)\} ([0-9.e+-]+)$')
+LABEL = re.compile(r'(\w+)="([^"]*)"')
+
+def write_config(directory, sss, deepstack, smtp, cameras, extra):
+    settings = {
+        "SSSUrl": sss.url,
+        "SSSUsername": "bench",
+        "SSSPassword": "bench",
+        "SSSGetSessionURL": "{}/webapi/auth.cgi?api=SYNO.API.Auth&method=login&version=3&account={}&passwd={}&session=SurveillanceStation",
+        "SSSGetSnapshotURL": "{}/webapi/entry.cgi?camStm=1&version=2&cameraId={}&api=%22SYNO.SurveillanceStation.Camera%22&method=GetSnapshot",
+        "deepstackUrl": deepstack.url,
+        "triggerInterval": 0,
+        "timeout": 30,
+        "captureDir": os.path.join(directory, "captures"),
+        "triggerStore": os.path.join(directory, "last_trigger.db"),
+        "polygon_deepstack_bottom_offset": 0.1,
+        "homebridgeWebhookUrl": None,
+        "EmailSenderAddress": "bench@localhost",
+        "EmailReceiverAddress": "bench@localhost",
+        "EmailSmtpHost": smtp.host,
+        "EmailSmtpPort": smtp.port,
+        "EmailPassword": "bench",
+        "EmailStartTLS": False,
+    }
+    settings.update(extra)
+    config = {}
+    for i in range(1, cameras + 1):
+        config[str(i)] = {
+            "name": "Bench Cam {}".format(i),
+            "triggerUrl": "{}/trigger/{}".format(sss.url, i),
+            "detect_objects": [
+                {"type": "person", "min_sizex": 60, "min_sizey": 60, "min_confidence": 60,
+                 "ignore_polygons": [[[0, 0], [1920, 0], [1920, 300], [0, 300]]]},
+                {"type": "car", "min_sizex": 100, "min_sizey": 100, "min_confidence": 70,
+                 "ignore_areas": [{"x_min": 0, "y_min": 600, "x_max": 900, "y_max": 1080}]},
+            ],
+        }
+    os.makedirs(settings["captureDir"], exist_ok=True)
+    with open(os.path.join(directory, "settings.json"), "w") as f:
+        json.dump(settings, f, indent=2)
+    with open(os.path.join(directory, "cameras.json"), "w") as f:
+        json.dump(config, f, indent=2)
+
+def start_app(directory, port, workers, worker_class):
+    env = dict(os.environ,
+               SSSAI_CONFIG_DIR=directory,
+               BIND="127.0.0.1:{}".format(port),
+               GUNICORN_WORKERS=str(workers),
+               GUNICORN_WORKER_CLASS=worker_class,
+               PROMETHEUS_MULTIPROC_DIR=os.path.join(directory, "metrics"),
+               LOG_LEVEL=os.environ.get("LOG_LEVEL", "WARNING"),
+               PYTHONPATH=os.pathsep.join([os.path.join(ROOT, "app"), ROOT]))
+    env["prometheus_multiproc_dir"] = env["PROMETHEUS_MULTIPROC_DIR"]
+    log = open(os.path.join(directory, "app.log"), "wb")
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, "run.py")], env=env, cwd=ROOT,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+def stop_app(process):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+async def wait_ready(client, url, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError("The app exited with status {}".format(process.returncode))
+        try:
+            r = await client.get(url + "/metrics")
+            if r.status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("The app did not come up within {}s".format(timeout))
+
+async def scrape(client, url):
+    """{stage: {le: cumulative count}} summed over cameras and workers."""
+    r = await client.get(url + "/metrics")
+    stages = {}
+    for line in r.text.splitlines():
+        m = BUCKET.match(line)
+        if not m:
+            continue
+        labels = dict(LABEL.findall(m.group(1)))
+        buckets = stages.setdefault(labels["stage"], {})
+        le = float(labels["le"])
+        buckets[le] = buckets.get(le, 0.0) + float(m.group(2))
+    return stages
+
+def histogram_quantile(q, buckets):
+    """Prometheus style quantile estimate (linear within a bucket) of cumulative {le: count}."""
+    bounds = sorted(buckets)
+    total = buckets[bounds[-1]] if bounds else 0
+    if total <= 0:
+        return None
+    rank = q * total
+    lower, below = 0.0, 0.0
+    for le in bounds:
+        if buckets[le] >= rank:
+            if le == float("inf"):
+                return lower
+            inside = buckets[le] - below
+            return lower + (le - lower) * ((rank - below) / inside if inside else 0)
+        lower, below = le, buckets[le]
+    return lower
+
+def stage_report(before, after):
+    report = {}
+    for stage, buckets in after.items():
+        delta = {le: count - before.get(stage, {}).get(le, 0.0) for le, count in buckets.items()}
+        count = delta.get(float("inf"), 0)
+        if count <= 0:
+            continue
+        report[stage] = {"count": int(count)}
+        for q in (0.5, 0.95, 0.99):
+            report[stage]["p{}".format(int(q * 100))] = histogram_quantile(q, delta)
+    return report
+
+async def drive(client, url, cameras, rate, duration, seed=0):
+    """Open loop load: requests start on schedule whether or not earlier ones finished."""
+    rnd = random.Random(seed)
+    latencies, statuses = [], {}
+
+    async def one(camera):
+        start = time.perf_counter()
+        try:
+            r = await client.get("{}/{}".format(url, camera))
+            status = r.status_code
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        latencies.append(time.perf_counter() - start)
+        statuses[status] = statuses.get(status, 0) + 1
+
+    tasks = []
+    start = time.perf_counter()
+    total = int(rate * duration)
+    for i in range(total):
+        delay = start + float(i) / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(one(rnd.randint(1, cameras))))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    p = percentiles(latencies)
+    return {"sent": total, "statuses": statuses, "elapsed": elapsed,
+            "throughput": statuses.get(200, 0) / elapsed, "p50": p[50], "p95": p[95], "p99": p[99]}
+
+async def run_one(args, worker_class, workers, sss, deepstack, smtp):
+    process = None
+    directory = tempfile.mkdtemp(prefix="sssai-bench-")
+    url = args.url
+    if url is None:
+        write_config(directory, sss, deepstack, smtp, args.cameras, json.loads(args.settings))
+        process = start_app(directory, args.port, workers, worker_class)
+        url = "http://127.0.0.1:{}".format(args.port)
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    try:
+        async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+            await wait_ready(client, url, process)
+            # Warm up the session, connection pools and caches of every worker
+            await drive(client, url, args.cameras, args.rate, min(args.warmup, args.duration))
+            before = await scrape(client, url)
+            result = await drive(client, url, args.cameras, args.rate, args.duration, args.seed)
+            after = await scrape(client, url)
+    finally:
+        if process is not None:
+            stop_app(process)
+    result.update(worker_class=worker_class, workers=workers, stages=stage_report(before, after))
+    if process is not None:
+        result["log"] = os.path.join(directory, "app.log")
+    return result
+
+def ms(value):
+    return "{:8.1f}".format(value * 1000) if value is not None else "       -"
+
+def print_result(result):
+    print("\n{} x{}: {} requests in {:.1f}s, {:.1f} ok/s, statuses {}".format(
+        result["worker_class"], result["workers"], result["sent"], result["elapsed"], result["throughput"], result["statuses"]))
+    print("  {:<14}{:>8}{:>9}{:>9}{:>9}  (ms)".format("stage", "count", "p50", "p95", "p99"))
+    print("  {:<14}{:>8}{}{}{}".format("client", result["sent"], ms(result["p50"]), ms(result["p95"]), ms(result["p99"])))
+    for stage, s in sorted(result["stages"].items()):
+        print("  {:<14}{:>8}{}{}{}".format(stage, s["count"], ms(s["p50"]), ms(s["p95"]), ms(s["p99"])))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", default="2", help="comma separated GUNICORN_WORKERS values (default 2)")
+    parser.add_argument("--worker-class", default="uvicorn.workers.UvicornWorker", help="comma separated gunicorn worker classes")
+    parser.add_argument("--cameras", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=10, help="requests per second")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of measured load")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds of load before measuring")
+    parser.add_argument("--connections", type=int, default=100, help="client connection limit")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--url", help="benchmark a running instance instead of starting one")
+    parser.add_argument("--fixtures", help="directory of .jpg snapshots served by the fake SSS")
+    parser.add_argument("--sss-latency", type=float, default=0.02)
+    parser.add_argument("--expire-every", type=int, default=0, help="expire the SSS session every N snapshots")
+    parser.add_argument("--deepstack-latency", type=float, default=0.15)
+    parser.add_argument("--deepstack-jitter", type=float, default=0.03)
+    parser.add_argument("--deepstack-errors", type=float, default=0.0, help="fraction of failed detections")
+    parser.add_argument("--deepstack-servers", type=int, default=1)
+    parser.add_argument("--settings", default="{}", help="JSON object merged into the generated settings.json")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    sss = FakeSSS(fixtures=args.fixtures, latency=args.sss_latency, expire_every=args.expire_every).start()
+    servers = [FakeDeepStack(latency=args.deepstack_latency, jitter=args.deepstack_jitter,
+                             error_rate=args.deepstack_errors, seed=args.seed + i).start()
+               for i in range(args.deepstack_servers)]
+    deepstack = servers[0]
+    if len(servers) > 1:
+        args.settings = json.dumps(dict(json.loads(args.settings), deepstackUrl=[s.url for s in servers]))
+    smtp = FakeSMTP().start()
+
+    results = []
+    for worker_class in args.worker_class.split(","):
+        for workers in (int(w) for w in args.workers.split(",")):
+            result = asyncio.get_event_loop().run_until_complete(
+                run_one(args, worker_class, workers, sss, deepstack, smtp))
+            print_result(result)
+            results.append(result)
+
+    print("\nfake SSS {}  DeepStack {}  SMTP {}".format(sss.stats, [s.stats for s in servers], smtp.stats))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,25 @@
 import os
 import logging
-import sys
+import shutil
 
 from gunicorn.app.base import BaseApplication
 from gunicorn.glogging import Logger
-from loguru import logger
+
+# prometheus_client picks its multiprocess mode up at import time, so the shared
+# metrics directory has to exist (and be emptied of old workers) before anything
+# imports it, the app included
+METRICS_DIR = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/sssai_metrics")
+os.environ.setdefault("prometheus_multiproc_dir", METRICS_DIR)
+shutil.rmtree(METRICS_DIR, ignore_errors=True)
+os.makedirs(METRICS_DIR, exist_ok=True)
 
 from app.main import app
 
 
 LOG_LEVEL = logging.getLevelName(os.environ.get("LOG_LEVEL", "INFO"))
-JSON_LOGS = True if os.environ.get("JSON_LOGS", "0") == "1" else False
 WORKERS = int(os.environ.get("GUNICORN_WORKERS", "5"))
-
-
-class InterceptHandler(logging.Handler):
-    def emit(self, record):
-        # Get corresponding Loguru level if it exists
-        try:
-            level = logger.level(record.levelname).name
-        except ValueError:
-            level = record.levelno
-
-        # Find caller from where originated the logged message
-        frame, depth = logging.currentframe(), 2
-        while frame.f_code.co_filename == logging.__file__:
-            frame = frame.f_back
-            depth += 1
-
-        logger.opt(depth=depth, exception=record.exc_info).log(level, record.getMessage())
+WORKER_CLASS = os.environ.get("GUNICORN_WORKER_CLASS", "uvicorn.workers.UvicornWorker")
+BIND = os.environ.get("BIND", "0.0.0.0:80")
 
 
 class StubbedGunicornLogger(Logger):
@@ -40,6 +31,12 @@ class StubbedGunicornLogger(Logger):
         self.access_log.setLevel(LOG_LEVEL)
 
 
+def child_exit(server, worker):
+    # Drop the live gauges of the dead worker from /metrics
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
 class StandaloneApplication(BaseApplication):
     """Our Gunicorn application."""
 
@@ -61,23 +58,18 @@ class StandaloneApplication(BaseApplication):
 
 
 if __name__ == '__main__':
-    intercept_handler = InterceptHandler()
-    # logging.basicConfig(handlers=[intercept_handler], level=LOG_LEVEL)
-    # logging.root.handlers = [intercept_handler]
-    logging.root.setLevel(LOG_LEVEL)
-
-    seen = set()
-    
-
-    logger.configure(handlers=[{"sink": sys.stdout, "serialize": JSON_LOGS}])
-
+    # Logging (LOG_LEVEL, JSON_LOGS) is set up by app/log.py when the app is imported
     options = {
-        "bind": "0.0.0.0:80",
+        "bind": BIND,
         "workers": WORKERS,
         "accesslog": "",
         "errorlog": "",
-        "worker_class": "uvicorn.workers.UvicornWorker",
-        "logger_class": StubbedGunicornLogger
+        "worker_class": WORKER_CLASS,
+        "logger_class": StubbedGunicornLogger,
+        "child_exit": child_exit,
+        # The app (config, camera index, stores) is loaded once in the master and shared by
+        # the forked workers; sessions and connections are opened by each worker after the fork
+        "preload_app": True,
     }
 
     StandaloneApplication(app, options).run()
\ No newline at end of file
@@ -0,0 +1,79 @@
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+from fakes import FakeDeepStack, FakeSMTP, FakeSSS
+from loadgen import write_config
+
+@pytest.fixture
+def fakes():
+    """Fake Surveillance Station, DeepStack and SMTP servers, stopped after the test."""
+    servers = {"sss": FakeSSS().start(), "deepstack": FakeDeepStack(latency=0.05).start(), "smtp": FakeSMTP().start()}
+    yield servers
+    for server in servers.values():
+        server.stop()
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class App:
+    """run.py started as in the container, on a generated config."""
+
+    def __init__(self, fakes, cameras=2, settings=None, workers=1, env=None):
+        self.directory = tempfile.mkdtemp()
+        write_config(self.directory, fakes["sss"], fakes["deepstack"], fakes["smtp"], cameras, settings or {})
+        self.url = "http://127.0.0.1:{}".format(free_port())
+        environ = {k: v for k, v in os.environ.items() if k.lower() != "prometheus_multiproc_dir"}
+        environ.update(SSSAI_CONFIG_DIR=self.directory, BIND=self.url[len("http://"):], GUNICORN_WORKERS=str(workers),
+                       PYTHONPATH=os.pathsep.join([os.path.join(ROOT, "app"), ROOT]), **(env or {}))
+        self.log = open(os.path.join(self.directory, "app.log"), "wb")
+        self.process = subprocess.Popen([sys.executable, os.path.join(ROOT, "run.py")], env=environ, cwd=ROOT,
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            assert self.process.poll() is None, "run.py exited with {}".format(self.process.returncode)
+            try:
+                if httpx.get(self.url + "/readyz").status_code == 200:
+                    return self
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.05)
+        raise TimeoutError("run.py not ready after {}s".format(timeout))
+
+    def get(self, path, **kwargs):
+        return httpx.get(self.url + path, timeout=30, **kwargs)
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.log.close()
+
+@pytest.fixture
+def start_app(fakes):
+    apps = []
+
+    def start(**kwargs):
+        app = App(fakes, **kwargs)
+        apps.append(app)
+        return app.wait_ready()
+    yield start
+    for app in apps:
+        app.stop()
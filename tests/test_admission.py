@@ -0,0 +1,55 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+
+from admission import Admission, Overloaded
+
+def test_waiting_for_a_slot_does_not_block_the_event_loop():
+    filename = os.path.join(tempfile.mkdtemp(), "admission.db")
+    admission = Admission(filename, concurrency=1)
+
+    async def main():
+        # Another process holds the database for a while
+        other = sqlite3.connect(filename, isolation_level=None)
+        other.execute("BEGIN IMMEDIATE")
+        asyncio.get_event_loop().call_later(0.5, other.execute, "COMMIT")
+
+        async def event():
+            async with admission.slot("1", 0, time.time() + 5):
+                await asyncio.sleep(0.05)
+
+        events = asyncio.gather(*(event() for _ in range(3)))
+        ticks = 0
+        while not events.done():
+            ticks += 1
+            await asyncio.sleep(0.01)
+        await events
+        return ticks
+
+    # The loop kept running while the events waited on the locked database
+    assert asyncio.run(main()) >= 30
+
+def test_slot_refused_when_the_queue_is_full():
+    admission = Admission(os.path.join(tempfile.mkdtemp(), "admission.db"), concurrency=1, max_queue=1)
+
+    async def main():
+        async def hold():
+            async with admission.slot("1", 0, time.time() + 5):
+                await asyncio.sleep(0.5)
+        # One event holds the slot and a second one fills the queue
+        holders = []
+        for key in ("admitted", "queued"):
+            holders.append(asyncio.ensure_future(hold()))
+            while not admission.stats[key]:
+                await asyncio.sleep(0.005)
+        try:
+            async with admission.slot("2", 0, time.time() + 5):
+                pass
+        except Overloaded as e:
+            return e.status
+        finally:
+            await asyncio.gather(*holders)
+
+    assert asyncio.run(main()) == 429
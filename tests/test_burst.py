@@ -0,0 +1,10 @@
+def test_every_burst_frame_is_detected_with_the_cache_on(fakes, start_app):
+    # A still scene, where nothing qualifies, so the burst runs to its last frame
+    fakes["sss"].frames = fakes["sss"].frames[:1]
+    fakes["deepstack"].canned = []
+    app = start_app(cameras=1, settings={"burst": {"frames": 3, "spacing": 0.05}, "detectionCache": True})
+
+    before = fakes["deepstack"].stats.get("detections", 0)
+    assert app.get("/1").status_code == 200
+    # Frames of one burst look alike; the cache must not answer for the later ones
+    assert fakes["deepstack"].stats["detections"] - before == 3
@@ -0,0 +1,23 @@
+import types
+
+from camerarules import camera_options, setting_options
+
+DEFAULTS = {"a": 1, "b": 2}
+
+def test_setting_options():
+    assert setting_options(None, DEFAULTS) is None
+    assert setting_options(False, DEFAULTS) is None
+    assert setting_options(True, DEFAULTS) == DEFAULTS
+    assert setting_options({"b": 3}, DEFAULTS) == {"a": 1, "b": 3}
+
+def test_camera_options_override_the_global_setting():
+    def camera(**options):
+        return types.SimpleNamespace(options=options)
+    everywhere = setting_options({"a": 5}, DEFAULTS)
+
+    assert camera_options(camera(), "gate", everywhere, DEFAULTS) == {"a": 5, "b": 2}
+    assert camera_options(camera(gate=False), "gate", everywhere, DEFAULTS) is None
+    assert camera_options(camera(gate={"b": 7}), "gate", everywhere, DEFAULTS) == {"a": 5, "b": 7}
+    # On for one camera only
+    assert camera_options(camera(), "gate", None, DEFAULTS) is None
+    assert camera_options(camera(gate=True), "gate", None, DEFAULTS) == DEFAULTS
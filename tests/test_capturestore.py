@@ -0,0 +1,19 @@
+import tempfile
+
+from capturestore import CaptureStore
+
+def labels_of(store, label):
+    return [e["labels"] for e in store.events(label=label)["events"]]
+
+def test_labels_stored_as_a_list_and_matched_exactly():
+    store = CaptureStore(tempfile.mkdtemp())
+    for t, labels in enumerate((["Test Request"], ["person", "car"], ["per_on"], ["100%"])):
+        store.record("1", "one", float(t), labels, [], store.path("one", float(t)))
+
+    assert labels_of(store, "Test Request") == [["Test Request"]]
+    assert labels_of(store, "Test") == []
+    assert labels_of(store, "car") == [["person", "car"]]
+    # LIKE wildcards in a label are matched literally
+    assert labels_of(store, "per_on") == [["per_on"]]
+    assert labels_of(store, "%") == []
+    assert labels_of(store, "100%") == [["100%"]]
@@ -0,0 +1,57 @@
+import asyncio
+
+import httpclient
+import metrics
+from deepstack import Dispatcher
+from fakes import FakeDeepStack
+
+def test_cancelling_a_hedged_detection_cancels_its_requests():
+    servers = [FakeDeepStack(latency=3.0, predictions=[]).start() for _ in range(2)]
+    try:
+        dispatcher = Dispatcher([s.url for s in servers], health_interval=0, hedge_min_delay=0.05)
+        hedges = metrics.REGISTRY.get_sample_value("sssai_deepstack_hedges_total")
+        for backend in dispatcher.backends:
+            backend.latencies.extend([0.05] * 20)
+
+        async def main():
+            detection = asyncio.ensure_future(dispatcher.detect(b"jpeg"))
+            await asyncio.sleep(0.2)
+            detection.cancel()
+            try:
+                await detection
+            except asyncio.CancelledError:
+                pass
+            outstanding = [b.outstanding for b in dispatcher.backends]
+            await httpclient.close()
+            return outstanding
+
+        # Both the request and its hedge are gone once detect() returns
+        assert asyncio.run(main()) == [0, 0]
+        assert metrics.REGISTRY.get_sample_value("sssai_deepstack_hedges_total") - hedges == 1
+    finally:
+        for server in servers:
+            server.stop()
+
+def test_ejected_backends_are_exported_until_they_answer_again():
+    server = FakeDeepStack(predictions=[]).start()
+    try:
+        dispatcher = Dispatcher([server.url], health_interval=0, failure_threshold=2, cooldown=0.1, attempts=1)
+        ejected = lambda: metrics.REGISTRY.get_sample_value("sssai_deepstack_backend_ejected", {"backend": server.url})
+
+        async def main():
+            server.error_rate = 1.0
+            for _ in range(2):
+                try:
+                    await dispatcher.detect(b"jpeg")
+                except Exception:
+                    pass
+            states = [ejected()]
+            server.error_rate = 0.0
+            await asyncio.sleep(0.15)
+            await dispatcher.detect(b"jpeg")
+            await httpclient.close()
+            return states + [ejected()]
+
+        assert asyncio.run(main()) == [1, 0]
+    finally:
+        server.stop()
@@ -0,0 +1,34 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import types
+
+import detectcache
+
+def test_shared_cache_does_not_block_the_event_loop(monkeypatch):
+    filename = os.path.join(tempfile.mkdtemp(), "cache.db")
+    monkeypatch.setattr(detectcache, "_cache", detectcache.SharedCache(filename))
+    camera = types.SimpleNamespace(id="1", name="one", options={})
+    opts = dict(detectcache.DEFAULTS)
+    predictions = [{"label": "person", "confidence": 0.9, "x_min": 0, "y_min": 0, "x_max": 10, "y_max": 10}]
+
+    async def main():
+        # Another worker writes to the cache for a while
+        other = sqlite3.connect(filename, isolation_level=None)
+        other.execute("BEGIN IMMEDIATE")
+        asyncio.get_event_loop().call_later(0.5, other.execute, "COMMIT")
+
+        async def put_and_get():
+            await detectcache.store(camera, 0b1011, 1000.0, predictions, opts)
+            return await detectcache.lookup(camera, 0b1010, 1001.0, opts)
+        cached = asyncio.ensure_future(put_and_get())
+        ticks = 0
+        while not cached.done():
+            ticks += 1
+            await asyncio.sleep(0.01)
+        return ticks, await cached
+
+    ticks, cached = asyncio.run(main())
+    assert ticks >= 30
+    assert cached == predictions
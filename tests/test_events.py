@@ -0,0 +1,34 @@
+import os
+import sqlite3
+import time
+
+PERSON = {"label": "person", "confidence": 0.9, "x_min": 1000, "y_min": 500, "x_max": 1200, "y_max": 900}
+
+def wait_for_events(app, count, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        events = app.get("/events").json()["events"]
+        if len(events) >= count or time.time() > deadline:
+            return events
+        time.sleep(0.05)
+
+def test_capture_indexed_without_blocking_the_event_loop(fakes, start_app):
+    fakes["deepstack"].canned = [PERSON]
+    app = start_app(cameras=1)
+
+    # Another worker holds the capture index while this one saves its capture
+    other = sqlite3.connect(os.path.join(app.directory, "captures", "captures.db"), isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        assert app.get("/1").status_code == 200
+        time.sleep(0.5)
+        s = time.perf_counter()
+        assert app.get("/healthz").status_code == 200
+        assert time.perf_counter() - s < 0.5
+    finally:
+        other.execute("COMMIT")
+
+    events = wait_for_events(app, 1)
+    assert [(e["camera_id"], e["labels"]) for e in events] == [("1", ["person"])]
+    image = app.get("/events/{}".format(events[0]["id"]))
+    assert image.status_code == 200 and image.headers["content-type"] == "image/jpeg"
@@ -0,0 +1,18 @@
+import json
+import time
+
+PERSON = {"label": "person", "confidence": 0.9, "x_min": 1000, "y_min": 500, "x_max": 1200, "y_max": 900}
+
+def test_json_logs_are_only_json(fakes, start_app):
+    fakes["deepstack"].canned = [PERSON]
+    app = start_app(cameras=1, env={"JSON_LOGS": "1", "LOG_LEVEL": "DEBUG"})
+    assert app.get("/1").status_code == 200
+    deadline = time.time() + 10
+    while not fakes["smtp"].stats.get("messages"):
+        assert time.time() < deadline, "no mail sent"
+        time.sleep(0.05)
+    app.stop()
+
+    with open(app.log.name) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    assert any(e["message"].startswith("Mail sent") for e in entries)
@@ -0,0 +1,12 @@
+import re
+
+def test_metrics_aggregated_over_workers_with_default_multiproc_dir(start_app):
+    # PROMETHEUS_MULTIPROC_DIR is left for run.py to set, as in the container
+    app = start_app(workers=2)
+    for camera_id in ("1", "2", "1", "2"):
+        assert app.get("/" + camera_id).status_code == 200
+
+    body = app.get("/metrics").text
+    events = sum(float(value) for value in re.findall(r'^sssai_events_total\{[^}]*\} ([0-9.e+]+)$', body, re.M))
+    assert events == 4
+    assert re.search(r'^sssai_stage_seconds_count\{camera="1",stage="request"\} 2\.0$', body, re.M)
@@ -0,0 +1,17 @@
+def test_scene_whose_detection_failed_is_detected_again(fakes, start_app):
+    # A still scene
+    fakes["sss"].frames = fakes["sss"].frames[:1]
+    fakes["deepstack"].canned = []
+    app = start_app(cameras=1, settings={"motionGate": True, "deepstackAttempts": 1})
+
+    def event():
+        before = fakes["deepstack"].stats.get("detections", 0)
+        assert app.get("/1").status_code == 200
+        return fakes["deepstack"].stats.get("detections", 0) - before
+
+    fakes["deepstack"].error_rate = 1.0
+    assert event() == 1
+    # The failed detection did not make the snapshot the gate's reference
+    fakes["deepstack"].error_rate = 0.0
+    assert event() == 1
+    assert event() == 0
@@ -0,0 +1,26 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from conftest import ROOT
+
+def test_recorded_snapshots_replay(fakes, start_app):
+    record_dir = tempfile.mkdtemp()
+    app = start_app(cameras=1, settings={"replayRecordDir": record_dir})
+    assert app.get("/1").status_code == 200
+
+    # Written in the background, on the recording queue
+    deadline = time.time() + 10
+    while not os.path.isdir(os.path.join(record_dir, "1")) or len(os.listdir(os.path.join(record_dir, "1"))) < 2:
+        assert time.time() < deadline, "snapshot not recorded"
+        time.sleep(0.05)
+
+    out = subprocess.run([sys.executable, os.path.join(ROOT, "app", "replay.py"), record_dir, "--jsonl", "--processes", "1",
+                          "--cameras", os.path.join(app.directory, "cameras.json")],
+                         stdout=subprocess.PIPE, check=True, env=dict(os.environ, PYTHONPATH=os.path.join(ROOT, "app"))).stdout
+    results = [json.loads(line) for line in out.splitlines()]
+    assert [r["camera_id"] for r in results] == ["1"]
+    assert results[0]["decisions"][0] is not None
@@ -0,0 +1,43 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import types
+
+import tracker
+from zones import Detection
+
+def test_update_does_not_block_the_event_loop(monkeypatch):
+    monkeypatch.setattr(tracker, "store_file", os.path.join(tempfile.mkdtemp(), "tracker.db"))
+    camera = types.SimpleNamespace(id="1", name="one", options={})
+    car = Detection(0, "car", 90, (50.0, 100), {"x_min": 0, "y_min": 0, "x_max": 100, "y_max": 100})
+    opts = dict(tracker.DEFAULTS)
+
+    async def main():
+        # Another worker holds the tracks for a while
+        tracker._get_store()
+        other = sqlite3.connect(tracker.store_file, isolation_level=None)
+        other.execute("BEGIN IMMEDIATE")
+        asyncio.get_event_loop().call_later(0.5, other.execute, "COMMIT")
+
+        update = asyncio.ensure_future(tracker.update(camera, [car], 1000.0, opts))
+        ticks = 0
+        while not update.done():
+            ticks += 1
+            await asyncio.sleep(0.01)
+        return ticks, await update
+
+    ticks, moving = asyncio.run(main())
+    assert ticks >= 30
+    assert moving == [car]
+
+def test_stationary_object_suppressed_after_the_configured_events(monkeypatch):
+    monkeypatch.setattr(tracker, "store_file", os.path.join(tempfile.mkdtemp(), "tracker.db"))
+    camera = types.SimpleNamespace(id="1", name="one", options={})
+    car = Detection(0, "car", 90, (50.0, 100), {"x_min": 0, "y_min": 0, "x_max": 100, "y_max": 100})
+    opts = dict(tracker.DEFAULTS, events=2)
+
+    async def main():
+        return [bool(await tracker.update(camera, [car], 1000.0 + i, opts)) for i in range(4)]
+
+    assert asyncio.run(main()) == [True, True, False, False]
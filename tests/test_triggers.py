@@ -0,0 +1,25 @@
+import os
+import sqlite3
+import threading
+import time
+
+PERSON = {"label": "person", "confidence": 0.9, "x_min": 1000, "y_min": 500, "x_max": 1200, "y_max": 900}
+
+def test_trigger_claim_does_not_block_the_event_loop(fakes, start_app):
+    fakes["deepstack"].canned = [PERSON]
+    app = start_app(cameras=1)
+
+    # Another worker holds the trigger store while the event claims its trigger
+    other = sqlite3.connect(os.path.join(app.directory, "last_trigger.db"), isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    event = threading.Thread(target=lambda: app.get("/1"))
+    event.start()
+    try:
+        time.sleep(0.3)
+        s = time.perf_counter()
+        assert app.get("/healthz").status_code == 200
+        assert time.perf_counter() - s < 0.5
+    finally:
+        other.execute("COMMIT")
+        event.join()
+    assert fakes["sss"].stats.get("triggers", 0) == 1
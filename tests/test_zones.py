@@ -0,0 +1,144 @@
+import collections
+import random
+
+from camerarules import Camera
+from polygon import IsInsidePolygon
+from zones import find_trigger, find_triggers, get_zones, prediction_arrays
+
+SQUARE = [[100, 100], [300, 100], [300, 300], [100, 300]]
+
+def camera(*detect_objects):
+    return Camera("1", {"name": "one", "triggerUrl": "", "detect_objects": list(detect_objects)})
+
+def rule(label="person", min_size=0, min_confidence=0, areas=(), polygons=()):
+    return {"type": label, "min_sizex": min_size, "min_sizey": min_size, "min_confidence": min_confidence,
+            "ignore_areas": [dict(zip(("x_min", "y_min", "x_max", "y_max"), a)) for a in areas],
+            "ignore_polygons": [list(p) for p in polygons]}
+
+def box(x_min, y_min, x_max, y_max, label="person", confidence=0.9):
+    return {"label": label, "confidence": confidence, "x_min": x_min, "y_min": y_min, "x_max": x_max, "y_max": y_max}
+
+def legacy(cameradata, predictions, offset):
+    """Index of the prediction the original CheckZones loop (before zones.py) triggered on, or None."""
+    def in_areas(p, areas):
+        return not areas or any(a["x_min"] < p["x_min"] < p["x_max"] < a["x_max"] and
+                                a["y_min"] < p["y_min"] < p["y_max"] < a["y_max"] for a in areas)
+
+    def in_polygons(polygons, point, label):
+        return not polygons or any(IsInsidePolygon(polygon, point, label) for polygon in polygons)
+
+    for i, prediction in enumerate(predictions):
+        confidence = round(100 * prediction["confidence"])
+        label = prediction["label"]
+        sizex = int(prediction["x_max"]) - int(prediction["x_min"])
+        sizey = int(prediction["y_max"]) - int(prediction["y_min"])
+        point = [(int(prediction["x_max"]) + int(prediction["x_min"])) / 2,
+                 int(int(prediction["y_min"]) + (int(prediction["y_max"]) - int(prediction["y_min"])) * (1 - offset))]
+        for detect_object in cameradata["detect_objects"]:
+            if detect_object["type"] != label:
+                continue
+            if sizex > detect_object["min_sizex"] and sizey > detect_object["min_sizey"] and \
+                    confidence > detect_object["min_confidence"]:
+                areas = [{k: int(v) for k, v in a.items()} for a in detect_object.get("ignore_areas", [])]
+                if not in_areas(prediction, areas) or \
+                        not in_polygons(detect_object["ignore_polygons"], point, label):
+                    return i
+    return None
+
+def triggered(c, predictions, offset=0.5, frame_size=None):
+    return [d.index for d in find_triggers(c, predictions, offset, frame_size)]
+
+def test_ignore_areas_need_the_box_strictly_inside():
+    c = camera(rule(areas=[(100, 100, 300, 300)]))
+    assert triggered(c, [box(150, 150, 250, 250)]) == []
+    # Overlapping, or touching the area's edge, is not inside
+    assert triggered(c, [box(50, 150, 250, 250)]) == [0]
+    assert triggered(c, [box(100, 150, 250, 250)]) == [0]
+
+def test_ignore_polygons_test_the_anchor_point():
+    c = camera(rule(polygons=[SQUARE]))
+    assert triggered(c, [box(150, 150, 250, 250)]) == []
+    assert triggered(c, [box(350, 150, 450, 250)]) == [0]
+    # On an edge counts as inside
+    assert triggered(c, [box(250, 150, 350, 250)]) == []
+
+def test_empty_zone_lists_are_no_zone_to_be_outside_of():
+    # As in CheckZones: a rule without ignore zones never triggers, and with only one
+    # kind of zone the prediction has to be outside of that kind
+    assert triggered(camera(rule()), [box(150, 150, 250, 250)]) == []
+    areas_only = camera(rule(areas=[(100, 100, 300, 300)]))
+    assert triggered(areas_only, [box(150, 150, 250, 250), box(400, 400, 500, 500)]) == [1]
+    polygons_only = camera(rule(polygons=[SQUARE]))
+    assert triggered(polygons_only, [box(150, 150, 250, 250), box(400, 400, 500, 500)]) == [1]
+    # Polygons of less than 3 vertices never contain a point
+    assert triggered(camera(rule(polygons=[[[0, 0], [500, 500]]])), [box(150, 150, 250, 250)]) == [0]
+
+def test_any_rule_of_the_label_may_pass():
+    c = camera(rule(min_size=500, polygons=[[[0, 0], [1, 0], [1, 1]]]),
+               rule(min_confidence=95, polygons=[[[0, 0], [1, 0], [1, 1]]]),
+               rule(polygons=[SQUARE]))
+    # Too small for the first, not confident enough for the second, in the zone of the third
+    assert triggered(c, [box(150, 150, 250, 250)]) == []
+    # Passes the third
+    assert triggered(c, [box(350, 150, 450, 250)]) == [0]
+    # Other labels and thresholds
+    assert triggered(c, [box(350, 150, 450, 250, label="car")]) == []
+    skipped = collections.Counter()
+    find_triggers(camera(rule(min_size=150, min_confidence=80, polygons=[SQUARE])),
+                  [box(350, 150, 450, 250), box(350, 150, 550, 350, confidence=0.5), box(0, 0, 10, 10, label="cat")],
+                  0.5, None, skipped)
+    assert skipped == {"size": 1, "confidence": 1, "label": 1}
+
+def test_bottom_offset_moves_the_anchor_up_from_the_bottom():
+    # Bottom of the box in the zone, its center above it
+    c = camera(rule(polygons=[[[0, 200], [500, 200], [500, 500], [0, 500]]]))
+    person = box(100, 0, 200, 240)
+    assert triggered(c, [person], offset=0.5) == [0]
+    assert triggered(c, [person], offset=0.1) == []
+    assert find_trigger(c, [person], 0.1) is None
+
+def test_first_trigger_matches_check_zones():
+    rnd = random.Random(3)
+    for _ in range(300):
+        polygons = [[[rnd.randint(0, 1920), rnd.randint(0, 1080)] for _ in range(rnd.randint(3, 7))]
+                    for _ in range(rnd.randint(0, 3))]
+        areas = [(x, y, x + rnd.randint(50, 800), y + rnd.randint(50, 600))
+                 for x, y in ((rnd.randint(0, 1500), rnd.randint(0, 800)) for _ in range(rnd.randint(0, 2)))]
+        data = {"name": "one", "triggerUrl": "", "detect_objects": [
+            rule(label, rnd.randint(0, 100), rnd.randint(0, 90), areas, polygons) for label in ("person", "car")]}
+        predictions = []
+        for _ in range(rnd.randint(1, 8)):
+            x, y = rnd.randint(0, 1800), rnd.randint(0, 900)
+            predictions.append(box(x, y, x + rnd.randint(10, 300), y + rnd.randint(10, 300),
+                                   rnd.choice(("person", "car", "dog")), rnd.uniform(0.3, 1.0)))
+        offset = rnd.choice((0.1, 0.5))
+        _, points, _ = prediction_arrays(predictions, offset)
+        if any(y == point[1] and x >= point[0] for polygon in polygons for x, y in polygon for point in points.tolist()):
+            # polygon.py counts these as inside whatever the polygon (see test below)
+            continue
+        detection = find_trigger(Camera("1", data), predictions, offset)
+        assert (detection.index if detection else None) == legacy(data, predictions, offset)
+
+def test_points_level_with_a_vertex_are_tested_exactly():
+    # polygon.py calls (50, 200) inside the diamond because its vertex (100, 200) is level
+    # with it, to its right; zones.py finds it outside and triggers
+    diamond = [[200, 100], [300, 200], [200, 300], [100, 200]]
+    person = box(0, 100, 100, 200)
+    assert IsInsidePolygon(diamond, (50, 200), "person")
+    assert legacy({"detect_objects": [rule(polygons=[diamond])]}, [person], 0.0) is None
+    assert triggered(camera(rule(polygons=[diamond])), [person], offset=0.0) == [0]
+
+def test_mask_agrees_with_the_ray_cast_away_from_edges():
+    rnd = random.Random(5)
+    polygon = [[400, 100], [900, 300], [800, 900], [300, 700], [200, 300]]
+    zones = get_zones(camera(rule(polygons=[polygon])).rules["person"][0])
+    predictions = [box(x, y, x + 40, y + 40) for x, y in ((rnd.randint(0, 1800), rnd.randint(0, 1000)) for _ in range(2000))]
+    _, points, _ = prediction_arrays(predictions, 0.5)
+    exact = zones.in_polygons(points)
+    masked = zones.in_polygons(points, (1920, 1080))
+    differ = (exact != masked).nonzero()[0]
+    # Rasterizing only moves the boundary by a pixel or so
+    for i in differ:
+        assert any(zones.in_polygons(points[i:i + 1] + (dx, dy))[0] != exact[i]
+                   for dx in (-2, 0, 2) for dy in (-2, 0, 2))
+    assert len(differ) < 0.01 * len(points)